@@ -0,0 +1,155 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Fast extraction of the ARD-METADATA.yaml values used by 'item_template.py'.
+
+Only 'id', 'extent.center_dt', 'extent.coord.ll', 'extent.coord.ur' and
+'image.bands.*.path' are needed, out of a ~23 kB document that is mostly lineage and
+processing history.
+
+HOW:
+    - The libyaml C loader is used whenever PyYAML was built with it.
+    - mode='full' loads the whole document, as before.
+    - mode='events' (the default) walks the parser's event stream and constructs only
+      the subtrees listed in WANTED. Everything else is skipped without building any
+      node, and parsing stops as soon as all top-level keys in WANTED have been seen,
+      so the lineage section is usually never parsed at all.
+
+In both modes the values, their types and the order of the bands are the same as
+those of a full load, so the ItemTemplate makes exactly the same item.
+'''
+# ------------------------------------------------------------------------------
+import yaml
+from yaml.nodes import MappingNode, ScalarNode, SequenceNode
+
+LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+HAVE_LIBYAML = LOADER is not yaml.SafeLoader
+MODES = ('events', 'full')
+
+# The parts of the document to construct. None means the whole subtree, '*' any key.
+WANTED = {
+    'id': None,
+    'extent': {
+        'center_dt': None,
+        'coord': {'ll': None, 'ur': None},
+    },
+    'image': {
+        'bands': {'*': {'path': None}},
+    },
+}
+
+# ------------------------------------------------------------------------------
+# load_ard_metadata:
+# Load the required values from an ARD-METADATA.yaml.
+# 'stream' is an open file (preferably binary), bytes or str.
+# ------------------------------------------------------------------------------
+def load_ard_metadata(stream, mode='events'):
+    if mode == 'full':
+        return yaml.load(stream, Loader=LOADER)
+    if mode != 'events':
+        raise ValueError('Unknown ARD-METADATA.yaml mode: {}'.format(mode))
+
+    loader = LOADER(stream)
+    try:
+        loader.get_event() # StreamStart
+        loader.get_event() # DocumentStart
+        if not loader.check_event(yaml.MappingStartEvent):
+            raise _FullLoadNeeded()
+        return _extract_mapping(loader, WANTED, {}, top_level=True)
+    except _FullLoadNeeded:
+        if not isinstance(stream, (bytes, str)):
+            stream.seek(0)
+        return yaml.load(stream, Loader=LOADER)
+    finally:
+        loader.dispose()
+
+# ------------------------------------------------------------------------------
+# _FullLoadNeeded:
+# Raised for the rare documents that cannot be extracted piecemeal: a top level that
+# is not a mapping, a merge key, or an alias to an anchor in a skipped section.
+# ------------------------------------------------------------------------------
+class _FullLoadNeeded(Exception):
+    pass
+
+# ------------------------------------------------------------------------------
+# _extract_mapping:
+# Walk a mapping, constructing the values of the keys in 'spec' and skipping the rest.
+# At the top level, stop reading as soon as every wanted key has been found.
+# ------------------------------------------------------------------------------
+def _extract_mapping(loader, spec, anchors, top_level=False):
+    loader.get_event() # MappingStart
+    result = {}
+    remaining = set(spec) - {'*'}
+    while not loader.check_event(yaml.MappingEndEvent):
+        key_node = _compose(loader, anchors)
+        if key_node.tag == 'tag:yaml.org,2002:merge': # The safe loaders cannot construct it alone.
+            raise _FullLoadNeeded()
+        key = loader.construct_object(key_node)
+        sub_spec = spec.get(key, spec.get('*', False))
+        if sub_spec is False:
+            _skip(loader)
+            continue
+        if sub_spec is not None and loader.check_event(yaml.MappingStartEvent):
+            result[key] = _extract_mapping(loader, sub_spec, anchors)
+        else:
+            result[key] = loader.construct_object(_compose(loader, anchors), deep=True)
+        remaining.discard(key)
+        if top_level and not remaining:
+            return result
+    loader.get_event() # MappingEnd
+    return result
+
+# ------------------------------------------------------------------------------
+# _compose:
+# Build the node of the next value from the event stream, resolving implicit tags
+# the same way the loader's own composer does.
+# ------------------------------------------------------------------------------
+def _compose(loader, anchors):
+    event = loader.get_event()
+    if isinstance(event, yaml.AliasEvent):
+        if event.anchor not in anchors:
+            raise _FullLoadNeeded()
+        return anchors[event.anchor]
+    if isinstance(event, yaml.ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(ScalarNode, event.value, event.implicit)
+        node = ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+    elif isinstance(event, yaml.SequenceStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(SequenceNode, None, event.implicit)
+        node = SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(_compose(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+    else:
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(MappingNode, None, event.implicit)
+        node = MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose(loader, anchors)
+            node.value.append((key, _compose(loader, anchors)))
+        node.end_mark = loader.get_event().end_mark
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+    return node
+
+# ------------------------------------------------------------------------------
+# _skip:
+# Consume the events of the next value without building anything.
+# ------------------------------------------------------------------------------
+def _skip(loader):
+    depth = 0
+    while True:
+        event = loader.get_event()
+        if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+        if depth == 0:
+            return
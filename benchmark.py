@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Benchmark of 'parse_direct.py' and 'parse_direct_parallel.py' on a synthetic DEA
+archive, so that their throughput can be reproduced and regressions caught.
+
+HOW:
+    - A synthetic archive of N items across M subsets is written to work_dir. Each
+      item has a ~23 kB ARD-METADATA.yaml, laid out like those of S2_MSI_ARD (keys in
+      the same order, with the large 'lineage' block between 'image' and the end),
+      and a bounds.geojson.
+    - Each mode runs the real program in a fresh Python process on a fresh
+      output_dir, with its output discarded:
+        serial, parallel:               one subset.
+        serial_A, parallel_A:           all subsets ('subset: A').
+        serial_incremental, parallel_incremental:
+                                        all subsets with --incremental, run three
+                                        times: on an empty output_dir (cold), again
+                                        with nothing changed (warm), and after
+                                        CHANGED_FRACTION of the items changed.
+      Each run reports its items/s, its peak RSS and the largest peak RSS of its
+      workers.
+    - The time per stage (list, stat, read, parse_yaml, parse_geojson, build,
+      serialise, write) is measured in this process over the whole archive, with the
+      same functions the programs use.
+    - The results are saved as JSON. With --compare, the items/s of each mode is
+      compared with a previous results file and the exit status is 1 if any fell by
+      more than --tolerance.
+
+USAGE:
+    benchmark.py --items=2000 --subsets=8 --results=bench_results.json
+    benchmark.py --items=2000 --subsets=8 --results=new.json --compare=bench_results.json
+'''
+# ------------------------------------------------------------------------------
+import click
+import collections
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import ard_yaml
+import executor
+import item_template
+import storage
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASE_URL = 'http://dea-public-data.s3-ap-southeast-2.amazonaws.com/S2_MSI_ARD/'
+ARD_METADATA_SIZE = 23 * 1024 # Bytes. About the size of an S2_MSI_ARD ARD-METADATA.yaml.
+CHANGED_FRACTION = 0.01 # Items changed before the last incremental run.
+MODES = ('serial', 'parallel', 'serial_A', 'parallel_A', 'serial_incremental', 'parallel_incremental')
+STAGES = ('list', 'stat', 'read', 'parse_yaml', 'parse_geojson', 'build', 'serialise', 'write')
+
+BANDS = ['lambertian_blue', 'lambertian_green', 'lambertian_red', 'lambertian_nir', 'lambertian_swir_1',
+         'lambertian_swir_2', 'nbar_blue', 'nbar_green', 'nbar_red', 'nbar_nir', 'nbar_swir_1', 'nbar_swir_2',
+         'nbart_blue', 'nbart_green', 'nbart_red', 'nbart_nir', 'nbart_swir_1', 'nbart_swir_2', 'fmask',
+         'satellite_azimuth', 'satellite_view', 'solar_azimuth', 'solar_zenith', 'relative_azimuth',
+         'timedelta', 'incident', 'exiting', 'azimuthal_incident', 'azimuthal_exiting', 'terrain_shadow']
+L1_BANDS = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12']
+
+# The code in the runner process: run a program as __main__ and save its exit code,
+# run time and peak RSS (of itself and of its largest child) to a JSON file.
+_RUNNER = """
+import json, os, resource, runpy, sys, time
+script, results_file = sys.argv[1], sys.argv[2]
+sys.argv = [script] + sys.argv[3:]
+sys.path.insert(0, os.path.dirname(script))
+code = 0
+start = time.perf_counter()
+try:
+    runpy.run_path(script, run_name='__main__')
+except SystemExit as e:
+    code = e.code or 0
+seconds = time.perf_counter() - start
+with open(results_file, 'w') as f:
+    json.dump({'returncode': code, 'seconds': seconds,
+               'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               'peak_worker_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}, f)
+"""
+
+# ------------------------------------------------------------------------------
+# make_ard_metadata:
+# A synthetic ARD-METADATA.yaml of at least 'size' bytes.
+# ------------------------------------------------------------------------------
+def make_ard_metadata(rnd, item, center_dt, ll, ur, size=ARD_METADATA_SIZE):
+    lon0, lat0 = ll
+    lon1, lat1 = ur
+    x0, y0 = rnd.randint(2, 8) * 100000.0, rnd.randint(50, 70) * 100000.0
+    lines = [
+        "algorithm_information:",
+        "  algorithm_version: 2.0.0",
+        "  arg25_doi: http://dx.doi.org/10.4225/25/5487CC0D4F40B",
+        "  nbar_doi: http://dx.doi.org/10.1109/JSTARS.2010.2042281",
+        "  nbar_terrain_corrected_doi: http://dx.doi.org/10.1016/j.rse.2012.06.018",
+        "creation_dt: '{}'".format(center_dt.replace('Z', '') + '123'),
+        "extent:",
+        "  center_dt: '{}'".format(center_dt),
+        "  coord:",
+        "    ll: {{lat: {}, lon: {}}}".format(lat0, lon0),
+        "    lr: {{lat: {}, lon: {}}}".format(lat0, lon1),
+        "    ul: {{lat: {}, lon: {}}}".format(lat1, lon0),
+        "    ur: {{lat: {}, lon: {}}}".format(lat1, lon1),
+        "format: {name: GeoTIFF}",
+        "grid_spatial:",
+        "  projection:",
+        "    geo_ref_points:",
+        "      ll: {{x: {}, y: {}}}".format(x0, y0),
+        "      lr: {{x: {}, y: {}}}".format(x0 + 109800.0, y0),
+        "      ul: {{x: {}, y: {}}}".format(x0, y0 + 109800.0),
+        "      ur: {{x: {}, y: {}}}".format(x0 + 109800.0, y0 + 109800.0),
+        "    spatial_reference: PROJCS[\"WGS 84 / UTM zone 56S\",GEOGCS[\"WGS 84\",DATUM[\"WGS_1984\",SPHEROID[\"WGS",
+        "      84\",6378137,298.257223563,AUTHORITY[\"EPSG\",\"7030\"]],AUTHORITY[\"EPSG\",\"6326\"]],PRIMEM[\"Greenwich\",0],UNIT[\"degree\",0.0174532925199433],AUTHORITY[\"EPSG\",\"4326\"]],PROJECTION[\"Transverse_Mercator\"],PARAMETER[\"latitude_of_origin\",0],PARAMETER[\"central_meridian\",153],PARAMETER[\"scale_factor\",0.9996],PARAMETER[\"false_easting\",500000],PARAMETER[\"false_northing\",10000000],UNIT[\"metre\",1],AUTHORITY[\"EPSG\",\"32756\"]]",
+        "id: {}".format(uuid.UUID(int=rnd.getrandbits(128))),
+        "image:",
+        "  bands:",
+    ]
+    for band in BANDS:
+        product = band.split('_')[0].upper() if band.startswith(('lambertian', 'nbar', 'nbart')) else 'SUPPLEMENTARY'
+        lines += ["    {}:".format(band), "      layer: 1", "      path: {}/{}_{}.TIF".format(product, product, band.upper())]
+    lines += [
+        "lineage:",
+        "  source_datasets:",
+        "    level1:",
+        "      acquisition:",
+        "        groundstation: {code: ASA}",
+        "      checksum_sha1: {:040x}".format(rnd.getrandbits(160)),
+        "      creation_dt: '{}'".format(center_dt.replace('Z', '')),
+        "      extent:",
+        "        center_dt: '{}'".format(center_dt),
+        "      format: {name: JPEG2000}",
+        "      id: {}".format(uuid.UUID(int=rnd.getrandbits(128))),
+        "      image:",
+        "        bands:",
+    ]
+    for band in L1_BANDS:
+        lines += ["          '{}':".format(band), "            layer: 1",
+                  "            path: GRANULE/{}/IMG_DATA/{}_{}.jp2".format(item, item[:40], band)]
+    lines += ["        cloud_cover_percentage: {:.4f}".format(rnd.uniform(0, 100)),
+              "        tile_reference: T56HPK",
+              "        viewing_angles:"]
+    tail = [
+        "processing_level: Level-2",
+        "product_type: S2MSIARD",
+        "software_versions:",
+        "  eodatasets: {repo_url: 'https://github.com/GeoscienceAustralia/eo-datasets.git', version: 0.1.0}",
+        "  gaip: {repo_url: 'https://github.com/GeoscienceAustralia/gaip.git', version: 5.2.1}",
+        "  modtran: {repo_url: 'http://www.ontar.com/software/productdetails.aspx?item=modtran', version: 6.0.1}",
+        "  tesp: {repo_url: 'https://github.com/OpenDataCubePipelines/tesp.git', version: 0.2.1}",
+        "system_information:",
+        "  hostname: r{}".format(rnd.randint(1000, 4000)),
+        "  runtime_id: {}".format(uuid.UUID(int=rnd.getrandbits(128))),
+        "  time_processed: '{}'".format(center_dt.replace('Z', '')),
+        "  uname: Linux r1234 3.10.0 x86_64",
+    ]
+    # The viewing angles of the detectors make up most of a real file.
+    used = sum(len(line) + 1 for line in lines + tail)
+    k = 0
+    while used < size:
+        line = "          {}_detector_{:02d}: {{azimuth: {:.6f}, zenith: {:.6f}}}".format(
+            L1_BANDS[k % len(L1_BANDS)], k // len(L1_BANDS), rnd.uniform(0, 360), rnd.uniform(0, 12))
+        lines.append(line)
+        used += len(line) + 1
+        k += 1
+    return "\n".join(lines + tail) + "\n"
+
+# ------------------------------------------------------------------------------
+# make_bounds:
+# The bounds.geojson of an item.
+# ------------------------------------------------------------------------------
+def make_bounds(ll, ur):
+    (lon0, lat0), (lon1, lat1) = ll, ur
+    ring = [[lon0, lat0], [lon1, lat0], [lon1, lat1], [lon0, lat1], [lon0, lat0]]
+    return json.dumps({'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}}]})
+
+# ------------------------------------------------------------------------------
+# make_archive:
+# Write a synthetic archive of n_items items, spread evenly over n_subsets tile
+# subsets, to input_dir. Returns the names of the subsets, as 'subset/'.
+# ------------------------------------------------------------------------------
+def make_archive(input_dir, n_items, n_subsets, seed=0):
+    rnd = random.Random(seed)
+    subsets = []
+    for s in range(n_subsets):
+        lat, lon = 10 + 5 * (s // 6), 115 + 5 * (s % 6)
+        subsets.append('{:02d}S{:03d}E-{:02d}S{:03d}E/'.format(lat, lon, lat + 5, lon + 5))
+    for i in range(n_items):
+        subset = subsets[i % n_subsets]
+        lat, lon = int(subset[0:2]), int(subset[3:6])
+        when = datetime.datetime(2018, 1, 1) + datetime.timedelta(days=rnd.randint(0, 364), seconds=rnd.randint(0, 86399))
+        item = 'S2A_OPER_MSI_ARD_TL_EPAE_{}_A{:06d}_T56HPK_N02.06'.format(when.strftime('%Y%m%dT%H%M%S'), i)
+        ll = (round(lon + rnd.uniform(0, 4), 6), round(-lat - rnd.uniform(1, 5), 6))
+        ur = (round(ll[0] + 1.0, 6), round(ll[1] + 1.0, 6))
+        item_dir = os.path.join(input_dir, subset, item)
+        os.makedirs(item_dir)
+        with open(os.path.join(item_dir, 'ARD-METADATA.yaml'), 'w') as f:
+            f.write(make_ard_metadata(rnd, item, when.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z', ll, ur))
+        with open(os.path.join(item_dir, 'bounds.geojson'), 'w') as f:
+            f.write(make_bounds(ll, ur))
+    return subsets
+
+# ------------------------------------------------------------------------------
+# change_items:
+# Change the ARD-METADATA.yaml of a fraction of the items, for an incremental run.
+# ------------------------------------------------------------------------------
+def change_items(input_dir, fraction, seed=0):
+    rnd = random.Random(seed)
+    for subset in sorted(os.listdir(input_dir)):
+        for item in sorted(os.listdir(os.path.join(input_dir, subset))):
+            if rnd.random() < fraction:
+                with open(os.path.join(input_dir, subset, item, 'ARD-METADATA.yaml'), 'a') as f:
+                    f.write("# reprocessed {}\n".format(rnd.getrandbits(32)))
+
+# ------------------------------------------------------------------------------
+# run_program:
+# Run 'parse_direct.py' (parallel=False) or 'parse_direct_parallel.py' in a fresh
+# process and return its results.
+# ------------------------------------------------------------------------------
+def run_program(work_dir, name, parallel, input_dir, subset, output_dir, n_items, args=()):
+    config_file = os.path.join(work_dir, name + '.yaml')
+    with open(config_file, 'w') as f:
+        f.write("base_url: {}\ninput_dir: {}\nsubset: {}\noutput_dir: {}\n".format(
+            BASE_URL, input_dir, subset.rstrip('/'), output_dir))
+    script = os.path.join(HERE, 'parse_direct_parallel.py' if parallel else 'parse_direct.py')
+    results_file = os.path.join(work_dir, name + '.json')
+    with open(os.path.join(work_dir, name + '.log'), 'w') as log:
+        subprocess.call([sys.executable, '-c', _RUNNER, script, results_file, config_file] + list(args),
+                        stdout=log, stderr=subprocess.STDOUT, cwd=work_dir)
+    with open(results_file) as f:
+        run = json.load(f)
+    print("{:<28} {:>6} items {:>8.2f} s {:>9.1f} items/s  RSS {:>6.1f} MB (workers {:.1f} MB){}".format(
+        name, n_items, run['seconds'], n_items / run['seconds'], run['peak_rss_kb'] / 1024.0,
+        run['peak_worker_rss_kb'] / 1024.0, '' if run['returncode'] == 0 else '  FAILED'))
+    return collections.OrderedDict([
+        ('mode', name), ('program', os.path.basename(script)), ('args', list(args)), ('items', n_items),
+        ('seconds', round(run['seconds'], 4)), ('items_per_sec', round(n_items / run['seconds'], 2)),
+        ('peak_rss_mb', round(run['peak_rss_kb'] / 1024.0, 1)),
+        ('peak_worker_rss_mb', round(run['peak_worker_rss_kb'] / 1024.0, 1)),
+        ('returncode', run['returncode'])])
+
+# ------------------------------------------------------------------------------
+# profile_stages:
+# Time each stage of item generation over the whole archive, in this process.
+# Returns {stage: {'seconds': s, 'ms_per_item': ms}}.
+# ------------------------------------------------------------------------------
+def profile_stages(input_dir, output_dir, metadata_mode):
+    seconds = collections.OrderedDict((stage, 0.0) for stage in STAGES)
+    input_store = storage.open_storage(input_dir)
+    output_store = storage.open_storage(output_dir)
+    clock = time.perf_counter
+    n = 0
+    for subset in sorted(input_store.list_subsets()):
+        start = clock()
+        items = list(input_store.list_items(subset))
+        seconds['list'] += clock() - start
+        template = item_template.ItemTemplate(BASE_URL + subset, BASE_URL)
+        for item in items:
+            t0 = clock()
+            item_record = input_store.item_record(subset, item)
+            t1 = clock()
+            ard_data, bounds_data = input_store.read_many([item_record.ard_metadata_file, item_record.bounds_file])
+            t2 = clock()
+            ard_metadata = ard_yaml.load_ard_metadata(ard_data, metadata_mode)
+            t3 = clock()
+            geodata = json.loads(bounds_data)
+            t4 = clock()
+            item_dict = template.to_dict(template.values(item, ard_metadata, geodata))
+            t5 = clock()
+            data = json.dumps(item_dict, indent=1)
+            t6 = clock()
+            output_store.write(subset + item + '/STAC.json', data)
+            t7 = clock()
+            for stage, begin, end in zip(STAGES[1:], (t0, t1, t2, t3, t4, t5, t6), (t1, t2, t3, t4, t5, t6, t7)):
+                seconds[stage] += end - begin
+            n += 1
+    stages = collections.OrderedDict()
+    for stage in STAGES:
+        stages[stage] = {'seconds': round(seconds[stage], 4), 'ms_per_item': round(1000.0 * seconds[stage] / max(n, 1), 4)}
+        print("{:<14} {:>8.3f} s {:>8.3f} ms/item".format(stage, seconds[stage], 1000.0 * seconds[stage] / max(n, 1)))
+    return stages
+
+# ------------------------------------------------------------------------------
+# compare:
+# Compare the items/s of each mode with a previous results file. Returns the modes
+# that fell by more than 'tolerance' (a fraction).
+# ------------------------------------------------------------------------------
+def compare(results, previous_file, tolerance):
+    with open(previous_file) as f:
+        previous = {run['mode']: run for run in json.load(f)['runs']}
+    regressions = []
+    for run in results['runs']:
+        before = previous.get(run['mode'])
+        if not before or not before['items_per_sec']:
+            continue
+        ratio = run['items_per_sec'] / before['items_per_sec']
+        flag = ''
+        if ratio < 1 - tolerance:
+            regressions.append(run['mode'])
+            flag = '  REGRESSION'
+        print("{:<28} {:>9.1f} -> {:>9.1f} items/s ({:+.0%}){}".format(
+            run['mode'], before['items_per_sec'], run['items_per_sec'], ratio - 1, flag))
+    return regressions
+
+# ------------------------------------------------------------------------------
+# main:
+# Generate the archive, run the modes, and save the results.
+# ------------------------------------------------------------------------------
+@click.command(name='benchmark')
+@click.option('--items', 'n_items', type=int, default=1000, help='Number of synthetic items.')
+@click.option('--subsets', 'n_subsets', type=int, default=4, help='Number of subsets the items are spread over.')
+@click.option('--cores', type=int, default=0, help='Workers of the parallel modes. By default, the CPUs available to this job.')
+@click.option('--modes', type=str, default=','.join(MODES), help='Comma separated modes to run, of: ' + ', '.join(MODES))
+@click.option('--metadata_mode', type=click.Choice(ard_yaml.MODES), default='events', help='How ARD-METADATA.yaml is read.')
+@click.option('--work_dir', type=str, default=None, help='Directory for the archive and outputs. By default a temporary one, removed afterwards.')
+@click.option('--results', type=str, default='bench_results.json', help='Where the JSON results are saved.')
+@click.option('--compare', 'previous_file', type=str, default=None, help='A previous results file to compare the items/s with.')
+@click.option('--tolerance', type=float, default=0.2, help='Fall in items/s, as a fraction, reported as a regression.')
+@click.option('--seed', type=int, default=0, help='Seed of the synthetic archive.')
+def main(n_items,n_subsets,cores,modes,metadata_mode,work_dir,results,previous_file,tolerance,seed):
+    modes = [mode for mode in modes.split(',') if mode]
+    for mode in modes:
+        if mode not in MODES:
+            raise click.BadParameter('Unknown mode {}'.format(mode), param_hint='--modes')
+    keep = work_dir is not None
+    work_dir = os.path.abspath(work_dir or tempfile.mkdtemp(prefix='stac-bench-'))
+    input_dir = os.path.join(work_dir, 'input')
+    if os.path.exists(input_dir):
+        shutil.rmtree(input_dir)
+
+    print("Writing {} items in {} subsets to {}".format(n_items, n_subsets, input_dir))
+    start = time.perf_counter()
+    subsets = make_archive(input_dir, n_items, n_subsets, seed)
+    print("Archive written in {:.1f} s".format(time.perf_counter() - start))
+    in_first_subset = len(os.listdir(os.path.join(input_dir, subsets[0])))
+    ard_sizes = [os.path.getsize(os.path.join(input_dir, subsets[0], item, 'ARD-METADATA.yaml'))
+                 for item in os.listdir(os.path.join(input_dir, subsets[0]))]
+
+    args = ['--metadata_mode=' + metadata_mode]
+    parallel_args = args + (['--cores={}'.format(cores)] if cores else [])
+    runs = []
+    try:
+        for mode in modes:
+            parallel = mode.startswith('parallel')
+            output_dir = os.path.join(work_dir, 'output_' + mode)
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+            mode_args = parallel_args if parallel else args
+            if mode in ('serial', 'parallel'):
+                runs.append(run_program(work_dir, mode, parallel, input_dir, subsets[0], output_dir, in_first_subset, mode_args))
+            elif mode.endswith('_A'):
+                runs.append(run_program(work_dir, mode, parallel, input_dir, 'A', output_dir, n_items, mode_args))
+            else:
+                mode_args = mode_args + ['--incremental']
+                runs.append(run_program(work_dir, mode + '_cold', parallel, input_dir, 'A', output_dir, n_items, mode_args))
+                runs.append(run_program(work_dir, mode + '_warm', parallel, input_dir, 'A', output_dir, n_items, mode_args))
+                change_items(input_dir, CHANGED_FRACTION, seed + len(runs))
+                runs.append(run_program(work_dir, mode + '_changed', parallel, input_dir, 'A', output_dir, n_items, mode_args))
+
+        print("Per stage, in one process:")
+        stages_dir = os.path.join(work_dir, 'output_stages')
+        if os.path.exists(stages_dir):
+            shutil.rmtree(stages_dir)
+        stages = profile_stages(input_dir, stages_dir, metadata_mode)
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results_dict = collections.OrderedDict([
+        ('created', datetime.datetime.now().isoformat()),
+        ('host', socket.gethostname()),
+        ('python', platform.python_version()),
+        ('libyaml', ard_yaml.HAVE_LIBYAML),
+        ('cpus', executor.available_cpus()),
+        ('items', n_items),
+        ('subsets', n_subsets),
+        ('ard_metadata_bytes', sum(ard_sizes) // max(len(ard_sizes), 1)),
+        ('metadata_mode', metadata_mode),
+        ('runs', runs),
+        ('stages', stages),
+    ])
+    with open(results, 'w') as f:
+        json.dump(results_dict, f, indent=1)
+    print("Results saved to", results)
+
+    failed = [run['mode'] for run in runs if run['returncode'] != 0]
+    if failed:
+        print("*** Failed: {}".format(', '.join(failed)))
+    regressions = compare(results_dict, previous_file, tolerance) if previous_file else []
+    if failed or regressions:
+        sys.exit(1)
+
+# ------------------------------------------------------------------------------
+# Standard boilerplate to call the main() function.
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,219 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Parent documents for the items: 'output_dir/subset/catalog.json' for each subset and
+'output_dir/catalog.json' for the product, so that a STAC browser can crawl down to
+every item.
+
+Both are STAC collections, i.e. catalogs with a license and an extent:
+    - A subset catalog links to the root catalog and to each of its items.
+    - The root catalog links to every subset catalog ever written to the output_dir.
+    - Each item links to its subset catalog ('parent') and the root catalog ('root').
+
+HOW:
+    - A SubsetCatalog is fed each item as it is processed. The item's 'bbox' and
+      'datetime' are merged into a running extent, and its link is appended to a
+      temporary file in batches, so memory does not grow with the number of items.
+      The file has no name, so a killed run leaves nothing in output_dir.
+    - On close(), the catalog is written out by streaming the links from that file.
+    - Items skipped as unchanged or already written are still linked, but their
+      extent is not re-read. Instead the extent of each subset is kept in the state
+      index of the output_dir (see 'item_state.py') and merged into on every run.
+    - The root catalog is made from those per-subset extents.
+'''
+# ------------------------------------------------------------------------------
+import json
+import os
+import tempfile
+
+CATALOG = 'catalog.json'
+STAC_VERSION = '0.6.0'
+LICENSE = 'PDDL-1.0'
+LINK_BATCH = 1000 # Links held in memory before they are appended to the temporary file.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalog_extent (
+    subset  TEXT PRIMARY KEY,
+    west    REAL, south REAL, east REAL, north REAL,
+    start   TEXT, end_  TEXT
+)
+"""
+
+# ------------------------------------------------------------------------------
+# item_url:
+# URL of an item's JSON, as in its 'self' link. 'base_url' is that of its subset.
+# ------------------------------------------------------------------------------
+def item_url(base_url, item):
+    return base_url + item + "/" + item + ".json"
+
+# ------------------------------------------------------------------------------
+# Extent:
+# A bounding box and a time range, grown one item at a time.
+# ------------------------------------------------------------------------------
+class Extent(object):
+    def __init__(self, bbox=None, start=None, end=None):
+        self.bbox = list(bbox) if bbox else None
+        self.start = start
+        self.end = end
+
+    def add(self, bbox, datetime):
+        if bbox:
+            if self.bbox is None:
+                self.bbox = list(bbox)
+            else:
+                self.bbox = [min(self.bbox[0], bbox[0]), min(self.bbox[1], bbox[1]),
+                             max(self.bbox[2], bbox[2]), max(self.bbox[3], bbox[3])]
+        if datetime:
+            if not isinstance(datetime, str):
+                datetime = datetime.isoformat()
+            if self.start is None or datetime < self.start:
+                self.start = datetime
+            if self.end is None or datetime > self.end:
+                self.end = datetime
+
+    def merge(self, other):
+        self.add(other.bbox, other.start)
+        self.add(None, other.end)
+
+    def as_dict(self):
+        return {'spatial': self.bbox, 'temporal': [self.start, self.end]}
+
+# ------------------------------------------------------------------------------
+# open_extents:
+# Create the extent table in the state index connection 'conn' if needed.
+# ------------------------------------------------------------------------------
+def open_extents(conn):
+    conn.execute(_SCHEMA)
+    return conn
+
+def _load_extents(conn):
+    rows = conn.execute('SELECT subset, west, south, east, north, start, end_ FROM catalog_extent ORDER BY subset')
+    return [(row[0], Extent(row[1:5] if row[1] is not None else None, row[5], row[6])) for row in rows]
+
+def _load_extent(conn, subset):
+    row = conn.execute('SELECT west, south, east, north, start, end_ FROM catalog_extent WHERE subset = ?',
+                       (subset.strip('/'),)).fetchone()
+    if row is None:
+        return Extent()
+    return Extent(row[0:4] if row[0] is not None else None, row[4], row[5])
+
+def _save_extent(conn, subset, extent):
+    bbox = extent.bbox or [None] * 4
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO catalog_extent VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     [subset.strip('/')] + bbox + [extent.start, extent.end])
+
+# ------------------------------------------------------------------------------
+# _collection:
+# The fields of a catalog other than its links.
+# ------------------------------------------------------------------------------
+def _collection(id, description, extent):
+    return {
+        'stac_version': STAC_VERSION,
+        'id': id,
+        'description': description,
+        'license': LICENSE,
+        'extent': extent.as_dict(),
+    }
+
+# ------------------------------------------------------------------------------
+# SubsetCatalog:
+# The catalog.json of one subset, streamed to disk as its items are added.
+# 'base_url' is the root URL of the product (above the subsets).
+# ------------------------------------------------------------------------------
+class SubsetCatalog(object):
+    def __init__(self, output_store, base_url, subset, conn):
+        self.output_store = output_store
+        self.base_url = base_url
+        self.subset = subset
+        self.conn = conn
+        self.extent = _load_extent(conn, subset)
+        self.links = []
+        self.links_file = None # Made once LINK_BATCH links are held. Removed when closed, or by the OS.
+        if not os.path.exists(output_store.local_dir):
+            os.makedirs(output_store.local_dir)
+
+    def add_item(self, item, bbox=None, datetime=None):
+        self.links.append(json.dumps({'rel': 'item', 'href': item_url(self.base_url + self.subset, item)}))
+        self.extent.add(bbox, datetime)
+        if len(self.links) >= LINK_BATCH:
+            self._flush_links()
+
+    # --------------------------------------------------------------------------
+    # add_catalog:
+    # Add the items and extent of a catalog.json of the same subset written by
+    # another run, e.g. by a shard of a multi-node run (see 'work_shards.py').
+    # --------------------------------------------------------------------------
+    def add_catalog(self, doc):
+        for link in doc['links']:
+            if link['rel'] == 'item':
+                self.links.append(json.dumps(link))
+                if len(self.links) >= LINK_BATCH:
+                    self._flush_links()
+        spatial, (start, end) = doc['extent']['spatial'], doc['extent']['temporal']
+        self.extent.merge(Extent(spatial, start, end))
+
+    def _flush_links(self):
+        if self.links_file is None:
+            self.links_file = tempfile.TemporaryFile('w+', prefix='.links-', suffix='.tmp',
+                                                     dir=self.output_store.local_dir)
+        for link in self.links:
+            self.links_file.write(link + '\n')
+        self.links = []
+
+    def _all_links(self):
+        if self.links_file is not None:
+            self.links_file.seek(0)
+            for link in self.links_file:
+                yield link.rstrip('\n')
+        for link in self.links:
+            yield link
+
+    def close(self):
+        _save_extent(self.conn, self.subset, self.extent)
+
+        name = self.subset.strip('/')
+        header = _collection(name, 'Items of {}'.format(name), self.extent)
+        header['links'] = [
+            {'rel': 'self', 'href': self.base_url + self.subset + CATALOG},
+            {'rel': 'parent', 'href': self.base_url + CATALOG},
+            {'rel': 'root', 'href': self.base_url + CATALOG},
+        ]
+        head = json.dumps(header, indent=1)
+        head = head[:head.rindex(']')].rstrip() # Leave the links list open.
+
+        fd, catalog_file = tempfile.mkstemp(prefix='.catalog-', suffix='.tmp', dir=self.output_store.local_dir)
+        try:
+            with os.fdopen(fd, 'w') as out:
+                out.write(head)
+                for link in self._all_links():
+                    out.write(',\n  ' + link)
+                out.write('\n ]\n}\n')
+            self.output_store.write_file(self.subset + CATALOG, catalog_file)
+        finally:
+            if self.links_file is not None:
+                self.links_file.close()
+                self.links_file = None
+            if os.path.exists(catalog_file): # Not written.
+                os.remove(catalog_file)
+
+# ------------------------------------------------------------------------------
+# write_root_catalog:
+# Write 'output_dir/catalog.json', linking every subset catalog recorded in the
+# state index and covering their merged extent.
+# ------------------------------------------------------------------------------
+def write_root_catalog(output_store, base_url, conn):
+    extent = Extent()
+    links = [{'rel': 'self', 'href': base_url + CATALOG}, {'rel': 'root', 'href': base_url + CATALOG}]
+    for subset, subset_extent in _load_extents(conn):
+        extent.merge(subset_extent)
+        links.append({'rel': 'child', 'href': base_url + subset + '/' + CATALOG})
+
+    name = base_url.rstrip('/').rsplit('/', 1)[-1] or 'root'
+    root = _collection(name, 'DEA {} items'.format(name), extent)
+    root['links'] = links
+    output_store.write(CATALOG, json.dumps(root, indent=1))
+    output_store.flush()
@@ -0,0 +1,87 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Low-syscall discovery of the items to process, and of their STAC.json outputs.
+
+On Lustre (/g/data) every metadata call is a round trip to the MDS, so each item is
+looked at with as few of them as possible:
+    - Subsets and items are listed with 'os.scandir', which reads the entry type from
+      the directory listing itself, so non-directories are dropped without a stat.
+    - An item's two inputs are stat'ed once each. The stat data is kept in its
+      ItemRecord and nothing downstream stats them again.
+    - The output is checked with a single stat, which can be skipped altogether when
+      the output tree is known to be empty, and its directory is made with a single
+      mkdir in the common case.
+'''
+# ------------------------------------------------------------------------------
+import collections
+import os
+
+ARD_METADATA = 'ARD-METADATA.yaml'
+BOUNDS = 'bounds.geojson'
+
+# The inputs of an item, as keys relative to the root of its storage (see
+# 'storage.py'). 'stats' is (ard_mtime, ard_size, bounds_mtime, bounds_size), or None
+# if either input is missing or empty.
+ItemRecord = collections.namedtuple('ItemRecord', 'item ard_metadata_file bounds_file stats')
+
+# ------------------------------------------------------------------------------
+# list_subsets:
+# Lazily list the subset directories of input_dir, as 'subset/'.
+# ------------------------------------------------------------------------------
+def list_subsets(input_dir):
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                yield entry.name + '/'
+
+# ------------------------------------------------------------------------------
+# list_items:
+# Lazily list the item directories of a subset directory.
+# ------------------------------------------------------------------------------
+def list_items(subset_dir):
+    with os.scandir(subset_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                yield entry.name
+
+# ------------------------------------------------------------------------------
+# stat_inputs:
+# Stat ARD-METADATA.yaml and bounds.geojson.
+# Returns (ard_mtime, ard_size, bounds_mtime, bounds_size), or None if either file
+# is missing or empty.
+# ------------------------------------------------------------------------------
+def stat_inputs(ard_metadata_file, bounds_file):
+    try:
+        ard = os.stat(ard_metadata_file)
+        bounds = os.stat(bounds_file)
+    except OSError:
+        return None
+    if ard.st_size == 0 or bounds.st_size == 0:
+        return None
+    return (ard.st_mtime, ard.st_size, bounds.st_mtime, bounds.st_size)
+
+# ------------------------------------------------------------------------------
+# output_exists:
+# True if the file exists and is not empty. One stat.
+# ------------------------------------------------------------------------------
+def output_exists(path):
+    try:
+        return os.stat(path).st_size > 0
+    except OSError:
+        return False
+
+# ------------------------------------------------------------------------------
+# make_output_dir:
+# Make an item's output directory. One mkdir unless its parents are missing too.
+# ------------------------------------------------------------------------------
+def make_output_dir(path):
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        pass
+    except FileNotFoundError:
+        os.makedirs(path, exist_ok=True)
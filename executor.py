@@ -0,0 +1,179 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Worker pool used by 'parse_direct_parallel.py'.
+
+HOW:
+    - The number of workers is the number of CPUs this process may actually use: the
+      CPU affinity mask, capped by a cgroup CPU quota (v1 or v2) and by the PBS
+      allocation (NCPUS), whichever is smallest.
+    - Items are streamed through 'imap_unordered' in chunks. When the number of
+      items is known (given to map(), or 'items' has a length), the chunks are sized
+      so that every worker gets several, which keeps the workers busy to the end
+      without paying one round trip per item, and a few items are not all given to
+      one worker. Otherwise, e.g. while the items are listed, a fixed chunk size is
+      used.
+    - 'imap_unordered' feeds the pool from its own thread, which would take items
+      from 'items' as fast as they can be listed, and its results queue up until they
+      are taken. So items are only let into the pool while fewer than 'max_in_flight'
+      are in it (sent, being processed, or done but not yet taken by the caller):
+      with a generator of items, and results that are taken as they come, memory
+      stays flat however many items there are.
+    - Each worker reports how many items it processed and how long it was busy, and
+      report() prints the per-worker and overall throughput.
+'''
+# ------------------------------------------------------------------------------
+import functools
+import math
+import os
+import threading
+import time
+from multiprocessing import Pool
+
+CHUNKS_PER_WORKER = 4  # Chunks handed to each worker, so the last ones finish together.
+MAX_CHUNKSIZE = 64
+STREAM_CHUNKSIZE = 16 # Used when the number of items is not known in advance.
+IN_FLIGHT_CHUNKS = 2 * CHUNKS_PER_WORKER # Chunks per worker in the pool at a time, by default.
+
+# ------------------------------------------------------------------------------
+# available_cpus:
+# Number of CPUs this process may use.
+# ------------------------------------------------------------------------------
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = _cgroup_cpu_quota()
+    if quota:
+        cpus = min(cpus, max(1, int(math.ceil(quota))))
+
+    for var in ('PBS_NCPUS', 'NCPUS'):
+        try:
+            cpus = min(cpus, int(os.environ[var]))
+            break
+        except (KeyError, ValueError):
+            pass
+    return max(1, cpus)
+
+# ------------------------------------------------------------------------------
+# _cgroup_cpu_quota:
+# CPU quota (in CPUs) of this process' cgroup, or None if it is not limited.
+# ------------------------------------------------------------------------------
+def _cgroup_cpu_quota():
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f: # cgroup v2
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f: # cgroup v1
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+# ------------------------------------------------------------------------------
+# default_chunksize:
+# Chunk size giving each worker about CHUNKS_PER_WORKER chunks.
+# ------------------------------------------------------------------------------
+def default_chunksize(n_items, workers):
+    if n_items is None:
+        return STREAM_CHUNKSIZE
+    return max(1, min(MAX_CHUNKSIZE, n_items // (workers * CHUNKS_PER_WORKER)))
+
+# ------------------------------------------------------------------------------
+# _timed_call:
+# Run func(item) in a worker and return (pid, seconds, result).
+# ------------------------------------------------------------------------------
+def _timed_call(func, item):
+    start = time.perf_counter()
+    result = func(item)
+    return os.getpid(), time.perf_counter() - start, result
+
+# ------------------------------------------------------------------------------
+# _bounded:
+# Yield the items, each once a slot is free, until 'stopped' is set. Run by the
+# feeder thread of the pool, which it holds back.
+# ------------------------------------------------------------------------------
+def _bounded(items, slots, stopped):
+    for item in items:
+        slots.acquire()
+        if stopped.is_set():
+            return
+        yield item
+
+# ------------------------------------------------------------------------------
+# ItemExecutor:
+# A process pool that streams items to 'func' and keeps per-worker statistics.
+# The pool is started on first use. Globals read by 'func' must be set before that,
+# as the workers inherit them when they are forked.
+# ------------------------------------------------------------------------------
+class ItemExecutor(object):
+    def __init__(self, workers=None, chunksize=None, max_in_flight=None):
+        self.workers = workers or available_cpus()
+        self.chunksize = chunksize
+        self.max_in_flight = max_in_flight
+        self.pool = None
+        self.worker_stats = {} # pid: [items, busy seconds]
+        self.started = None
+
+    # --------------------------------------------------------------------------
+    # start:
+    # Fork the workers now, e.g. before the caller starts any threads.
+    # --------------------------------------------------------------------------
+    def start(self):
+        if self.pool is None:
+            self.pool = Pool(processes=self.workers)
+            self.started = time.perf_counter()
+
+    def map(self, func, items, n_items=None):
+        self.start()
+        if n_items is None and hasattr(items, '__len__'):
+            n_items = len(items)
+        chunksize = self.chunksize or default_chunksize(n_items, self.workers)
+        # A chunk is only sent once it is full, so at least one must fit.
+        max_in_flight = max(chunksize, self.max_in_flight or chunksize * self.workers * IN_FLIGHT_CHUNKS)
+        slots = threading.Semaphore(max_in_flight)
+        stopped = threading.Event()
+        try:
+            for pid, seconds, result in self.pool.imap_unordered(functools.partial(_timed_call, func),
+                                                                 _bounded(items, slots, stopped), chunksize):
+                slots.release()
+                stats = self.worker_stats.setdefault(pid, [0, 0.0])
+                stats[0] += 1
+                stats[1] += seconds
+                yield result
+        finally:
+            # Let the feeder thread finish if the caller stopped early.
+            stopped.set()
+            slots.release()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def report(self):
+        if not self.worker_stats:
+            return
+        elapsed = time.perf_counter() - self.started
+        total = 0
+        for n, (pid, (items, busy)) in enumerate(sorted(self.worker_stats.items()), 1):
+            total += items
+            print("Worker {} (pid {}): {} items, {:.1f} s busy, {:.1f} items/s".format(
+                n, pid, items, busy, items / busy if busy else 0.0))
+        print("Workers: {}; Items: {}; Elapsed: {:.1f} s; Throughput: {:.1f} items/s".format(
+            self.workers, total, elapsed, total / elapsed if elapsed else 0.0))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Spatio-temporal index of the items, written alongside their STAC.json files as
+'output_dir/items.sqlite'.
+
+It answers "which items intersect this bbox in this date range" without opening any
+STAC.json:
+    - items:      one row per (subset, item), with its id, datetime, URL and
+                  geometry (GeoJSON), and a B-tree index on datetime.
+    - items_bbox: an R-tree on the item bboxes.
+
+HOW:
+    - 'parse_direct.py' and 'parse_direct_parallel.py' add each item as it is built,
+      and replace its row when it is rebuilt, so the index is kept up to date by
+      incremental runs.
+    - For an S3 output_dir the index is kept in the local state directory (see
+      'storage.py') and a copy is uploaded at the end of each run.
+
+USAGE:
+    item_index.py output_dir/items.sqlite --bbox=149,-36,150,-35 --start=2018-05-01 --end=2018-05-31
+
+    prints the URL of every matching item, one per line. --start and --end are
+    inclusive; a date on its own stands for the whole day.
+'''
+# ------------------------------------------------------------------------------
+import click
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+INDEX_FILE = 'items.sqlite'
+BATCH_SIZE = 1000 # Items added per transaction.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id        INTEGER PRIMARY KEY,
+    subset    TEXT NOT NULL,
+    item      TEXT NOT NULL,
+    stac_id   TEXT,
+    datetime  TEXT,
+    href      TEXT,
+    geometry  TEXT,
+    UNIQUE (subset, item)
+);
+CREATE INDEX IF NOT EXISTS items_datetime ON items (datetime);
+CREATE VIRTUAL TABLE IF NOT EXISTS items_bbox USING rtree (id, west, east, south, north);
+"""
+
+# ------------------------------------------------------------------------------
+# ItemIndex:
+# The index of an output_dir, opened for update.
+# ------------------------------------------------------------------------------
+class ItemIndex(object):
+    def __init__(self, local_dir):
+        if not os.path.exists(local_dir):
+            os.makedirs(local_dir)
+        self.path = os.path.join(local_dir, INDEX_FILE)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(_SCHEMA)
+        self.pending = 0
+
+    # --------------------------------------------------------------------------
+    # add:
+    # Add an item, or replace its row if it is already in the index.
+    # --------------------------------------------------------------------------
+    def add(self, subset, item, stac_id, bbox, datetime, href, geometry):
+        subset = subset.strip('/')
+        if datetime is not None and not isinstance(datetime, str):
+            datetime = datetime.isoformat()
+        geometry = json.dumps(geometry) if geometry is not None else None
+        row = self.conn.execute('SELECT id FROM items WHERE subset = ? AND item = ?', (subset, item)).fetchone()
+        if row is None:
+            rowid = self.conn.execute(
+                'INSERT INTO items (subset, item, stac_id, datetime, href, geometry) VALUES (?, ?, ?, ?, ?, ?)',
+                (subset, item, stac_id, datetime, href, geometry)).lastrowid
+        else:
+            rowid = row[0]
+            self.conn.execute('UPDATE items SET stac_id = ?, datetime = ?, href = ?, geometry = ? WHERE id = ?',
+                              (stac_id, datetime, href, geometry, rowid))
+        west, south, east, north = bbox
+        self.conn.execute('INSERT OR REPLACE INTO items_bbox VALUES (?, ?, ?, ?, ?)',
+                          (rowid, min(west, east), max(west, east), min(south, north), max(south, north)))
+        self.pending += 1
+        if self.pending >= BATCH_SIZE:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    # --------------------------------------------------------------------------
+    # close:
+    # Commit, and upload a copy of the index if the output_dir is not local.
+    # --------------------------------------------------------------------------
+    def close(self, output_store):
+        self.commit()
+        self.conn.execute('PRAGMA journal_mode=DELETE') # A single file again, for its readers.
+        self.conn.close()
+        if os.path.abspath(output_store.local_dir) != os.path.abspath(getattr(output_store, 'root', '')):
+            fd, copy = tempfile.mkstemp(prefix='.index-', suffix='.tmp', dir=output_store.local_dir)
+            os.close(fd)
+            shutil.copyfile(self.path, copy)
+            output_store.write_file(INDEX_FILE, copy)
+
+# ------------------------------------------------------------------------------
+# query:
+# Yield (subset, item, stac_id, datetime, href) of the items whose bbox intersects
+# 'bbox' (west, south, east, north) and whose datetime is within [start, end].
+# Any of the three may be None.
+# ------------------------------------------------------------------------------
+def query(index_file, bbox=None, start=None, end=None):
+    sql = 'SELECT i.subset, i.item, i.stac_id, i.datetime, i.href FROM items i'
+    where, params = [], []
+    if bbox is not None:
+        west, south, east, north = bbox
+        sql += ' JOIN items_bbox b ON b.id = i.id'
+        where.append('b.west <= ? AND b.east >= ? AND b.south <= ? AND b.north >= ?')
+        params += [east, west, north, south]
+    if start:
+        where.append('i.datetime >= ?')
+        params.append(start)
+    if end:
+        if 'T' not in end:
+            end += 'T\uffff' # The whole day.
+        where.append('i.datetime <= ?')
+        params.append(end)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY i.datetime'
+
+    conn = sqlite3.connect('file:{}?mode=ro'.format(index_file), uri=True)
+    try:
+        for row in conn.execute(sql, params):
+            yield row
+    finally:
+        conn.close()
+
+# ------------------------------------------------------------------------------
+# main:
+# Print the URLs of the items intersecting a bbox in a date range.
+# ------------------------------------------------------------------------------
+@click.command(name='item_index')
+@click.argument('index_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--bbox', type=str, default=None, help='west,south,east,north e.g. 149,-36,150,-35')
+@click.option('--start', type=str, default=None, help='Earliest datetime, e.g. 2018-05-01 or 2018-05-01T10:00:00')
+@click.option('--end', type=str, default=None, help='Latest datetime, e.g. 2018-05-31')
+def main(index_file,bbox,start,end):
+    if bbox:
+        try:
+            bbox = [float(value) for value in bbox.split(',')]
+        except ValueError:
+            bbox = []
+        if len(bbox) != 4:
+            raise click.BadParameter('Give it as west,south,east,north', param_hint='--bbox')
+    for subset, item, stac_id, datetime, href in query(index_file, bbox, start, end):
+        print(href)
+
+# ------------------------------------------------------------------------------
+# Standard boilerplate to call the main() function.
+if __name__ == '__main__':
+  main()
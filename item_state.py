@@ -0,0 +1,136 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Persistent item-state index for the incremental run mode of 'parse_direct.py' and
+'parse_direct_parallel.py'.
+
+HOW:
+    - One SQLite file, 'output_dir/.stac_state.sqlite', is kept per output_dir.
+    - For each item it records the mtime, size and SHA-1 of ARD-METADATA.yaml and
+      bounds.geojson at the time its STAC.json was last written.
+    - On the next run an item whose input mtimes and sizes are unchanged is skipped
+      after two stat calls, without opening any file.
+    - If the stat data differs the inputs are hashed. An item whose content is the
+      same (e.g. a 'touch' or a re-copy) only has its stat data refreshed; any other
+      item is rebuilt and its STAC.json overwritten.
+'''
+# ------------------------------------------------------------------------------
+import hashlib
+import os
+import sqlite3
+
+STATE_FILE = '.stac_state.sqlite'
+BATCH_SIZE = 1000 # Items recorded per transaction, so that a killed run keeps most of its progress.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS item_state (
+    subset        TEXT NOT NULL,
+    item          TEXT NOT NULL,
+    ard_mtime     REAL NOT NULL,
+    ard_size      INTEGER NOT NULL,
+    ard_sha1      TEXT NOT NULL,
+    bounds_mtime  REAL NOT NULL,
+    bounds_size   INTEGER NOT NULL,
+    bounds_sha1   TEXT NOT NULL,
+    PRIMARY KEY (subset, item)
+)
+"""
+
+# ------------------------------------------------------------------------------
+# open_state:
+# Open (creating if needed) the state index of an output_dir.
+# ------------------------------------------------------------------------------
+def open_state(output_dir):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    conn = sqlite3.connect(os.path.join(output_dir, STATE_FILE))
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(_SCHEMA)
+    return conn
+
+# ------------------------------------------------------------------------------
+# load_subset:
+# Read the recorded state of every item of a subset in one query.
+# Returns {item: (ard_mtime, ard_size, ard_sha1, bounds_mtime, bounds_size, bounds_sha1)}
+# ------------------------------------------------------------------------------
+def load_subset(conn, subset):
+    rows = conn.execute(
+        'SELECT item, ard_mtime, ard_size, ard_sha1, bounds_mtime, bounds_size, bounds_sha1 '
+        'FROM item_state WHERE subset = ?', (subset.strip('/'),))
+    return {row[0]: row[1:] for row in rows}
+
+# ------------------------------------------------------------------------------
+# load_subsets:
+# As load_subset(), for several subsets at once. Keys are (subset, item).
+# ------------------------------------------------------------------------------
+def load_subsets(conn, subsets):
+    state = {}
+    for subset in subsets:
+        for item, row in load_subset(conn, subset).items():
+            state[(subset, item)] = row
+    return state
+
+# ------------------------------------------------------------------------------
+# StateReader:
+# The recorded state of items, looked up one at a time, for runs with too many
+# items to load the state of. Used like the dict of load_subsets(): get((subset, item)).
+# Each process opens its own read-only connection on first use, so a reader can be
+# made before the workers are forked. With WAL, the parent records items meanwhile.
+# ------------------------------------------------------------------------------
+class StateReader(object):
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, STATE_FILE)
+        self.conn = None
+        self.pid = None
+
+    def get(self, key):
+        if self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path)
+            self.pid = os.getpid()
+        subset, item = key
+        return self.conn.execute(
+            'SELECT ard_mtime, ard_size, ard_sha1, bounds_mtime, bounds_size, bounds_sha1 '
+            'FROM item_state WHERE subset = ? AND item = ?', (subset.strip('/'), item)).fetchone()
+
+# ------------------------------------------------------------------------------
+# unchanged:
+# True if the stat data of an item, from its ItemRecord, is the one recorded. The
+# item can then be skipped without reading its inputs.
+# ------------------------------------------------------------------------------
+def unchanged(previous, stats):
+    if previous is None:
+        return False
+    ard_mtime, ard_size, bounds_mtime, bounds_size = stats
+    return (ard_mtime, ard_size, bounds_mtime, bounds_size) == (previous[0], previous[1], previous[3], previous[4])
+
+# ------------------------------------------------------------------------------
+# make_record:
+# The row to store for an item, from its stat data and the content of its inputs.
+# ------------------------------------------------------------------------------
+def make_record(stats, ard_data, bounds_data):
+    ard_mtime, ard_size, bounds_mtime, bounds_size = stats
+    return (ard_mtime, ard_size, hashlib.sha1(ard_data).hexdigest(),
+            bounds_mtime, bounds_size, hashlib.sha1(bounds_data).hexdigest())
+
+# ------------------------------------------------------------------------------
+# same_content:
+# True if the inputs of an item have the recorded content, i.e. only their stat
+# data changed (e.g. a 'touch' or a re-copy) and the item need not be rebuilt.
+# ------------------------------------------------------------------------------
+def same_content(previous, record):
+    return previous is not None and (previous[2], previous[5]) == (record[2], record[5])
+
+# ------------------------------------------------------------------------------
+# record_items:
+# Store the rows made by make_record() for a batch of items in one transaction.
+# 'records' is an iterable of (subset, item, record).
+# ------------------------------------------------------------------------------
+def record_items(conn, records):
+    with conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO item_state VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((subset.strip('/'), item) + tuple(record) for subset, item, record in records))
@@ -0,0 +1,147 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+The STAC item of a subset, compiled once so that each item only fills in its values.
+
+Everything but a handful of values is the same for all the items of a subset: the
+URL prefixes, the fixed properties, the parent and root links, and the asset entries
+of the bands. An ItemTemplate holds those, and:
+    - values(item, ard, geodata) takes the values of an item from its metadata, in
+      one pass over its bands.
+    - to_dict(values) makes the item dict, as written to STAC.json.
+    - dumps(values, output_format) writes the item straight to a string, identical
+      to json.dumps() of its dict, without making the dict.
+
+HOW (dumps):
+    - For each band schema (the names of the bands, in order), a skeleton of the item
+      with a placeholder for each value is serialised once, and cut into the constant
+      fragments between the placeholders.
+    - An item is then the fragments joined with its values, each encoded with
+      json.dumps(). Values that span several lines when indented (bbox, geometry) are
+      indented to the depth of their placeholder.
+'''
+# ------------------------------------------------------------------------------
+import collections
+import json
+import re
+
+import catalog
+import shards
+
+PROVIDER = 'GA'
+LICENSE = 'PDDL-1.0'
+
+# The values of one item. 'schema' is the tuple of its band names, and 'band_paths'
+# the path of each, in the same order.
+ItemValues = collections.namedtuple('ItemValues', 'item id bbox geometry datetime schema band_paths')
+
+_PLACEHOLDER = re.compile(r'"\\u0000(\w+)\\u0000"')
+
+def _placeholder(name):
+    return '\x00' + name + '\x00'
+
+# ------------------------------------------------------------------------------
+# ItemTemplate:
+# The items of a subset. 'base_url' is the URL of the subset and 'root_url', if
+# given, the URL above the subsets, for the 'parent' and 'root' links.
+# ------------------------------------------------------------------------------
+class ItemTemplate(object):
+    def __init__(self, base_url, root_url=None):
+        self.base_url = base_url
+        self.links = []
+        if root_url:
+            self.links = [{'rel': 'parent', 'href': base_url + catalog.CATALOG},
+                          {'rel': 'root', 'href': root_url + catalog.CATALOG}]
+        self.assets = {} # schema: [(band, eo:band number)]
+        self.compiled = {} # (schema, output_format): (fragments, names, depths)
+
+    def values(self, item, ard, geodata):
+        extent = ard['extent']
+        ll, ur = extent['coord']['ll'], extent['coord']['ur']
+        bands = ard['image']['bands']
+        return ItemValues(item, ard['id'], [ll['lon'], ll['lat'], ur['lon'], ur['lat']],
+                          geodata['features'][0]['geometry'], extent['center_dt'],
+                          tuple(bands), [band['path'] for band in bands.values()])
+
+    def href(self, item):
+        return catalog.item_url(self.base_url, item)
+
+    def _assets(self, schema):
+        if schema not in self.assets:
+            self.assets[schema] = [(key, j) for j, key in enumerate(schema, 1)]
+        return self.assets[schema]
+
+    # --------------------------------------------------------------------------
+    # to_dict:
+    # The dict of an item.
+    # --------------------------------------------------------------------------
+    def to_dict(self, values):
+        item = values.item
+        assets = {
+            'map': {'href': self.base_url + item + '/map.html', "required": 'true', "type": "html"},
+            'metadata': {'href': self.base_url + item + "/ARD-METADATA.yaml", "required": 'true', "type": "yaml"},
+        }
+        for (key, j), path in zip(self._assets(values.schema), values.band_paths):
+            assets[key] = {'href': path, "required": 'true', "type": "GeoTIFF", "eo:band":[j]}
+        return {
+            'id': values.id,
+            'type': 'Feature',
+            'bbox': values.bbox,
+            'geometry': values.geometry,
+            'properties': {'datetime': values.datetime, 'provider': PROVIDER, 'license': LICENSE},
+            'links': [{'rel': 'self', 'href': self.href(item)}] + [dict(link) for link in self.links],
+            'assets': assets,
+        }
+
+    # --------------------------------------------------------------------------
+    # _compile:
+    # The fragments of the serialised skeleton of a band schema, with the names (or
+    # band positions) and indentation of the placeholders between them.
+    # --------------------------------------------------------------------------
+    def _compile(self, schema, output_format):
+        skeleton = self.to_dict(ItemValues(
+            _placeholder('item'), _placeholder('id'), _placeholder('bbox'), _placeholder('geometry'),
+            _placeholder('datetime'), schema, [_placeholder('band_{}'.format(n)) for n in range(len(schema))]))
+        skeleton['links'][0]['href'] = _placeholder('self')
+        skeleton['assets']['map']['href'] = _placeholder('map')
+        skeleton['assets']['metadata']['href'] = _placeholder('metadata')
+        parts = _PLACEHOLDER.split(shards.dumps(skeleton, output_format))
+        fragments = parts[0::2]
+        names = [int(name[5:]) if name.startswith('band_') else name for name in parts[1::2]] # Bands by position.
+        depths = []
+        for fragment in fragments[:-1]:
+            line = fragment.rsplit('\n', 1)[-1]
+            depths.append(len(line) - len(line.lstrip(' ')))
+        return fragments, names, depths
+
+    # --------------------------------------------------------------------------
+    # dumps:
+    # An item as a string in the given output format (see 'shards.py'), the same as
+    # shards.dumps(to_dict(values), output_format).
+    # --------------------------------------------------------------------------
+    def dumps(self, values, output_format):
+        key = (values.schema, output_format)
+        if key not in self.compiled:
+            self.compiled[key] = self._compile(values.schema, output_format)
+        fragments, names, depths = self.compiled[key]
+        item = values.item
+        fields = {
+            'id': values.id, 'bbox': values.bbox, 'geometry': values.geometry, 'datetime': values.datetime,
+            'self': self.href(item), 'map': self.base_url + item + '/map.html',
+            'metadata': self.base_url + item + "/ARD-METADATA.yaml",
+        }
+        out = [fragments[0]]
+        for name, depth, fragment in zip(names, depths, fragments[1:]):
+            value = values.band_paths[name] if isinstance(name, int) else fields[name]
+            if isinstance(value, (list, dict)):
+                text = shards.dumps(value, output_format)
+                if output_format == 'json':
+                    text = text.replace('\n', '\n' + ' ' * depth)
+            else:
+                text = json.dumps(value)
+            out.append(text)
+            out.append(fragment)
+        return ''.join(out)
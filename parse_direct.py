@@ -26,6 +26,15 @@ import click
 import os
 import yaml
 import json
+import item_state
+import ard_yaml
+import storage
+import catalog
+import item_index
+import run_stats
+import shards
+import run_journal
+import stac_items
 
 # ------------------------------------------------------------------------------
 # _default_config:
@@ -50,85 +59,191 @@ def _default_config(ctx, param, value):
          return value
      ctx.fail('STAC_CONFIG_FILE not provided.')
 
-# ------------------------------------------------------------------------------
-# create_item_dict:
-# Create a dictionary structure of the required values. This will be written out 
-# as the 'output_dir/subset/item/STAC.json'
-# These output files are STAC compliant and must be viewable with any STAC browser.
-# ------------------------------------------------------------------------------
-def create_item_dict(item,ard,geodata,base_url,item_dict):
-    item_dict['id'] = ard['id']
-    item_dict['type'] = 'Feature'
-    
-    item_dict['bbox'] = [ ard['extent']['coord']['ll']['lon'], ard['extent']['coord']['ll']['lat'], 
-    ard['extent']['coord']['ur']['lon'], ard['extent']['coord']['ur']['lat'] ]
-
-    item_dict['geometry'] = geodata['features'][0]['geometry']
-
-    item_dict['properties'] = {}
-    item_dict['properties']['datetime'] = ard['extent']['center_dt']
-    item_dict['properties']['provider'] = 'GA'
-    item_dict['properties']['license'] = 'PDDL-1.0'
-
-    item_dict['links'] = [0]
-    item_json_url = base_url + item + "/" + item + ".json"
-    item_dict['links'][0] = {'rel': 'self', 'href': item_json_url}
-
-    item_json_map_url = base_url + item + '/map.html'
-
-    item_dict['assets'] = {}
-    item_dict['assets']['map'] = {'href': item_json_map_url, "required": 'true', "type": "html"}
-
-    ard_metadata_url = base_url + item + "/ARD-METADATA.yaml"
-    item_dict['assets']['metadata'] = {'href': ard_metadata_url, "required": 'true', "type": "yaml"}
-
-    j = 0
-    bands = ard['image']['bands']
-    for key in bands:
-        j += 1
-        path = ard['image']['bands'][key]['path']
-        item_dict['assets'][key] = {'href': path, "required": 'true', "type": "GeoTIFF", "eo:band":[j]}
-
 # ------------------------------------------------------------------------------
 # create_jsons:
-# Iterate through all items and create a JSON file for each.
+# Iterate through all items of a subset and create a JSON file for each.
+# Inputs are read from 'input_store' and outputs written to 'output_store'. Each is
+# a local directory or an S3 prefix. See 'storage.py'.
 # Will skip an item if either the 'ARD-METADATA.yaml' or 'bounds.geojson' is missing or empty.
+# In incremental mode an item is rebuilt, and its STAC.json overwritten, only if its
+# inputs changed since the last incremental run. See 'item_state.py'.
+# With check_output=False the output tree is assumed to be empty and existing
+# STAC.json files are not looked for.
+# With a root_url (the base_url above the subsets), the subset's catalog.json is
+# written too, and the items link to it. See 'catalog.py'.
+# Built items are added to 'index', an ItemIndex, if given. See 'item_index.py'.
+# Each item is timed stage by stage into 'stats', a RunStats, if given. See 'run_stats.py'.
+# With output_format 'ndjson' or 'ndjson.gz' the items are written to a shard of the
+# subset instead of their own STAC.json. See 'shards.py'.
+# The items are made by an ItemBuilder, from the ItemTemplate of the subset, and with
+# direct_serialise written straight from it, without making their dicts. See
+# 'stac_items.py' and 'item_template.py'.
+# The items done or failed are entered in 'journal', a Journal, if given. With resume
+# the items in it are not looked at again, and with retry_failed only its failed items
+# are processed, with retries. Nothing is written for an item that is skipped or fails.
+# See 'run_journal.py'.
 # ------------------------------------------------------------------------------
-def create_jsons(input_dir,base_url,output_dir,subset):
-    items_dirs = os.listdir(input_dir)
-    i = len(items_dirs)
-    for item in items_dirs:
+def create_jsons(input_store,base_url,output_store,subset,incremental=False,metadata_mode='events',check_output=True,root_url=None,index=None,stats=None,output_format='json',direct_serialise=False,journal=None,resume=False,retry_failed=False):
+    i = 0
+    if incremental or root_url:
+        state_conn = item_state.open_state(output_store.local_dir)
+    if incremental:
+        state = item_state.load_subset(state_conn, subset)
+        records = []
+    if root_url:
+        subset_catalog = catalog.SubsetCatalog(output_store, root_url, subset, catalog.open_extents(state_conn))
+        if retry_failed and output_store.exists(subset + catalog.CATALOG): # Only some of its items are processed.
+            subset_catalog.add_catalog(json.loads(output_store.read_many([subset + catalog.CATALOG])[0]))
+    if resume:
+        previous_run = run_journal.JournalReader(output_store.local_dir)
+    # base_url is that of the subset: the URL of the product followed by the subset.
+    builder = stac_items.ItemBuilder(base_url[:len(base_url) - len(subset)], root_url is not None, metadata_mode)
+    template = builder.template(subset)
+    shard = None
+    if output_format in shards.SHARDED:
+        shard = shards.ShardWriter(output_store, subset, output_format)
+    if retry_failed:
+        items = (item for failed_subset, item in run_journal.failed_items(output_store.local_dir, [subset]))
+    else:
+        items = input_store.list_items(subset)
+    if stats:
+        items = stats.timed_iter('list', items)
+    failures = []
+    items = run_journal.with_retries(items, failures, run_journal.RETRY_ATTEMPTS if retry_failed else 0)
+    for item in items:
+        if ((journal and len(journal.entries) >= run_journal.BATCH_SIZE) or
+                (incremental and not shard and len(records) >= item_state.BATCH_SIZE)):
+            output_store.flush() # Record only the items whose output is written.
+            if index:
+                index.commit()
+            if incremental and not shard: # Shards are written at the end.
+                item_state.record_items(state_conn, records)
+                records = []
+            if journal:
+                journal.commit()
         item_dict = {} # Blank out the array for each item. Not really necessary!
-        item_dir = os.path.join(input_dir,item)
-        ard_metadata_file = item_dir + '/ARD-METADATA.yaml'
-        bounds_file = item_dir + '/bounds.geojson'
+        record = None
+        built = False
+        timings = run_stats.ItemTimings(subset, item, stats is not None)
+        if resume:
+            entry = previous_run.get((subset, item))
+            if entry is not None:
+                status, bbox, datetime = entry
+                if root_url and status == run_journal.DONE:
+                    subset_catalog.add_item(item, bbox, datetime)
+                if stats:
+                    stats.add(timings.done('resumed'))
+                continue
+        with timings.stage('stat'):
+            item_record = input_store.item_record(subset, item)
 
-        if (os.path.exists(ard_metadata_file) and os.path.getsize(ard_metadata_file) > 0) and (os.path.exists(bounds_file) and os.path.getsize(bounds_file) > 0):
+        if item_record.stats:
+            if incremental:
+                previous = state.get(item)
+                if item_state.unchanged(previous, item_record.stats) and (not shard or shard.has(item)):
+                    if root_url:
+                        subset_catalog.add_item(item)
+                    if journal:
+                        journal.done(subset, item)
+                    if stats:
+                        stats.add(timings.done('unchanged'))
+                    continue
             try:
-                ard_metadata = yaml.load(open(ard_metadata_file))
-                with open(bounds_file) as f:
-                    geodata = json.load(f)
-                    create_item_dict(item,ard_metadata,geodata,base_url,item_dict)
-            except:
-                print("*** Unknown error in loading the data.", item)
-                pass
+                with timings.stage('read'):
+                    ard_data, bounds_data = input_store.read_many([item_record.ard_metadata_file, item_record.bounds_file])
+                if incremental:
+                    with timings.stage('hash'):
+                        record = item_state.make_record(item_record.stats, ard_data, bounds_data)
+                    if item_state.same_content(previous, record) and (not shard or shard.has(item)):
+                        records.append((subset, item, record)) # Same content, new stat data.
+                        if root_url:
+                            subset_catalog.add_item(item)
+                        if journal:
+                            journal.done(subset, item)
+                        if stats:
+                            stats.add(timings.done('same_content'))
+                        continue
+                values = builder.values(subset, item, ard_data, bounds_data, timings)
+                if not direct_serialise:
+                    with timings.stage('build'):
+                        item_dict = builder.to_dict(subset, values)
+                built = True
+            except Exception as e:
+                print("*** Unknown error in loading the data.", item, repr(e))
+                timings.failed(e)
+                timings.done()
+                failures.append(item)
+                if journal:
+                    journal.failed(subset, item, repr(e))
         else:
             print("*** No valid ARD-METADATA.yaml and/or bounds.geojson: SKIPPING ***:", item)
+            timings.done('invalid')
 
-        # Write out the JSON files.
-        item_output_dir = output_dir + subset + item
-        if not os.path.exists(item_output_dir):
-            os.makedirs(item_output_dir)
-        item_json_file = item_output_dir + "/" + "STAC.json"
+        if built and shard:
+            # Add the item to the shard, unless it is there already and has not been rebuilt.
+            if not ((not record) and check_output and shard.has(item)):
+                with timings.stage('serialise'):
+                    data = builder.dumps(subset, values, output_format) if direct_serialise else shards.dumps(item_dict, output_format)
+                with timings.stage('write'):
+                    shard.add(item, data)
+                i += 1
+                print("{}. {} in {}".format(i, item, output_store.url(shard.key)))
+                timings.done('written')
+                if record:
+                    records.append((subset, item, record)) # Recorded once the shard is written.
+            else:
+                timings.done('exists')
+        elif built:
+            # Write out the JSON files.
+            item_json_file = subset + item + "/" + "STAC.json"
 
-        # Write out only if the file does not exist.
-        if (os.path.exists(item_json_file) and os.path.getsize(item_json_file) > 0):
-            print("*** File exits. Not overwriting:", item_json_file)
-        else:
-            with open(item_json_file, 'w') as file:
-                 file.write(json.dumps(item_dict,indent=1)) 
-                 print("{}. {}".format(i, item_json_file)) 
-                 i -= 1
+            # Write out only if the file does not exist, unless the item has been rebuilt.
+            with timings.stage('exists'):
+                exists = (not record) and check_output and output_store.exists(item_json_file)
+            if exists:
+                print("*** File exits. Not overwriting:", output_store.url(item_json_file))
+                timings.done('exists')
+            else:
+                with timings.stage('serialise'):
+                    if direct_serialise:
+                        data = builder.dumps(subset, values, output_format)
+                    else:
+                        data = shards.dumps(item_dict, output_format)
+                with timings.stage('write'):
+                    output_store.write(item_json_file, data)
+                i += 1
+                print("{}. {}".format(i, output_store.url(item_json_file))) 
+                timings.done('written')
+                if record:
+                    records.append((subset, item, record))
+        if journal and built:
+            # Items in a shard are done once it is written, at the end.
+            journal.done(subset, item, values.bbox, values.datetime, run_journal.WRITTEN if shard else run_journal.DONE)
+        if root_url and built:
+            subset_catalog.add_item(item, values.bbox, values.datetime)
+        if index and built:
+            index.add(subset, item, values.id, values.bbox, values.datetime, template.href(item), values.geometry)
+        if stats:
+            stats.add(timings)
+
+    output_store.flush()
+    if index:
+        index.commit()
+    if incremental and not shard:
+        item_state.record_items(state_conn, records)
+        records = []
+    if journal:
+        journal.commit()
+    if shard:
+        shard.close()
+        if journal:
+            journal.release(subset)
+    if root_url:
+        subset_catalog.close()
+    if incremental:
+        item_state.record_items(state_conn, records)
+    if incremental or root_url:
+        state_conn.close()
 
 # ------------------------------------------------------------------------------
 # usage:
@@ -146,6 +261,26 @@ Usage:\n\
     Output files (output_dir/subset/item/STAC.json) will be created for each item.\n\
 \n\
     Existing files will not be overwritten.\n\
+\n\
+    With --output_format=minified they are written without whitespace, and with\n\
+    --output_format=ndjson or ndjson.gz all the items of a subset are written to one\n\
+    shard (output_dir/subset/items.ndjson[.gz]) with a byte-offset index.\n\
+\n\
+    A catalog.json is also written for each subset (output_dir/subset/catalog.json)\n\
+    and for the whole product (output_dir/catalog.json), unless --no_catalogs is given.\n\
+\n\
+    The items are indexed by bbox and datetime in output_dir/items.sqlite, unless\n\
+    --no_index is given. Query it with item_index.py.\n\
+\n\
+    With --report=file.json (and/or --prometheus=file.prom), each stage of each item\n\
+    is timed and a report of the run, with its errors and slowest items, is written.\n\
+\n\
+    With --incremental, only the items whose ARD-METADATA.yaml or bounds.geojson\n\
+    changed since the last incremental run are rebuilt, and their files overwritten.\n\
+\n\
+    The items done or failed are entered in a journal (output_dir/.stac_journal.sqlite).\n\
+    With --resume, a run that was killed continues where it stopped, and with\n\
+    --retry_failed, only the items that failed are processed again, with retries.\n\
 \n\
 ".format(this_program,this_program))
 
@@ -160,13 +295,27 @@ Usage:\n\
 @click.option('--input_dir', type=str, help='Full path of the directory where the subsets are. e.g. /g/data/dz56/datacube/002/S2_MSI_ARD/packaged',default='')
 @click.option('--subset', type=str, help='Date, tile_no, etc. that lists the items. e.g. 2018-06-29, 05S105E-10S110E, etc. ',default='')
 @click.option('--output_dir', type=str, help='Relative or full path of the output directory where the STAC.json will be written under "subset/item/"',default='')
-def main(stac_config_file,base_url,input_dir,subset,output_dir,info):
+@click.option('--incremental', is_flag=True, help='Rebuild only the items whose inputs changed since the last incremental run.')
+@click.option('--metadata_mode', type=click.Choice(ard_yaml.MODES), default='events', help='How ARD-METADATA.yaml is read: only the required values (events) or the whole document (full).')
+@click.option('--empty_output', is_flag=True, help='The output tree is known to be empty: do not look for existing STAC.json files.')
+@click.option('--s3_endpoint', type=str, default=None, help='Endpoint URL of an S3-compatible store, when input_dir or output_dir is an s3:// URL.')
+@click.option('--s3_concurrency', type=int, default=storage.DEFAULT_CONCURRENCY, help='Maximum concurrent S3 requests.')
+@click.option('--no_catalogs', is_flag=True, help='Do not write the catalog.json files, nor link the items to them.')
+@click.option('--no_index', is_flag=True, help='Do not index the items in output_dir/items.sqlite.')
+@click.option('--report', type=str, default=None, help='Time each stage and write a JSON report of the run to this file.')
+@click.option('--prometheus', type=str, default=None, help='Time each stage and write the report as Prometheus metrics to this file.')
+@click.option('--output_format', type=click.Choice(shards.FORMATS), default='json', help='Indented (json) or minified STAC.json per item, or one ndjson(.gz) shard per subset.')
+@click.option('--direct_serialise', is_flag=True, help='Write the items straight from the template of their subset, without making their dicts.')
+@click.option('--resume', is_flag=True, help='Continue the previous run: skip the items in its journal, done or failed.')
+@click.option('--retry_failed', is_flag=True, help='Process only the items that failed in the previous run, retrying each with backoff.')
+def main(stac_config_file,base_url,input_dir,subset,output_dir,info,incremental,metadata_mode,empty_output,s3_endpoint,s3_concurrency,no_catalogs,no_index,report,prometheus,output_format,direct_serialise,resume,retry_failed):
+    if resume and retry_failed:
+        raise click.UsageError('--resume and --retry_failed cannot be used together.')
     if (info): usage()
     else:
         if ((not base_url) or (not input_dir) or (not subset) or (not output_dir)):  # Specify all or none in commandline. If any is missing, it will use the config file.
-            config = yaml.load(open(stac_config_file))
+            config = yaml.safe_load(open(stac_config_file))
             base_url = config['base_url']
-            base_url = os.path.join(base_url, '')
             
             input_dir = config['input_dir']
     
@@ -175,33 +324,39 @@ def main(stac_config_file,base_url,input_dir,subset,output_dir,info):
         
             output_dir = config['output_dir']
 
-        output_dir = os.path.join(output_dir, '')
-        input_dir = os.path.join(input_dir, '')
+        base_url = os.path.join(base_url, '')
+        # input_dir and output_dir may also be s3://bucket/prefix URLs.
+        input_store = storage.open_storage(input_dir, s3_endpoint, s3_concurrency)
+        output_store = storage.open_storage(output_dir, s3_endpoint, s3_concurrency)
         # Specify a subset as 2018-06-30 for L2, or as 05S105E-10S110E for S2_MSI_ARD. 
         # Option 'A' is suitable for S2_MSI_ARD where multiple tiles are involved
-        if(subset is not 'A'):
-            subset = os.path.join(subset, '')
-    
-            base_url = base_url + subset
-            input_dir = input_dir + subset
-            
-            # Iterate through all items abd create a JSON file for each.
-            create_jsons(input_dir,base_url,output_dir,subset)
+        if(subset != 'A'):
+            subsets = [os.path.join(subset, '')]
         else:
-            subsets = os.listdir(input_dir)
-            for subset in subsets:
-                subset = os.path.join(subset, '')
-        
-                base_url = base_url + subset
-                input_dir = input_dir + subset
-                
-                output_subset_dir = output_dir + subset
-                if not os.path.exists(output_subset_dir):
-                    os.makedirs(output_subset_dir)
-
-                # Iterate through all items abd create a JSON file for each.
-                create_jsons(input_dir,base_url,output_dir,subset)
-#                break # Activate for limiting the iteration to just one subset. 
+            subsets = list(input_store.list_subsets())
+
+        index = None if no_index else item_index.ItemIndex(output_store.local_dir)
+        stats = run_stats.RunStats('parse_direct') if (report or prometheus) else None
+        journal = run_journal.Journal(output_store.local_dir, new=not (resume or retry_failed))
+        if output_format in shards.SHARDED:
+            shards.remove_temp_files(output_store) # Left by a killed run.
+        for subset in subsets:
+            # Iterate through all items and create a JSON file for each.
+            create_jsons(input_store,base_url + subset,output_store,subset,incremental,metadata_mode,not empty_output,
+                         None if no_catalogs else base_url,index,stats,output_format,direct_serialise,
+                         journal,resume,retry_failed)
+#            break # Activate for limiting the iteration to just one subset. 
+
+        # The root catalog.json links every subset catalog written so far.
+        if not no_catalogs:
+            state_conn = item_state.open_state(output_store.local_dir)
+            catalog.write_root_catalog(output_store, base_url, catalog.open_extents(state_conn))
+            state_conn.close()
+        if index:
+            index.close(output_store)
+        journal.close()
+        if stats:
+            stats.write(report, prometheus)
 
 # ------------------------------------------------------------------------------
 # Standard boilerplate to call the main() function.
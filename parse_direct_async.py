@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+This program creates STAC catalog JSONs for the GeoTIFFs in the DEA Data Staging area,
+as 'parse_direct_parallel.py' does, with few processes.
+
+On /g/data most of the time of an item is spent waiting for Lustre: a stat and a read
+of each of its two small inputs, a stat of its output and a write. The parallel
+program hides that with one process per CPU, each waiting on one item at a time.
+This one keeps hundreds of items in flight from a single event loop, and only uses
+a few processes for the parsing, so it gets close to the same throughput on a
+handful of cores and can be run from cron on a shared server.
+
+HOW:
+    - An asyncio event loop streams the items from the listing through a bounded
+      queue to --io_concurrency item tasks, so memory does not grow with the number
+      of items and the listing is never far ahead of the processing.
+    - The blocking calls of the storage (stat, read, output check, write; see
+      'storage.py') run in a thread pool of --io_concurrency threads. Only the
+      calling thread waits on each of them, not the loop.
+    - Parsing ARD-METADATA.yaml and bounds.geojson and serialising the item run in a
+      process pool of --cores processes (by default the CPUs available to the job,
+      at most MAX_CORES), or in the loop itself with --cores=0.
+    - As in the parallel program, only the event loop writes the state index, the
+      item index, the catalogs, the ndjson shards and the journal of the run (see
+      'run_journal.py'). An item is recorded in the state index, and entered in the
+      journal as done, only once its output is written.
+    - With --retry_failed an item that fails again waits for its retry in the loop,
+      without holding a thread.
+
+PROGRAM FLOW:
+1. Takes the base_url, input_dir, subset and output_dir specified in a YAML file or on commandline.
+
+2. Takes the following files from input_dir/subset/item/:
+    - bounds.geojson
+    - ARD-METADATA.yaml
+
+3. Parses the above files to create the 'output_dir/subset/item/STAC.json'
+'''
+# ------------------------------------------------------------------------------
+import asyncio
+import click
+import concurrent.futures
+import itertools
+import json
+import os
+import time
+import yaml
+
+import ard_yaml
+import catalog
+import executor
+import item_index
+import item_state
+import run_journal
+import run_stats
+import shards
+import stac_items
+import storage
+
+IO_CONCURRENCY = 128 # Items in flight, and threads for their I/O.
+MAX_CORES = 4 # Default size of the process pool.
+LIST_BATCH = 256 # Items listed per call in the thread pool.
+
+# Globals of the processes that build the items. Set by _init_builder().
+builder = None # See 'stac_items.py'.
+output_format = 'json'
+direct_serialise = False
+instrument = False
+
+# ------------------------------------------------------------------------------
+# _default_config:
+# As in 'parse_direct_parallel.py'.
+# ------------------------------------------------------------------------------
+def _default_config(ctx, param, value):
+     if os.path.exists(value):
+         return value
+     ctx.fail('STAC_CONFIG_FILE not provided.')
+
+def _init_builder(base_url, catalogs, metadata_mode, output_formatp, direct_serialisep, instrumentp):
+    global builder,output_format,direct_serialise,instrument
+    builder = stac_items.ItemBuilder(base_url, catalogs, metadata_mode)
+    output_format = output_formatp
+    direct_serialise = direct_serialisep
+    instrument = instrumentp
+
+# ------------------------------------------------------------------------------
+# _start_builders:
+# Make the process pool fork its workers now: a ProcessPoolExecutor only does so
+# when work is first submitted. Each worker is given a no-op and waited for.
+# ------------------------------------------------------------------------------
+def _start_builders(builders, cores):
+    for future in [builders.submit(os.getpid) for _ in range(cores)]:
+        future.result()
+
+# ------------------------------------------------------------------------------
+# build_item:
+# Run in the process pool: parse the inputs of an item and serialise it. Returns
+# (stages, data, bbox, datetime, id, geometry), 'stages' being the time of each stage.
+# ------------------------------------------------------------------------------
+def build_item(subset, item, ard_data, bounds_data):
+    global builder,output_format,direct_serialise,instrument
+    timings = run_stats.ItemTimings(subset, item, instrument)
+    values = builder.values(subset, item, ard_data, bounds_data, timings)
+    if not direct_serialise:
+        with timings.stage('build'):
+            item_dict = builder.to_dict(subset, values)
+    with timings.stage('serialise'):
+        data = builder.dumps(subset, values, output_format) if direct_serialise else shards.dumps(item_dict, output_format)
+    return timings.stages, data, values.bbox, values.datetime, values.id, values.geometry
+
+# ------------------------------------------------------------------------------
+# AsyncRun:
+# One run over a list of subsets. Everything but build_item() runs in the event
+# loop, so its state needs no locking.
+# ------------------------------------------------------------------------------
+class AsyncRun(object):
+    def __init__(self, input_store, output_store, base_url, subsets, incremental=False, check_output=True,
+                 catalogs=True, index=True, stats=None, output_format='json', io_concurrency=IO_CONCURRENCY, builders=None,
+                 resume=False, retry_failed=False):
+        self.input_store = input_store
+        self.output_store = output_store
+        self.base_url = base_url
+        self.subsets = subsets
+        self.incremental = incremental
+        self.check_output = check_output
+        self.catalogs = catalogs
+        self.stats = stats
+        self.output_format = output_format
+        self.sharded = output_format in shards.SHARDED
+        self.io_concurrency = io_concurrency
+        self.builders = builders # ProcessPoolExecutor, or None to build in the loop.
+        self.threads = concurrent.futures.ThreadPoolExecutor(io_concurrency)
+        self.state_conn = None
+        if incremental or catalogs:
+            self.state_conn = item_state.open_state(output_store.local_dir)
+        self.state = item_state.StateReader(output_store.local_dir) if incremental else {} # Looked up one item at a time.
+        if catalogs:
+            catalog.open_extents(self.state_conn)
+        self.subset_catalogs = {}
+        self.index = item_index.ItemIndex(output_store.local_dir) if index else None
+        self.shard_writers = {}
+        if self.sharded:
+            shards.remove_temp_files(output_store) # Left by a killed run.
+            self.shard_writers = {subset: shards.ShardWriter(output_store, subset, output_format) for subset in subsets}
+        self.records = []
+        self.journal = run_journal.Journal(output_store.local_dir, new=not (resume or retry_failed))
+        self.previous_run = run_journal.JournalReader(output_store.local_dir) if resume else None
+        self.retry_failed = retry_failed
+        self.retries = run_journal.RETRY_ATTEMPTS if retry_failed else 0
+        self.written = 0
+        self.loop = None
+
+    def _io(self, func, *args):
+        return self.loop.run_in_executor(self.threads, func, *args)
+
+    # --------------------------------------------------------------------------
+    # _list:
+    # Put the (subset, item) pairs of all the subsets in the queue, then one None for
+    # each item task.
+    # --------------------------------------------------------------------------
+    async def _list(self, queue):
+        def next_batch(items):
+            start = time.perf_counter()
+            return list(itertools.islice(items, LIST_BATCH)), time.perf_counter() - start
+        if self.retry_failed: # Read at once, as the batches are taken from any thread.
+            items = iter(list(run_journal.failed_items(self.output_store.local_dir, self.subsets)))
+        else:
+            items = ((subset, item) for subset in self.subsets for item in self.input_store.list_items(subset))
+        while True:
+            batch, seconds = await self._io(next_batch, items)
+            if self.stats:
+                self.stats.add_stage('list', seconds)
+            if not batch:
+                break
+            for work in batch:
+                await queue.put(work)
+        for _ in range(self.io_concurrency):
+            await queue.put(None)
+
+    async def _worker(self, queue):
+        while True:
+            work = await queue.get()
+            if work is None:
+                return
+            await self.process_item(*work)
+            if len(self.journal.entries) >= run_journal.BATCH_SIZE:
+                await self._flush()
+
+    # --------------------------------------------------------------------------
+    # process_item:
+    # Process one item, with up to 'retries' retries, with backoff, if it fails.
+    # --------------------------------------------------------------------------
+    async def process_item(self, subset, item):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(run_journal.backoff(attempt - 1))
+                print("*** Retrying:", item)
+            if await self._process_item(subset, item) != 'failed':
+                return
+
+    # --------------------------------------------------------------------------
+    # _process_item:
+    # The steps of create_json() in 'parse_direct_parallel.py' for one item, with
+    # its I/O in the thread pool and its parsing in the process pool. Returns the
+    # outcome of the item.
+    # --------------------------------------------------------------------------
+    async def _process_item(self, subset, item):
+        record = None
+        built = None
+        timings = run_stats.ItemTimings(subset, item, self.stats is not None)
+        shard = self.shard_writers.get(subset)
+        if self.previous_run:
+            entry = self.previous_run.get((subset, item))
+            if entry is not None:
+                status, bbox, datetime = entry
+                if self.catalogs and status == run_journal.DONE:
+                    self._catalog(subset).add_item(item, bbox, datetime)
+                return self._done(subset, item, timings.done('resumed'))
+        with timings.stage('stat'):
+            item_record = await self._io(self.input_store.item_record, subset, item)
+
+        if item_record.stats:
+            if self.incremental:
+                previous = self.state.get((subset, item))
+                if item_state.unchanged(previous, item_record.stats) and (not shard or shard.has(item)):
+                    return self._done(subset, item, timings.done('unchanged'))
+            try:
+                with timings.stage('read'):
+                    ard_data, bounds_data = await self._io(
+                        self.input_store.read_many, [item_record.ard_metadata_file, item_record.bounds_file])
+                if self.incremental:
+                    with timings.stage('hash'):
+                        record = await self._io(item_state.make_record, item_record.stats, ard_data, bounds_data)
+                    if item_state.same_content(previous, record) and (not shard or shard.has(item)):
+                        self._record(subset, item, record) # Same content, new stat data.
+                        return self._done(subset, item, timings.done('same_content'))
+                if self.builders:
+                    built = await self.loop.run_in_executor(self.builders, build_item, subset, item, ard_data, bounds_data)
+                else:
+                    built = build_item(subset, item, ard_data, bounds_data)
+                timings.stages.update(built[0])
+            except Exception as e:
+                print("*** Unknown error in loading the data.", item, repr(e))
+                timings.failed(e)
+                self.journal.failed(subset, item, repr(e))
+                return self._done(subset, item, timings.done())
+        else:
+            print("*** No valid ARD-METADATA.yaml and/or bounds.geojson: SKIPPING ***:", item)
+            return self._done(subset, item, timings.done('invalid'))
+
+        stages, data, bbox, datetime, stac_id, geometry = built
+        if shard:
+            # Add the item to the shard, unless it is there already and has not been rebuilt.
+            if not ((not record) and self.check_output and shard.has(item)):
+                shard.add(item, data)
+                timings.done('written')
+                if record:
+                    self._record(subset, item, record)
+            else:
+                timings.done('exists')
+        else:
+            item_json_file = subset + item + "/" + "STAC.json"
+
+            # Write out only if the file does not exist, unless the item has been rebuilt.
+            with timings.stage('exists'):
+                exists = (not record) and self.check_output and await self._io(self.output_store.exists, item_json_file)
+            if exists:
+                print("*** File exits. Not overwriting:", self.output_store.url(item_json_file))
+                timings.done('exists')
+            else:
+                with timings.stage('write'):
+                    await self._io(self.output_store.write, item_json_file, data)
+                self.written += 1
+                print("{}. {}".format(self.written, self.output_store.url(item_json_file)))
+                timings.done('written')
+                if record:
+                    self._record(subset, item, record)
+        # Items in a shard are done once it is written, at the end.
+        self.journal.done(subset, item, bbox, datetime, run_journal.WRITTEN if shard else run_journal.DONE)
+        if self.catalogs:
+            self._catalog(subset).add_item(item, bbox, datetime)
+        if self.index:
+            self.index.add(subset, item, stac_id, bbox, datetime,
+                           catalog.item_url(self.base_url + subset, item), geometry)
+        return self._done(subset, item, timings)
+
+    # --------------------------------------------------------------------------
+    # _catalog:
+    # The SubsetCatalog of a subset. With retry_failed, only some of its items are
+    # processed, so it starts with those of its catalog.json.
+    # --------------------------------------------------------------------------
+    def _catalog(self, subset):
+        if subset not in self.subset_catalogs:
+            subset_catalog = catalog.SubsetCatalog(self.output_store, self.base_url, subset, self.state_conn)
+            if self.retry_failed and self.output_store.exists(subset + catalog.CATALOG):
+                subset_catalog.add_catalog(json.loads(self.output_store.read_many([subset + catalog.CATALOG])[0]))
+            self.subset_catalogs[subset] = subset_catalog
+        return self.subset_catalogs[subset]
+
+    def _done(self, subset, item, timings):
+        if timings.outcome in ('unchanged', 'same_content'):
+            self.journal.done(subset, item)
+            if self.catalogs:
+                self._catalog(subset).add_item(item)
+        if self.stats:
+            self.stats.add(timings)
+        return timings.outcome
+
+    def _record(self, subset, item, record):
+        self.records.append((subset, item, record))
+
+    # --------------------------------------------------------------------------
+    # _flush:
+    # Record the items whose output is written. Shards are written at the end.
+    # --------------------------------------------------------------------------
+    async def _flush(self):
+        entries, self.journal.entries = self.journal.entries, []
+        records = []
+        if not self.sharded:
+            records, self.records = self.records, []
+        await self._io(self.output_store.flush)
+        if self.index:
+            self.index.commit()
+        if records:
+            item_state.record_items(self.state_conn, records)
+        self.journal.commit(entries)
+
+    async def _run(self):
+        queue = asyncio.Queue(2 * self.io_concurrency)
+        tasks = [asyncio.ensure_future(self._worker(queue)) for _ in range(self.io_concurrency)]
+        await self._list(queue)
+        await asyncio.gather(*tasks)
+        await self._io(self.output_store.flush)
+
+    # --------------------------------------------------------------------------
+    # run:
+    # Process all the items, then write the shards, the index, the state, the
+    # journal and the catalogs.
+    # --------------------------------------------------------------------------
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._run())
+        finally:
+            self.loop.close()
+            self.threads.shutdown()
+        if self.index:
+            self.index.commit()
+        if self.incremental and not self.sharded:
+            item_state.record_items(self.state_conn, self.records)
+        self.journal.commit()
+        for subset, shard_writer in self.shard_writers.items():
+            shard_writer.close()
+            self.journal.release(subset)
+        if self.incremental and self.sharded: # Once the shards are written.
+            item_state.record_items(self.state_conn, self.records)
+        if self.index:
+            self.index.close(self.output_store)
+        self.journal.close()
+        if self.catalogs:
+            for subset_catalog in self.subset_catalogs.values():
+                subset_catalog.close()
+            catalog.write_root_catalog(self.output_store, self.base_url, self.state_conn)
+        if self.state_conn:
+            self.state_conn.close()
+
+# ------------------------------------------------------------------------------
+# usage:
+# Help info to run. Invoke it with --info=usage
+# ------------------------------------------------------------------------------
+def usage():
+    this_program = os.path.basename(__file__)
+    print("\n\
+Usage:\n\
+    {} config.yaml. Default is './stac.yaml'. \n\
+\n\
+    Or, commandline as:\n\
+        {} --base_url=url --input_dir=path --subset=str --output_dir=path\n\
+\n\
+    Output files (output_dir/subset/item/STAC.json) will be created for each item,\n\
+    as with parse_direct_parallel.py, with the same options.\n\
+\n\
+    Up to --io_concurrency items are read and written at a time, from threads, and\n\
+    their inputs are parsed by --cores processes.\n\
+\n\
+    With --resume, a run that was killed continues where it stopped, and with\n\
+    --retry_failed, only the items that failed are processed again, with retries.\n\
+\n\
+".format(this_program,this_program))
+
+# ------------------------------------------------------------------------------
+# main:
+# The main function.
+# ***REMEMBER:*** COMMANDLINE OPTIONS MUST ALL BE IN LOWER CASE
+# ------------------------------------------------------------------------------
+@click.command(name='parse_direct_async')
+@click.argument('stac_config_file', type=str, default='stac.yaml', callback=_default_config, metavar='STAC_CONFIG_FILE')
+@click.option('--info', type=str, help='Type --info=yes to get additional info.')
+@click.option('--base_url', type=str, help='URL of the product. e.g. https://FQDN/S2_MSI_ARD',default='')
+@click.option('--input_dir', type=str, help='Full path of the directory where the subsets are. e.g. /g/data/dz56/datacube/002/S2_MSI_ARD/packaged',default='')
+@click.option('--subset', type=str, help='Date, tile_no, etc. that lists the items. e.g. 2018-06-29, 05S105E-10S110E, etc. ',default='')
+@click.option('--output_dir', type=str, help='Relative or full path of the output directory where the STAC.json will be written under "subset/item/"',default='')
+@click.option('--incremental', is_flag=True, help='Rebuild only the items whose inputs changed since the last incremental run.')
+@click.option('--metadata_mode', type=click.Choice(ard_yaml.MODES), default='events', help='How ARD-METADATA.yaml is read: only the required values (events) or the whole document (full).')
+@click.option('--cores', type=int, default=None, help='Processes parsing the inputs. By default, the CPUs available to this job, at most {}. 0 parses them in the main process.'.format(MAX_CORES))
+@click.option('--io_concurrency', type=int, default=IO_CONCURRENCY, help='Items read and written at a time.')
+@click.option('--empty_output', is_flag=True, help='The output tree is known to be empty: do not look for existing STAC.json files.')
+@click.option('--s3_endpoint', type=str, default=None, help='Endpoint URL of an S3-compatible store, when input_dir or output_dir is an s3:// URL.')
+@click.option('--s3_concurrency', type=int, default=storage.DEFAULT_CONCURRENCY, help='Maximum concurrent S3 requests.')
+@click.option('--no_catalogs', is_flag=True, help='Do not write the catalog.json files, nor link the items to them.')
+@click.option('--no_index', is_flag=True, help='Do not index the items in output_dir/items.sqlite.')
+@click.option('--report', type=str, default=None, help='Time each stage and write a JSON report of the run to this file.')
+@click.option('--prometheus', type=str, default=None, help='Time each stage and write the report as Prometheus metrics to this file.')
+@click.option('--output_format', type=click.Choice(shards.FORMATS), default='json', help='Indented (json) or minified STAC.json per item, or one ndjson(.gz) shard per subset.')
+@click.option('--direct_serialise', is_flag=True, help='Write the items straight from the template of their subset, without making their dicts.')
+@click.option('--resume', is_flag=True, help='Continue the previous run: skip the items in its journal, done or failed.')
+@click.option('--retry_failed', is_flag=True, help='Process only the items that failed in the previous run, retrying each with backoff.')
+def main(stac_config_file,info,base_url,input_dir,subset,output_dir,incremental,metadata_mode,cores,io_concurrency,empty_output,s3_endpoint,s3_concurrency,no_catalogs,no_index,report,prometheus,output_format,direct_serialise,resume,retry_failed):
+    if resume and retry_failed:
+        raise click.UsageError('--resume and --retry_failed cannot be used together.')
+    if (info):
+        usage()
+        return
+    if ((not base_url) or (not input_dir) or (not subset) or (not output_dir)):  # Specify all or none in commandline. If any is missing, it will use the config file.
+        config = yaml.safe_load(open(stac_config_file))
+        base_url = config['base_url']
+        input_dir = config['input_dir']
+        subset = config['subset']
+        output_dir = config['output_dir']
+
+    base_url = os.path.join(base_url, '')
+    stats = run_stats.RunStats('parse_direct_async') if (report or prometheus) else None
+    builder_args = (base_url, not no_catalogs, metadata_mode, output_format, direct_serialise, stats is not None)
+    _init_builder(*builder_args) # For --cores=0.
+    if cores is None:
+        cores = min(executor.available_cpus(), MAX_CORES)
+    builders = None
+    if cores:
+        builders = concurrent.futures.ProcessPoolExecutor(cores, initializer=_init_builder, initargs=builder_args)
+        _start_builders(builders, cores) # Fork before any thread is started, e.g. by the S3 client or the I/O pool.
+
+    input_store = storage.open_storage(input_dir, s3_endpoint, s3_concurrency)
+    output_store = storage.open_storage(output_dir, s3_endpoint, s3_concurrency)
+    if(subset != 'A'):
+        subsets = [os.path.join(subset, '')]
+    else:
+        subsets = list(input_store.list_subsets())
+
+    print("Cores: {}; I/O concurrency: {}; Subsets to be processed: {}".format(cores, io_concurrency, len(subsets)))
+    started = time.perf_counter()
+    run = AsyncRun(input_store, output_store, base_url, subsets, incremental, not empty_output, not no_catalogs,
+                   not no_index, stats, output_format, io_concurrency, builders, resume, retry_failed)
+    try:
+        run.run()
+    finally:
+        if builders:
+            builders.shutdown()
+    elapsed = time.perf_counter() - started
+    print("Items written: {}; Elapsed: {:.1f} s".format(run.written, elapsed))
+    if stats:
+        stats.write(report, prometheus)
+    print("Finished !")
+
+# ------------------------------------------------------------------------------
+# Standard boilerplate to call the main() function.
+if __name__ == '__main__':
+  main()
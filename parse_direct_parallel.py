@@ -11,6 +11,9 @@ This program creates STAC catalog JSONs for the GeoTIFFs in the DEA Data Staging
 This is a parallelised version of 'parse_direct.py' and gives ~20X speed improvement
 over the serial program which processes ~3 items per second. 
 
+The number of workers is taken from the CPUs actually available to the job (affinity,
+cgroup quota and PBS NCPUS), unless given with --cores. See 'executor.py'.
+
 However, this may not be suitable for the cron jobs if they run on shared servers. 
 You must start an interactive queue on Raijin (qsub -I) to run this.
 
@@ -36,24 +39,65 @@ import click
 import os
 import yaml
 import json
-import multiprocessing
-import time
-from multiprocessing import Pool
-from subprocess import Popen, PIPE
 import socket
 import sys
+import item_state
+import ard_yaml
+import storage
+import catalog
+import item_index
+import run_stats
+import shards
+import stac_items
+import executor
+import work_shards
+import itertools
+import collections
+import time
+import run_journal
 hostname = socket.gethostname()
 if (('vdi' in hostname) or ('raijin' in hostname)):
     print ("It is not safe to run the parallel program on a login node. Start a 'qsub -I' session. Exiting!")
     sys.exit()
 
 # Globals
-cores = 64 # Number of workers spawned for each iteration. A value of 64 is the optimum on one node. 
+cores = 0 # Number of workers. 0 sizes the pool from the CPUs available to this job.
+chunksize = 0 # Items sent to a worker at a time. 0 picks it from the number of items and workers, if known.
+max_in_flight = 0 # Items in the pool at a time. 0 picks it from the chunk size and workers. See 'executor.py'.
 limit = 0
 input_dir = ''
 base_url = ''
 output_dir = ''
 subset = ''
+input_store = None # See 'storage.py'
+output_store = None
+incremental = False
+metadata_mode = 'events' # See 'ard_yaml.py'
+check_output = True # False when the output tree is known to be empty.
+state = {} # Item state in incremental mode, looked up by each worker. See item_state.StateReader.
+catalogs = True # Write the catalog.json files and link the items to them. See 'catalog.py'.
+index = True # Index the items in output_dir/items.sqlite. See 'item_index.py'.
+instrument = False # Time each stage of each item. See 'run_stats.py'.
+report = None # Where the JSON report of an instrumented run is written.
+prometheus = None # Where the report is written as Prometheus metrics.
+output_format = 'json' # See 'shards.py'.
+shard_items = {} # Items in the previous shard of each subset, for the sharded formats. Inherited by the workers.
+direct_serialise = False # Write the items straight from their template. See 'item_template.py'.
+builder = None # ItemBuilder of the run, made by each worker as needed. See 'stac_items.py'.
+shard = None # (index, count) of the part of the items processed by this run. See 'work_shards.py'.
+run_store = None # Where the state, item index, catalogs and shards of the run are kept: output_store, or the directory of its shard.
+resume = False # Skip the items in the journal of the previous run. See 'run_journal.py'.
+retry_failed = False # Process only the failed items in the journal of the previous run.
+journal = None # JournalReader of the previous run, with resume. Inherited by the workers.
+retries = 0 # Retries of an item that fails, with backoff.
+
+# What a worker reports back on an item to be linked from its subset's catalog.
+# 'record' is its new state index row, if any; 'bbox' and 'datetime' are None if it was skipped.
+# 'id' and 'geometry' are those of its STAC.json, for the item index.
+# 'line' is the item to be added to the shard of its subset, for the sharded formats.
+# 'outcome' is that of its ItemTimings, and 'error' why it failed, for the journal of the run.
+ItemResult = collections.namedtuple('ItemResult', 'subset item record bbox datetime id geometry line outcome error',
+                                    defaults=(None, None))
 
 # ------------------------------------------------------------------------------
 # _default_config:
@@ -79,90 +123,269 @@ def _default_config(ctx, param, value):
      ctx.fail('STAC_CONFIG_FILE not provided.')
 
 # ------------------------------------------------------------------------------
-# create_item_dict:
-# Create a dictionary structure of the required values. This will be written out 
-# as the 'output_dir/subset/item/STAC.json'
-# These output files are STAC compliant and must be viewable with any STAC browser.
+# create_jsons:
+# Create the JSON file of one (subset, item) pair, retrying it up to 'retries' times,
+# with backoff, if it fails. See create_json().
 # ------------------------------------------------------------------------------
-def create_item_dict(item,ard,geodata,base_url,item_dict):
-    item_dict['id'] = ard['id']
-    item_dict['type'] = 'Feature'
-    
-    item_dict['bbox'] = [ ard['extent']['coord']['ll']['lon'], ard['extent']['coord']['ll']['lat'], 
-    ard['extent']['coord']['ur']['lon'], ard['extent']['coord']['ur']['lat'] ]
-
-    item_dict['geometry'] = geodata['features'][0]['geometry']
-
-    item_dict['properties'] = {}
-    item_dict['properties']['datetime'] = ard['extent']['center_dt']
-    item_dict['properties']['provider'] = 'GA'
-    item_dict['properties']['license'] = 'PDDL-1.0'
-
-    item_dict['links'] = [0]
-    item_json_url = base_url + item + "/" + item + ".json"
-    item_dict['links'][0] = {'rel': 'self', 'href': item_json_url}
-
-    item_json_map_url = base_url + item + '/map.html'
-
-    item_dict['assets'] = {}
-    item_dict['assets']['map'] = {'href': item_json_map_url, "required": 'true', "type": "html"}
-
-    ard_metadata_url = base_url + item + "/ARD-METADATA.yaml"
-    item_dict['assets']['metadata'] = {'href': ard_metadata_url, "required": 'true', "type": "yaml"}
-
-    j = 0
-    bands = ard['image']['bands']
-    for key in bands:
-        j += 1
-        path = ard['image']['bands'][key]['path']
-        item_dict['assets'][key] = {'href': path, "required": 'true', "type": "GeoTIFF", "eo:band":[j]}
+def create_jsons(work):
+    global retries
+    result, timings = create_json(work)
+    for attempt in range(retries):
+        if result is None or result.outcome != 'failed':
+            break
+        time.sleep(run_journal.backoff(attempt))
+        print("*** Retrying:", work[1])
+        result, timings = create_json(work)
+    return result, timings
 
 # ------------------------------------------------------------------------------
-# create_jsons:
-# Iterate through all items and create a JSON file for each.
+# create_json:
+# Create the JSON file of one (subset, item) pair. Inputs are read from the global
+# 'input_store' and outputs written to 'output_store', each a local directory or an
+# S3 prefix (see 'storage.py'). The item URLs are made from the global 'base_url'.
 # Will skip an item if either the 'ARD-METADATA.yaml' or 'bounds.geojson' is missing or empty.
+# Nothing is written for an item that is skipped or fails.
+# In incremental mode an item is rebuilt, and its STAC.json overwritten, only if its
+# inputs changed since the last incremental run.
+# With check_output=False the output tree is assumed to be empty and existing
+# STAC.json files are not looked for.
+# With resume, an item in the journal of the previous run is not looked at again.
+# An ItemResult is returned to the parent, which is the only writer of the state
+# index, the journal and the catalogs, for every item with valid inputs (None
+# otherwise), together with the ItemTimings of the item if the run is instrumented.
 # ------------------------------------------------------------------------------
-def create_jsons(item):
-    global input_dir,base_url,output_dir,subset
+def create_json(work):
+    global input_store,base_url,output_store
+    global incremental,state,metadata_mode,check_output,catalogs,index,instrument
+    global output_format,shard_items,direct_serialise,resume,journal
+    subset, item = work
+    sharded = output_format in shards.SHARDED
     item_dict = {} # Blank out the array for each item. Not really necessary!
-    item_dir = os.path.join(input_dir,item)
-    ard_metadata_file = item_dir + '/ARD-METADATA.yaml'
-    bounds_file = item_dir + '/bounds.geojson'
+    record = None
+    timings = run_stats.ItemTimings(subset, item, instrument)
+    if resume:
+        entry = journal.get(work)
+        if entry is not None:
+            timings.done('resumed')
+            status, bbox, datetime = entry
+            if status == run_journal.FAILED:
+                return None, _timings(timings)
+            return ItemResult(subset, item, None, bbox, datetime, None, None, None, timings.outcome), _timings(timings)
+    with timings.stage('stat'):
+        item_record = input_store.item_record(subset, item)
 
-    if (os.path.exists(ard_metadata_file) and os.path.getsize(ard_metadata_file) > 0) and (os.path.exists(bounds_file) and os.path.getsize(bounds_file) > 0):
+    if item_record.stats:
+        if incremental:
+            previous = state.get(work)
+            if item_state.unchanged(previous, item_record.stats) and (not sharded or item in shard_items[subset]):
+                timings.done('unchanged')
+                return ItemResult(subset, item, None, None, None, None, None, None, timings.outcome), _timings(timings)
         try:
-            ard_metadata = yaml.load(open(ard_metadata_file))
-            with open(bounds_file) as f:
-                geodata = json.load(f)
-                create_item_dict(item,ard_metadata,geodata,base_url,item_dict)
-        except:
-            print("*** Unknown error in loading the data.", item)
-            pass
+            with timings.stage('read'):
+                ard_data, bounds_data = input_store.read_many([item_record.ard_metadata_file, item_record.bounds_file])
+            if incremental:
+                with timings.stage('hash'):
+                    record = item_state.make_record(item_record.stats, ard_data, bounds_data)
+                if item_state.same_content(previous, record) and (not sharded or item in shard_items[subset]):
+                    # Same content, new stat data.
+                    timings.done('same_content')
+                    return ItemResult(subset, item, record, None, None, None, None, None, timings.outcome), _timings(timings)
+            values = _builder().values(subset, item, ard_data, bounds_data, timings)
+            if not direct_serialise:
+                with timings.stage('build'):
+                    item_dict = _builder().to_dict(subset, values)
+        except Exception as e:
+            print("*** Unknown error in loading the data.", item, repr(e))
+            timings.failed(e)
+            return (ItemResult(subset, item, None, None, None, None, None, None, timings.outcome, repr(e)),
+                    _timings(timings.done()))
     else:
         print("*** No valid ARD-METADATA.yaml and/or bounds.geojson: SKIPPING ***:", item)
+        return None, _timings(timings.done('invalid'))
+
+    line = None
+    if sharded:
+        # The parent adds the item to the shard, unless it is there already and has not been rebuilt.
+        if not ((not record) and check_output and item in shard_items[subset]):
+            with timings.stage('serialise'):
+                line = _builder().dumps(subset, values, output_format) if direct_serialise else shards.dumps(item_dict, output_format)
+            timings.done('written')
+        else:
+            timings.done('exists')
+    else:
+        # Write out the JSON files.
+        item_json_file = subset + item + "/" + "STAC.json"
 
-    # Write out the JSON files.
-    item_output_dir = output_dir + subset + item
-    if not os.path.exists(item_output_dir):
-        os.makedirs(item_output_dir)
-    item_json_file = item_output_dir + "/" + "STAC.json"
+        # Write out only if the file does not exist, unless the item has been rebuilt.
+        with timings.stage('exists'):
+            exists = (not record) and check_output and output_store.exists(item_json_file)
+        if exists:
+            print("*** File exits. Not overwriting:", output_store.url(item_json_file))
+            timings.done('exists')
+        else:
+            with timings.stage('serialise'):
+                if direct_serialise:
+                    data = _builder().dumps(subset, values, output_format)
+                else:
+                    data = shards.dumps(item_dict, output_format)
+            with timings.stage('write'):
+                output_store.write(item_json_file, data)
+                output_store.flush() # The parent records the item as done once this returns.
+            timings.done('written')
+    return ItemResult(subset, item, record, values.bbox, values.datetime,
+                      values.id, values.geometry if index else None, line, timings.outcome), _timings(timings)
 
-    # Write out only if the file does not exist.
-    if (os.path.exists(item_json_file) and os.path.getsize(item_json_file) > 0):
-        print("*** File exits. Not overwriting:", item_json_file)
+# ------------------------------------------------------------------------------
+# _builder:
+# The ItemBuilder of the run, made once per worker.
+# ------------------------------------------------------------------------------
+def _builder():
+    global base_url,catalogs,metadata_mode,builder
+    if builder is None:
+        builder = stac_items.ItemBuilder(base_url, catalogs, metadata_mode)
+    return builder
+
+# ------------------------------------------------------------------------------
+# _timings:
+# The ItemTimings to return to the parent, if the run is instrumented.
+# ------------------------------------------------------------------------------
+def _timings(timings):
+    return timings if timings.enabled else None
+
+# ------------------------------------------------------------------------------
+# _subset_catalog:
+# The SubsetCatalog of a subset. With --retry_failed, only some of its items are
+# processed, so it starts with those of its catalog.json.
+# ------------------------------------------------------------------------------
+def _subset_catalog(subset, state_conn):
+    global base_url,run_store,retry_failed
+    subset_catalog = catalog.SubsetCatalog(run_store, base_url, subset, state_conn)
+    if retry_failed and run_store.exists(subset + catalog.CATALOG):
+        subset_catalog.add_catalog(json.loads(run_store.read_many([subset + catalog.CATALOG])[0]))
+    return subset_catalog
+
+# ------------------------------------------------------------------------------
+# work_items:
+# Lazily list the (subset, item) pairs of all the given subsets, one subset at a time.
+# ------------------------------------------------------------------------------
+def work_items(subsets):
+    global input_store,shard
+    for subset in subsets:
+        for item in input_store.list_items(subset):
+            if shard is None or work_shards.in_shard(item, shard):
+                yield (subset, item)
+
+# ------------------------------------------------------------------------------
+# parallel_process:
+# Process the items of all the given subsets as a single stream through one pool, so
+# that no worker is idle at the end of a small subset and the pool is started once.
+# The items are listed as they are processed, and only a bounded number of them are
+# in the pool at a time, so the first ones are processed before the listing is done
+# and the memory used does not grow with the number of items.
+# With --shard, only the items of the shard are processed, and everything but their
+# STAC.json files is kept in the directory of the shard, to be merged afterwards.
+# The items done or failed are entered in the journal of the run, in batches, and
+# with --resume or --retry_failed that of the previous run is added to instead.
+# ------------------------------------------------------------------------------
+def parallel_process(subsets):
+    global base_url,output_store,run_store,shard
+    global limit,cores,chunksize,max_in_flight
+    global incremental,state,catalogs,index
+    global instrument,report,prometheus
+    global output_format,shard_items
+    global resume,retry_failed,journal
+    sharded = output_format in shards.SHARDED
+    journal_db = run_journal.Journal(run_store.local_dir, new=not (resume or retry_failed))
+    if resume:
+        journal = run_journal.JournalReader(run_store.local_dir)
+    if incremental or catalogs:
+        state_conn = item_state.open_state(run_store.local_dir)
+    if incremental:
+        state = item_state.StateReader(run_store.local_dir) # Not loaded: memory stays flat however many items there are.
+    if catalogs:
+        catalog.open_extents(state_conn)
+        subset_catalogs = {}
+    if index:
+        item_index_db = item_index.ItemIndex(run_store.local_dir)
+    if sharded:
+        shards.remove_temp_files(run_store) # Left by a killed run.
+        shard_writers = {subset: shards.ShardWriter(run_store, subset, output_format) for subset in subsets}
+        shard_items = {subset: set(writer.previous) for subset, writer in shard_writers.items()} # Before the fork.
+    n_items = None # Not known while the items are listed. Sizes the chunks if known.
+    if retry_failed:
+        work = run_journal.failed_items(run_store.local_dir, subsets)
+        n_items = run_journal.count_failed(run_store.local_dir, subsets)
     else:
-        with open(item_json_file, 'w') as file:
-             file.write(json.dumps(item_dict,indent=1)) 
-        time.sleep(1) # make this wait long enough to finish the processing
-
-def parallel_process():
-    global input_dir,base_url,output_dir,subset
-    global limit,cores
-    items_dirs = os.listdir(input_dir)
-    pool = Pool(processes=cores)              # start $np worker processes. It is the optimum
-    if not limit: limit = len(items_dirs)
-    print("Cores: {}; Items to be processed: {}".format(cores,limit))
-    pool.map(create_jsons, items_dirs[:limit]) # Send $cores files each time until the set limit         
+        work = work_items(subsets)
+    if instrument:
+        stats = run_stats.RunStats('parse_direct_parallel')
+        work = stats.timed_iter('list', work)
+    if limit:
+        work = itertools.islice(work, limit)
+        n_items = None if n_items is None else min(n_items, limit)
+    pool = executor.ItemExecutor(cores, chunksize, max_in_flight)
+    print("Cores: {}; Subsets to be processed: {}".format(pool.workers,len(subsets)))
+    records = []
+    for result, timings in pool.map(create_jsons, work, n_items):
+        if timings:
+            stats.add(timings)
+        if result is None:
+            continue
+        if result.outcome == 'failed':
+            journal_db.failed(result.subset, result.item, result.error)
+        elif result.outcome != 'resumed':
+            # Items in a shard are done once it is written, at the end.
+            journal_db.done(result.subset, result.item, result.bbox, result.datetime,
+                            run_journal.WRITTEN if result.line else run_journal.DONE)
+        if len(journal_db.entries) >= run_journal.BATCH_SIZE:
+            if index:
+                item_index_db.commit()
+            if incremental and not sharded: # Shards are written at the end.
+                item_state.record_items(state_conn, records)
+                records = []
+            journal_db.commit()
+        if result.outcome == 'failed':
+            continue
+        if result.line:
+            shard_writers[result.subset].add(result.item, result.line)
+        if result.record:
+            records.append(result[:3])
+        if catalogs:
+            if result.subset not in subset_catalogs:
+                subset_catalogs[result.subset] = _subset_catalog(result.subset, state_conn)
+            subset_catalogs[result.subset].add_item(result.item, result.bbox, result.datetime)
+        if index and result.id is not None:
+            item_index_db.add(result.subset, result.item, result.id, result.bbox, result.datetime,
+                              catalog.item_url(base_url + result.subset, result.item), result.geometry)
+    pool.close()
+    if index:
+        item_index_db.commit()
+    if incremental and not sharded:
+        item_state.record_items(state_conn, records)
+        records = []
+    journal_db.commit()
+    if sharded:
+        for subset, shard_writer in shard_writers.items():
+            shard_writer.close()
+            journal_db.release(subset)
+    if index:
+        item_index_db.close(run_store)
+    if incremental:
+        item_state.record_items(state_conn, records)
+    journal_db.close()
+    if catalogs:
+        for subset_catalog in subset_catalogs.values():
+            subset_catalog.close()
+        if shard is None: # The root catalog of a sharded run is written by the merge.
+            catalog.write_root_catalog(output_store, base_url, state_conn)
+    if incremental or catalogs:
+        state_conn.close()
+    pool.report()
+    if instrument:
+        run_report = stats.write(report, prometheus, pool.worker_stats)
+        if shard is not None:
+            run_store.write(work_shards.REPORT, json.dumps(run_report, indent=1)) # Also marks the shard as done.
+            run_store.flush()
     print("Finished !")    
     
 # ------------------------------------------------------------------------------
@@ -181,6 +404,30 @@ Usage:\n\
     Output files (output_dir/subset/item/STAC.json) will be created for each item.\n\
 \n\
     Existing files will not be overwritten.\n\
+\n\
+    With --output_format=minified they are written without whitespace, and with\n\
+    --output_format=ndjson or ndjson.gz all the items of a subset are written to one\n\
+    shard (output_dir/subset/items.ndjson[.gz]) with a byte-offset index.\n\
+\n\
+    A catalog.json is also written for each subset (output_dir/subset/catalog.json)\n\
+    and for the whole product (output_dir/catalog.json), unless --no_catalogs is given.\n\
+\n\
+    The items are indexed by bbox and datetime in output_dir/items.sqlite, unless\n\
+    --no_index is given. Query it with item_index.py.\n\
+\n\
+    With --report=file.json (and/or --prometheus=file.prom), each stage of each item\n\
+    is timed and a report of the run, with its errors and slowest items, is written.\n\
+\n\
+    With --incremental, only the items whose ARD-METADATA.yaml or bounds.geojson\n\
+    changed since the last incremental run are rebuilt, and their files overwritten.\n\
+\n\
+    The items done or failed are entered in a journal (output_dir/.stac_journal.sqlite).\n\
+    With --resume, a run that was killed continues where it stopped, and with\n\
+    --retry_failed, only the items that failed are processed again, with retries.\n\
+\n\
+    With --shard=INDEX/COUNT, only one of COUNT disjoint parts of the items is\n\
+    processed, e.g. by each task of a PBS array job. Then run work_shards.py to\n\
+    merge the catalogs, indexes, ndjson shards and reports of all the parts.\n\
 \n\
 ".format(this_program,this_program))
 
@@ -197,18 +444,58 @@ Usage:\n\
 @click.option('--input_dirp', type=str, help='Full path of the directory where the subsets are. e.g. /g/data/dz56/datacube/002/S2_MSI_ARD/packaged',default='')
 @click.option('--subsetp', type=str, help='Date, tile_no, etc. that lists the items. e.g. 2018-06-29, 05S105E-10S110E, etc. ',default='')
 @click.option('--output_dirp', type=str, help='Relative or full path of the output directory where the STAC.json will be written under "subset/item/"',default='')
-def main(stac_config_file,base_urlp,input_dirp,subsetp,output_dirp,info):
-    global input_dir,base_url,output_dir,subset
+@click.option('--incremental', 'incrementalp', is_flag=True, help='Rebuild only the items whose inputs changed since the last incremental run.')
+@click.option('--metadata_mode', 'metadata_modep', type=click.Choice(ard_yaml.MODES), default='events', help='How ARD-METADATA.yaml is read: only the required values (events) or the whole document (full).')
+@click.option('--cores', 'coresp', type=int, default=0, help='Number of workers. By default, the number of CPUs available to this job.')
+@click.option('--chunksize', 'chunksizep', type=int, default=0, help='Items sent to a worker at a time. By default, chosen from the number of items and workers when it is known (--retry_failed), else {}.'.format(executor.STREAM_CHUNKSIZE))
+@click.option('--max_in_flight', 'max_in_flightp', type=int, default=0, help='Items in the pool at a time. By default, a few chunks per worker.')
+@click.option('--empty_output', is_flag=True, help='The output tree is known to be empty: do not look for existing STAC.json files.')
+@click.option('--s3_endpoint', type=str, default=None, help='Endpoint URL of an S3-compatible store, when input_dir or output_dir is an s3:// URL.')
+@click.option('--s3_concurrency', type=int, default=storage.DEFAULT_CONCURRENCY, help='Maximum concurrent S3 requests per worker.')
+@click.option('--no_catalogs', is_flag=True, help='Do not write the catalog.json files, nor link the items to them.')
+@click.option('--no_index', is_flag=True, help='Do not index the items in output_dir/items.sqlite.')
+@click.option('--report', 'reportp', type=str, default=None, help='Time each stage and write a JSON report of the run to this file.')
+@click.option('--prometheus', 'prometheusp', type=str, default=None, help='Time each stage and write the report as Prometheus metrics to this file.')
+@click.option('--output_format', 'output_formatp', type=click.Choice(shards.FORMATS), default='json', help='Indented (json) or minified STAC.json per item, or one ndjson(.gz) shard per subset.')
+@click.option('--direct_serialise', 'direct_serialisep', is_flag=True, help='Write the items straight from the template of their subset, without making their dicts.')
+@click.option('--resume', 'resumep', is_flag=True, help='Continue the previous run: skip the items in its journal, done or failed.')
+@click.option('--retry_failed', 'retry_failedp', is_flag=True, help='Process only the items that failed in the previous run, retrying each with backoff.')
+@click.option('--shard', 'shardp', type=str, default=None, callback=work_shards.parse_shard, metavar='INDEX/COUNT', help='Process only the INDEX-th (from 0) of COUNT disjoint parts of the items, e.g. --shard=${PBS_ARRAY_INDEX}/8.')
+def main(stac_config_file,base_urlp,input_dirp,subsetp,output_dirp,info,incrementalp,metadata_modep,coresp,chunksizep,max_in_flightp,empty_output,s3_endpoint,s3_concurrency,no_catalogs,no_index,reportp,prometheusp,output_formatp,direct_serialisep,resumep,retry_failedp,shardp):
+    global input_dir,base_url,output_dir,subset,shard
+    global input_store,output_store,run_store,catalogs,index
+    global instrument,report,prometheus,output_format,direct_serialise
+    global incremental,metadata_mode,check_output
+    global cores,chunksize,max_in_flight
+    global resume,retry_failed,retries
     input_dir = input_dirp
     base_url = base_urlp
     output_dir = output_dirp
     subset = subsetp
+    incremental = incrementalp
+    metadata_mode = metadata_modep
+    check_output = not empty_output
+    catalogs = not no_catalogs
+    index = not no_index
+    report = reportp
+    prometheus = prometheusp
+    shard = shardp
+    instrument = bool(report or prometheus or shard) # The report of each shard is merged.
+    output_format = output_formatp
+    direct_serialise = direct_serialisep
+    cores = coresp
+    chunksize = chunksizep
+    max_in_flight = max_in_flightp
+    if resumep and retry_failedp:
+        raise click.UsageError('--resume and --retry_failed cannot be used together.')
+    resume = resumep
+    retry_failed = retry_failedp
+    retries = run_journal.RETRY_ATTEMPTS if retry_failed else 0
     if (info): usage()
     else:
         if ((not base_url) or (not input_dir) or (not subset) or (not output_dir)):  # Specify all or none in commandline. If any is missing, it will use the config file.
-            config = yaml.load(open(stac_config_file))
+            config = yaml.safe_load(open(stac_config_file))
             base_url = config['base_url']
-            base_url = os.path.join(base_url, '')
             
             input_dir = config['input_dir']
     
@@ -217,33 +504,23 @@ def main(stac_config_file,base_urlp,input_dirp,subsetp,output_dirp,info):
         
             output_dir = config['output_dir']
     
-            output_dir = os.path.join(output_dir, '')
-            input_dir = os.path.join(input_dir, '')
-            # Specify a subset as 2018-06-30 for L2, or as 05S105E-10S110E for S2_MSI_ARD. 
-            # Option 'A' is suitable for S2_MSI_ARD where multiple tiles are involved
-            if(subset is not 'A'):
-                subset = os.path.join(subset, '')
-        
-                base_url = base_url + subset
-                input_dir = input_dir + subset
-                
-                # Iterate through all items and create a JSON file for each.
-                parallel_process()
-            else: # Note: This part is not tested yet!
-                subsets = os.listdir(input_dir)
-                for subset in subsets:
-                    subset = os.path.join(subset, '')
-            
-                    base_url = base_url + subset
-                    input_dir = input_dir + subset
-                    
-                    output_subset_dir = output_dir + subset
-                    if not os.path.exists(output_subset_dir):
-                        os.makedirs(output_subset_dir)
-    
-                    # Iterate through all items abd create a JSON file for each.
-                    parallel_process()
-#                    break # Activate for limiting the iteration to just one subset. 
+        base_url = os.path.join(base_url, '')
+        # input_dir and output_dir may also be s3://bucket/prefix URLs.
+        input_store = storage.open_storage(input_dir, s3_endpoint, s3_concurrency)
+        output_store = storage.open_storage(output_dir, s3_endpoint, s3_concurrency)
+        run_store = output_store
+        if shard is not None:
+            run_store = storage.open_storage(output_store.url(work_shards.shard_key(shard)), s3_endpoint, s3_concurrency)
+        # Specify a subset as 2018-06-30 for L2, or as 05S105E-10S110E for S2_MSI_ARD. 
+        # Option 'A' is suitable for S2_MSI_ARD where multiple tiles are involved.
+        # The items of all its subsets are processed as one stream by a single pool.
+        if(subset != 'A'):
+            subsets = [os.path.join(subset, '')]
+        else:
+            subsets = list(input_store.list_subsets())
+
+        # Iterate through all items and create a JSON file for each.
+        parallel_process(subsets)
 
 # ------------------------------------------------------------------------------
 # Standard boilerplate to call the main() function.
@@ -0,0 +1,194 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Journal of a run of 'parse_direct.py', 'parse_direct_parallel.py' or
+'parse_direct_async.py', so that a run killed part way (e.g. at the PBS walltime)
+can be resumed, and the items that failed retried.
+
+HOW:
+    - One SQLite file, 'output_dir/.stac_journal.sqlite', is kept per output_dir
+      (per shard with --shard). A run starts a new journal unless it is given
+      --resume or --retry_failed.
+    - Every item that is done (written, not overwritten or unchanged) or failed is
+      appended to it, with the bbox and datetime of a built item, or the error of a
+      failed one. Entries are committed in batches, and an item is only entered as
+      done once its output is written: for the ndjson formats, it is entered as
+      'written' and becomes done when the shard of its subset is (see release()).
+    - With --resume the items in the journal, done or failed, are not looked at
+      again. Their bbox and datetime still go into the catalog.json of their subset.
+    - With --retry_failed only the failed items in the journal are processed. An item
+      that fails again is retried up to RETRY_ATTEMPTS times, after a delay that
+      doubles from RETRY_DELAY up to RETRY_MAX_DELAY seconds.
+'''
+# ------------------------------------------------------------------------------
+import os
+import sqlite3
+import time
+
+JOURNAL_FILE = '.stac_journal.sqlite'
+BATCH_SIZE = 1000 # Entries committed per transaction.
+RETRY_ATTEMPTS = 3 # Retries of a failed item with --retry_failed.
+RETRY_DELAY = 1.0 # Seconds before the first retry, doubled for each next one.
+RETRY_MAX_DELAY = 30.0
+
+DONE = 'done'
+FAILED = 'failed'
+WRITTEN = 'written' # In a shard that is not written yet.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    subset    TEXT NOT NULL,
+    item      TEXT NOT NULL,
+    status    TEXT NOT NULL,
+    attempts  INTEGER NOT NULL,
+    west      REAL,
+    south     REAL,
+    east      REAL,
+    north     REAL,
+    datetime  TEXT,
+    error     TEXT,
+    PRIMARY KEY (subset, item)
+)
+"""
+
+# An item is counted as one more attempt each time it is entered as failed.
+_UPSERT = """
+INSERT INTO journal VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (subset, item) DO UPDATE SET
+    status = excluded.status, attempts = journal.attempts + excluded.attempts,
+    west = excluded.west, south = excluded.south, east = excluded.east, north = excluded.north,
+    datetime = excluded.datetime, error = excluded.error
+"""
+
+def _connect(output_dir):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    conn = sqlite3.connect(os.path.join(output_dir, JOURNAL_FILE))
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(_SCHEMA)
+    return conn
+
+def backoff(attempt):
+    return min(RETRY_DELAY * 2 ** attempt, RETRY_MAX_DELAY)
+
+# ------------------------------------------------------------------------------
+# Journal:
+# The journal of a run, as written by its only writer. With new=False, that of
+# the previous run is kept and added to.
+# ------------------------------------------------------------------------------
+class Journal(object):
+    def __init__(self, output_dir, new=True):
+        self.output_dir = output_dir
+        self.conn = _connect(output_dir)
+        if new:
+            with self.conn:
+                self.conn.execute('DELETE FROM journal')
+        self.entries = []
+
+    def done(self, subset, item, bbox=None, datetime=None, status=DONE):
+        west, south, east, north = bbox if bbox is not None else (None, None, None, None)
+        self.entries.append((subset.strip('/'), item, status, 0, west, south, east, north, datetime, None))
+
+    def failed(self, subset, item, error):
+        self.entries.append((subset.strip('/'), item, FAILED, 1, None, None, None, None, None, error))
+
+    # --------------------------------------------------------------------------
+    # commit:
+    # Store the entries added since the last commit, or the given ones, taken from
+    # 'entries' before. The caller must have written the output of the done items.
+    # --------------------------------------------------------------------------
+    def commit(self, entries=None):
+        if entries is None:
+            entries, self.entries = self.entries, []
+        with self.conn:
+            self.conn.executemany(_UPSERT, entries)
+
+    # --------------------------------------------------------------------------
+    # release:
+    # Enter the items 'written' to the shard of a subset as done, once the shard
+    # is written.
+    # --------------------------------------------------------------------------
+    def release(self, subset):
+        self.commit()
+        with self.conn:
+            self.conn.execute('UPDATE journal SET status = ? WHERE subset = ? AND status = ?',
+                              (DONE, subset.strip('/'), WRITTEN))
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+# ------------------------------------------------------------------------------
+# failed_items:
+# The (subset, item) pairs of the failed items of the given subsets in a journal,
+# read lazily with their own connection, e.g. from the feeder thread of a pool.
+# ------------------------------------------------------------------------------
+def failed_items(output_dir, subsets):
+    conn = _connect(output_dir)
+    try:
+        for subset in subsets:
+            rows = conn.execute('SELECT item FROM journal WHERE subset = ? AND status = ? ORDER BY item',
+                                (subset.strip('/'), FAILED))
+            for (item,) in rows.fetchall():
+                yield (subset, item)
+    finally:
+        conn.close()
+
+# ------------------------------------------------------------------------------
+# count_failed:
+# The number of failed items of the given subsets in a journal.
+# ------------------------------------------------------------------------------
+def count_failed(output_dir, subsets):
+    conn = _connect(output_dir)
+    try:
+        return sum(conn.execute('SELECT COUNT(*) FROM journal WHERE subset = ? AND status = ?',
+                                (subset.strip('/'), FAILED)).fetchone()[0] for subset in subsets)
+    finally:
+        conn.close()
+
+# ------------------------------------------------------------------------------
+# with_retries:
+# Yield the items, then those put in the list 'failures' meanwhile, again, up to
+# 'retries' times, waiting backoff() before each pass. For a serial run, which
+# puts the items that fail in 'failures'.
+# ------------------------------------------------------------------------------
+def with_retries(items, failures, retries):
+    for item in items:
+        yield item
+    for attempt in range(retries):
+        if not failures:
+            return
+        time.sleep(backoff(attempt))
+        retry, failures[:] = list(failures), []
+        for item in retry:
+            print("*** Retrying:", item)
+            yield item
+
+# ------------------------------------------------------------------------------
+# JournalReader:
+# The entries of a journal, looked up one item at a time: get((subset, item)) is
+# (status, bbox, datetime), or None. As item_state.StateReader, each process opens
+# its own connection on first use.
+# ------------------------------------------------------------------------------
+class JournalReader(object):
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, JOURNAL_FILE)
+        self.conn = None
+        self.pid = None
+
+    def get(self, key):
+        if self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path)
+            self.pid = os.getpid()
+        subset, item = key
+        row = self.conn.execute('SELECT status, west, south, east, north, datetime FROM journal '
+                                'WHERE subset = ? AND item = ? AND status IN (?, ?)',
+                                (subset.strip('/'), item, DONE, FAILED)).fetchone()
+        if row is None:
+            return None
+        status, west, south, east, north, datetime = row
+        return status, (west, south, east, north) if west is not None else None, datetime
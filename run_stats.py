@@ -0,0 +1,365 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Opt-in instrumentation of 'create_jsons', and the report of a run.
+
+Each item is timed stage by stage ('stat', 'read', 'hash', 'parse_yaml',
+'parse_geojson', 'build', 'serialise', 'exists', 'write'), and the listing of the
+items is timed as 'list'. The report of a run has:
+    - the count of items by outcome: written, exists (not overwritten), unchanged,
+      same_content (incremental mode), invalid (missing or empty inputs), failed and
+      resumed (in the journal of the previous run, see 'run_journal.py').
+    - the count of errors by exception type, with the first few of them.
+    - a latency histogram of each stage and of whole items.
+    - the slowest items, with their time per stage.
+    - the items and busy time of each worker, for the parallel program.
+
+HOW:
+    - An ItemTimings is made for every item. If the run is not instrumented, its
+      stages are a shared no-op, so the cost is a few attribute lookups per stage.
+    - The workers of the parallel program return the ItemTimings of each item with
+      its result, and only the parent aggregates them in a RunStats, so nothing is
+      shared between processes.
+    - The report is written as JSON and optionally as a Prometheus textfile (for the
+      node_exporter textfile collector). Both are written to a temporary file first
+      and renamed into place.
+'''
+# ------------------------------------------------------------------------------
+import bisect
+import collections
+import datetime
+import heapq
+import json
+import os
+import tempfile
+import time
+
+# Upper bounds, in seconds, of the histogram buckets. The last one is +Inf.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+OUTCOMES = ('written', 'exists', 'unchanged', 'same_content', 'invalid', 'failed', 'resumed')
+SLOWEST = 10 # Slowest items kept in the report.
+ERROR_SAMPLES = 20 # Errors kept in the report, with their items.
+PROMETHEUS_PREFIX = 'stac_'
+
+# ------------------------------------------------------------------------------
+# Histogram:
+# Counts of values per bucket, with their sum and maximum.
+# ------------------------------------------------------------------------------
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        cumulative, buckets = 0, collections.OrderedDict()
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return collections.OrderedDict([
+            ('count', self.count), ('sum', round(self.sum, 6)),
+            ('mean', round(self.sum / self.count, 6) if self.count else 0.0),
+            ('max', round(self.max, 6)), ('buckets', buckets)])
+
+# ------------------------------------------------------------------------------
+# _NullStage:
+# The stage of an item that is not timed.
+# ------------------------------------------------------------------------------
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage(object):
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stages = self.timings.stages
+        stages[self.name] = stages.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+# ------------------------------------------------------------------------------
+# ItemTimings:
+# The time per stage, outcome and error of one item. Use as:
+#     with timings.stage('read'):
+#         ...
+#     timings.done('written')
+# ------------------------------------------------------------------------------
+class ItemTimings(object):
+    __slots__ = ('subset', 'item', 'enabled', 'stages', 'outcome', 'error_type', 'error', 'start', 'seconds')
+
+    def __init__(self, subset, item, enabled=True):
+        self.subset = subset
+        self.item = item
+        self.enabled = enabled
+        self.stages = {}
+        self.outcome = None
+        self.error_type = None
+        self.error = None
+        self.start = time.perf_counter() if enabled else 0.0
+        self.seconds = 0.0
+
+    def stage(self, name):
+        if self.enabled:
+            return _Stage(self, name)
+        return _NULL_STAGE
+
+    def failed(self, e):
+        self.outcome = 'failed'
+        self.error_type = type(e).__name__
+        self.error = str(e)
+
+    def done(self, outcome=None):
+        if self.outcome is None:
+            self.outcome = outcome
+        if self.enabled:
+            self.seconds = time.perf_counter() - self.start
+        return self
+
+    # No need to pickle the unused bits back from the workers.
+    def __getstate__(self):
+        return (self.subset, self.item, self.stages, self.outcome, self.error_type, self.error, self.seconds)
+
+    def __setstate__(self, state):
+        self.subset, self.item, self.stages, self.outcome, self.error_type, self.error, self.seconds = state
+        self.enabled = True
+        self.start = 0.0
+
+# ------------------------------------------------------------------------------
+# RunStats:
+# The aggregated ItemTimings of a run.
+# ------------------------------------------------------------------------------
+class RunStats(object):
+    def __init__(self, program):
+        self.program = program
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.outcomes = collections.Counter()
+        self.errors = collections.Counter()
+        self.error_samples = []
+        self.stages = collections.OrderedDict()
+        self.items = Histogram()
+        self.slowest = [] # Heap of (seconds, n, ItemTimings).
+        self.n = 0
+
+    def add_stage(self, name, seconds):
+        if name not in self.stages:
+            self.stages[name] = Histogram()
+        self.stages[name].add(seconds)
+
+    # --------------------------------------------------------------------------
+    # timed_iter:
+    # Iterate, timing each step as the stage 'name'. For the listing of the items.
+    # --------------------------------------------------------------------------
+    def timed_iter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                value = next(iterator)
+            except StopIteration:
+                self.add_stage(name, time.perf_counter() - start)
+                return
+            self.add_stage(name, time.perf_counter() - start)
+            yield value
+
+    def add(self, timings):
+        self.n += 1
+        self.outcomes[timings.outcome] += 1
+        for name, seconds in timings.stages.items():
+            self.add_stage(name, seconds)
+        self.items.add(timings.seconds)
+        if timings.error_type:
+            self.errors[timings.error_type] += 1
+            if len(self.error_samples) < ERROR_SAMPLES:
+                self.error_samples.append(collections.OrderedDict([
+                    ('subset', timings.subset), ('item', timings.item),
+                    ('type', timings.error_type), ('error', timings.error)]))
+        entry = (timings.seconds, self.n, timings)
+        if len(self.slowest) < SLOWEST:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    # --------------------------------------------------------------------------
+    # summary:
+    # The report of the run as a dict. 'workers' is {pid: (items, busy seconds)}, and
+    # 'backlog' is {name: number} of items waiting, for a long running process.
+    # --------------------------------------------------------------------------
+    def summary(self, workers=None, backlog=None):
+        elapsed = time.perf_counter() - self.start
+        outcomes = collections.OrderedDict((outcome, self.outcomes.get(outcome, 0)) for outcome in OUTCOMES)
+        report = collections.OrderedDict([
+            ('program', self.program),
+            ('started', datetime.datetime.fromtimestamp(self.started).isoformat()),
+            ('elapsed_seconds', round(elapsed, 3)),
+            ('items', self.n),
+            ('items_per_sec', round(self.n / elapsed, 2) if elapsed else 0.0),
+            ('outcomes', outcomes),
+            ('errors', collections.OrderedDict(self.errors.most_common())),
+            ('error_samples', self.error_samples),
+            ('stages', collections.OrderedDict((name, hist.as_dict()) for name, hist in self.stages.items())),
+            ('item_seconds', self.items.as_dict()),
+            ('slowest', [collections.OrderedDict([
+                ('subset', timings.subset), ('item', timings.item), ('seconds', round(seconds, 6)),
+                ('outcome', timings.outcome),
+                ('stages', collections.OrderedDict((name, round(s, 6)) for name, s in timings.stages.items()))])
+                for seconds, n, timings in sorted(self.slowest, reverse=True)]),
+        ])
+        if backlog is not None:
+            report['backlog'] = collections.OrderedDict(sorted(backlog.items()))
+        if workers:
+            report['workers'] = [collections.OrderedDict([('pid', pid), ('items', items), ('busy_seconds', round(busy, 3))])
+                                 for pid, (items, busy) in sorted(workers.items())]
+        return report
+
+    # --------------------------------------------------------------------------
+    # write:
+    # Write the report as JSON to 'json_file' and/or as Prometheus metrics to
+    # 'prometheus_file', and print a one line summary.
+    # --------------------------------------------------------------------------
+    def write(self, json_file=None, prometheus_file=None, workers=None, backlog=None):
+        return write_report(self.summary(workers, backlog), json_file, prometheus_file)
+
+# ------------------------------------------------------------------------------
+# write_report:
+# Write a report as JSON and/or Prometheus metrics, as RunStats.write().
+# ------------------------------------------------------------------------------
+def write_report(report, json_file=None, prometheus_file=None):
+    if json_file:
+        _write_atomic(json_file, json.dumps(report, indent=1) + '\n')
+    if prometheus_file:
+        _write_atomic(prometheus_file, prometheus_text(report))
+    print("Report: {} items in {:.1f} s ({}); {} errors".format(
+        report['items'], report['elapsed_seconds'],
+        ', '.join('{} {}'.format(n, outcome) for outcome, n in report['outcomes'].items() if n),
+        sum(report['errors'].values())))
+    return report
+
+# ------------------------------------------------------------------------------
+# _merge_histograms:
+# The sum of histograms in the form of Histogram.as_dict().
+# ------------------------------------------------------------------------------
+def _merge_histograms(hists):
+    count = sum(hist['count'] for hist in hists)
+    total = sum(hist['sum'] for hist in hists)
+    buckets = collections.OrderedDict()
+    for hist in hists:
+        for bound, n in hist['buckets'].items():
+            buckets[bound] = buckets.get(bound, 0) + n # Cumulative counts add up too.
+    return collections.OrderedDict([
+        ('count', count), ('sum', round(total, 6)), ('mean', round(total / count, 6) if count else 0.0),
+        ('max', max(hist['max'] for hist in hists)), ('buckets', buckets)])
+
+# ------------------------------------------------------------------------------
+# merge_reports:
+# One report from the reports of runs over disjoint parts of the items at the same
+# time, e.g. the shards of a multi-node run. Its elapsed time is from the first
+# start to the last finish.
+# ------------------------------------------------------------------------------
+def merge_reports(reports, program):
+    started = [datetime.datetime.fromisoformat(report['started']) for report in reports]
+    finished = max(start + datetime.timedelta(seconds=report['elapsed_seconds']) for start, report in zip(started, reports))
+    elapsed = (finished - min(started)).total_seconds()
+    items = sum(report['items'] for report in reports)
+    errors = collections.Counter()
+    stages = collections.OrderedDict()
+    for report in reports:
+        errors.update(report['errors'])
+        for name, hist in report['stages'].items():
+            stages.setdefault(name, []).append(hist)
+    merged = collections.OrderedDict([
+        ('program', program),
+        ('started', min(started).isoformat()),
+        ('elapsed_seconds', round(elapsed, 3)),
+        ('items', items),
+        ('items_per_sec', round(items / elapsed, 2) if elapsed else 0.0),
+        ('outcomes', collections.OrderedDict((outcome, sum(report['outcomes'].get(outcome, 0) for report in reports))
+                                             for outcome in OUTCOMES)),
+        ('errors', collections.OrderedDict(errors.most_common())),
+        ('error_samples', [sample for report in reports for sample in report['error_samples']][:ERROR_SAMPLES]),
+        ('stages', collections.OrderedDict((name, _merge_histograms(hists)) for name, hists in stages.items())),
+        ('item_seconds', _merge_histograms([report['item_seconds'] for report in reports])),
+        ('slowest', sorted((item for report in reports for item in report['slowest']),
+                           key=lambda item: item['seconds'], reverse=True)[:SLOWEST]),
+        ('shards', len(reports)),
+    ])
+    workers = [collections.OrderedDict([('shard', n)] + list(worker.items()))
+               for n, report in enumerate(reports) for worker in report.get('workers', [])]
+    if workers:
+        merged['workers'] = workers
+    return merged
+
+# ------------------------------------------------------------------------------
+# prometheus_text:
+# The report of a run in the Prometheus text exposition format.
+# ------------------------------------------------------------------------------
+def prometheus_text(report):
+    p = PROMETHEUS_PREFIX
+    program = 'program="{}"'.format(report['program'])
+    lines = [
+        '# HELP {}items_total Items processed in the last run, by outcome.'.format(p),
+        '# TYPE {}items_total gauge'.format(p),
+    ]
+    for outcome, n in report['outcomes'].items():
+        lines.append('{}items_total{{{},outcome="{}"}} {}'.format(p, program, outcome, n))
+    lines += ['# HELP {}errors_total Items that failed in the last run, by exception type.'.format(p),
+              '# TYPE {}errors_total gauge'.format(p)]
+    for error_type, n in report['errors'].items():
+        lines.append('{}errors_total{{{},type="{}"}} {}'.format(p, program, error_type, n))
+    lines += ['# HELP {}stage_seconds Time per item spent in each stage in the last run.'.format(p),
+              '# TYPE {}stage_seconds histogram'.format(p)]
+    for name, hist in report['stages'].items():
+        labels = '{},stage="{}"'.format(program, name)
+        for bound, count in hist['buckets'].items():
+            lines.append('{}stage_seconds_bucket{{{},le="{}"}} {}'.format(p, labels, bound, count))
+        lines.append('{}stage_seconds_sum{{{}}} {}'.format(p, labels, hist['sum']))
+        lines.append('{}stage_seconds_count{{{}}} {}'.format(p, labels, hist['count']))
+    if 'backlog' in report:
+        lines += ['# HELP {}backlog_items Items waiting to be processed, by state.'.format(p),
+                  '# TYPE {}backlog_items gauge'.format(p)]
+        for name, n in report['backlog'].items():
+            lines.append('{}backlog_items{{{},state="{}"}} {}'.format(p, program, name, n))
+    lines += [
+        '# HELP {}run_duration_seconds Duration of the last run.'.format(p),
+        '# TYPE {}run_duration_seconds gauge'.format(p),
+        '{}run_duration_seconds{{{}}} {}'.format(p, program, report['elapsed_seconds']),
+        '# HELP {}run_items_per_second Throughput of the last run.'.format(p),
+        '# TYPE {}run_items_per_second gauge'.format(p),
+        '{}run_items_per_second{{{}}} {}'.format(p, program, report['items_per_sec']),
+        '# HELP {}run_finished_timestamp_seconds When the last run finished.'.format(p),
+        '# TYPE {}run_finished_timestamp_seconds gauge'.format(p),
+        '{}run_finished_timestamp_seconds{{{}}} {:.0f}'.format(p, program, time.time()),
+    ]
+    return '\n'.join(lines) + '\n'
+
+def _write_atomic(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '-', suffix='.tmp', dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Output formats of the items, selected with --output_format:
+    - json:      'output_dir/subset/item/STAC.json', indented (the default).
+    - minified:  the same files, without whitespace.
+    - ndjson:    one shard per subset, 'output_dir/subset/items.ndjson', with one
+                 minified item per line.
+    - ndjson.gz: the same, gzip compressed, as 'output_dir/subset/items.ndjson.gz'.
+
+A shard replaces thousands of small files, and as many inodes and PUT requests, with
+two files per subset: the shard and its index.
+
+HOW (shards):
+    - The index, 'items.ndjson.idx' or 'items.ndjson.gz.idx', has one line per item:
+          item <TAB> block_offset <TAB> block_length <TAB> offset <TAB> length
+      The block is the byte range of the shard to read. In a gzip shard it is a gzip
+      member of up to BLOCK_ITEMS items (members can be concatenated in one file), and
+      offset and length give the item in the decompressed block. In a plain shard the
+      block is the item itself. So any item can be read with a single ranged read;
+      see read_item().
+    - A ShardWriter assembles the shard and its index as temporary files in the
+      local_dir of the output storage and moves both into place on close(). Those
+      left by a killed run are removed by the next one (see remove_temp_files()). Items
+      that are not added again in this run, e.g. unchanged ones in incremental mode,
+      are copied from the previous shard, so a shard always has every item of its
+      subset, as the per-item files would. They are read a few blocks at a time.
+    - As with per-item files, an item already in the shard is not replaced unless it
+      was rebuilt in incremental mode.
+
+USAGE:
+    shards.py output_dir subset item    prints the STAC JSON of an item from its shard.
+'''
+# ------------------------------------------------------------------------------
+import click
+import gzip
+import json
+import os
+import tempfile
+
+import storage
+
+FORMATS = ('json', 'minified', 'ndjson', 'ndjson.gz')
+SHARDED = ('ndjson', 'ndjson.gz')
+SHARD = 'items.'
+INDEX_SUFFIX = '.idx'
+TEMP_PREFIX = '.shard-' # Temporary files of the shards, in the local_dir of the output storage.
+BLOCK_ITEMS = 64 # Items per gzip member, and per append to the temporary shard.
+READ_BYTES = 1 << 20 # Most bytes of a shard, or of any object copied, read at a time.
+
+# ------------------------------------------------------------------------------
+# dumps:
+# An item as a string in the given output format. Shards have minified items.
+# ------------------------------------------------------------------------------
+def dumps(item_dict, output_format):
+    if output_format == 'json':
+        return json.dumps(item_dict, indent=1)
+    return json.dumps(item_dict, separators=(',', ':'))
+
+def shard_key(subset, output_format):
+    return subset + SHARD + output_format
+
+# ------------------------------------------------------------------------------
+# _load_index:
+# The index of a shard as {item: (block_offset, block_length, offset, length)}, or
+# {} if there is none.
+# ------------------------------------------------------------------------------
+def _load_index(output_store, key):
+    if not output_store.exists(key + INDEX_SUFFIX):
+        return {}
+    index = {}
+    for line in output_store.read_many([key + INDEX_SUFFIX])[0].decode('utf-8').splitlines():
+        item, block_offset, block_length, offset, length = line.split('\t')
+        index[item] = (int(block_offset), int(block_length), int(offset), int(length))
+    return index
+
+# ------------------------------------------------------------------------------
+# ShardWriter:
+# The shard of one subset, written to disk in blocks as its items are added.
+# ------------------------------------------------------------------------------
+class ShardWriter(object):
+    def __init__(self, output_store, subset, output_format):
+        self.output_store = output_store
+        self.key = shard_key(subset, output_format)
+        self.compress = output_format.endswith('.gz')
+        self.previous = _load_index(output_store, self.key)
+        self.added = set()
+        self.lines = [] # (item, line) not yet written.
+        self.index = []
+        self.size = 0
+        self.shard_file = None # Made with the first block.
+
+    # --------------------------------------------------------------------------
+    # has:
+    # True if the item is in the previous shard.
+    # --------------------------------------------------------------------------
+    def has(self, item):
+        return item in self.previous
+
+    def add(self, item, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        self.added.add(item)
+        self.lines.append((item, line))
+        if len(self.lines) >= BLOCK_ITEMS:
+            self._write_block()
+
+    def _write_block(self):
+        if not self.lines:
+            return
+        if self.shard_file is None:
+            self.shard_file = _temp_file(self.output_store, TEMP_PREFIX)
+        with open(self.shard_file, 'ab') as f:
+            if self.compress:
+                entries, offset = [], 0
+                for item, line in self.lines:
+                    entries.append((item, offset, len(line)))
+                    offset += len(line) + 1
+                block = gzip.compress(b'\n'.join(line for item, line in self.lines) + b'\n', 6)
+                self.index.extend((item, self.size, len(block), offset, length) for item, offset, length in entries)
+                f.write(block)
+                self.size += len(block)
+            else:
+                for item, line in self.lines:
+                    self.index.append((item, self.size, len(line), 0, len(line)))
+                    f.write(line + b'\n')
+                    self.size += len(line) + 1
+        self.lines = []
+
+    # --------------------------------------------------------------------------
+    # _previous_lines:
+    # The (item, line) of the items of the previous shard that were not added
+    # again, in shard order. Their blocks are read with ranged reads of adjacent
+    # blocks, of up to READ_BYTES, so the previous shard is never held whole.
+    # --------------------------------------------------------------------------
+    def _previous_lines(self):
+        blocks = {}
+        for item, (block_offset, block_length, offset, length) in self.previous.items():
+            if item not in self.added:
+                blocks.setdefault((block_offset, block_length), []).append((offset, length, item))
+        for span in _spans(sorted(blocks)):
+            start = span[0][0]
+            data = self.output_store.read_range(self.key, start, span[-1][0] + span[-1][1] - start)
+            for block_offset, block_length in span:
+                block = data[block_offset - start:block_offset - start + block_length]
+                if self.compress:
+                    block = gzip.decompress(block)
+                for offset, length, item in sorted(blocks[(block_offset, block_length)]):
+                    yield item, block[offset:offset + length]
+
+    # --------------------------------------------------------------------------
+    # close:
+    # Copy the previous items that were not added again, and move the shard and
+    # its index into place.
+    # --------------------------------------------------------------------------
+    def close(self):
+        index_file = None
+        try:
+            for item, line in self._previous_lines():
+                self.add(item, line)
+            self._write_block()
+            if self.shard_file is None: # No item: an empty shard.
+                self.shard_file = _temp_file(self.output_store, TEMP_PREFIX)
+
+            index_file = _temp_file(self.output_store, TEMP_PREFIX + 'index-')
+            with open(index_file, 'w') as f:
+                for entry in self.index:
+                    f.write('\t'.join(str(value) for value in entry) + '\n')
+            self.output_store.write_file(self.key, self.shard_file)
+            self.output_store.write_file(self.key + INDEX_SUFFIX, index_file)
+            self.output_store.flush()
+        finally:
+            _remove_files([self.shard_file, index_file]) # Those not moved into place.
+
+# ------------------------------------------------------------------------------
+# _temp_file, _remove_files:
+# A new empty temporary file in the local_dir of the output storage, and the
+# removal of those that are left.
+# ------------------------------------------------------------------------------
+def _temp_file(output_store, prefix):
+    if not os.path.exists(output_store.local_dir):
+        os.makedirs(output_store.local_dir)
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix='.tmp', dir=output_store.local_dir)
+    os.close(fd)
+    return path
+
+def _remove_files(paths):
+    for path in paths:
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+# ------------------------------------------------------------------------------
+# remove_temp_files:
+# Remove the temporary files of the shards left in the local_dir of the output
+# storage by a run that was killed. Called before a run makes its ShardWriters.
+# ------------------------------------------------------------------------------
+def remove_temp_files(output_store):
+    if not os.path.isdir(output_store.local_dir):
+        return
+    for name in os.listdir(output_store.local_dir):
+        if name.startswith(TEMP_PREFIX) and name.endswith('.tmp'):
+            os.remove(os.path.join(output_store.local_dir, name))
+
+# ------------------------------------------------------------------------------
+# _spans:
+# The (block_offset, block_length) of the blocks, sorted, in runs of adjacent
+# blocks that can be read together: up to READ_BYTES, or one larger block.
+# ------------------------------------------------------------------------------
+def _spans(blocks):
+    span = []
+    for block_offset, block_length in blocks:
+        if span and (block_offset != span[-1][0] + span[-1][1] or
+                     block_offset + block_length - span[0][0] > READ_BYTES):
+            yield span
+            span = []
+        span.append((block_offset, block_length))
+    if span:
+        yield span
+
+# ------------------------------------------------------------------------------
+# copy_object:
+# Append an object of a storage to an open binary file, READ_BYTES at a time, so
+# that memory does not grow with the size of the object.
+# ------------------------------------------------------------------------------
+def copy_object(source_store, key, f):
+    size = source_store.size(key)
+    for offset in range(0, size, READ_BYTES):
+        f.write(source_store.read_range(key, offset, min(READ_BYTES, size - offset)))
+
+# ------------------------------------------------------------------------------
+# concatenate:
+# Write the shard of a subset from the shards of the same subset in other stores,
+# e.g. those of the shards of a multi-node run (see 'work_shards.py'), one after
+# the other. The blocks are copied as they are, with their offsets moved.
+# ------------------------------------------------------------------------------
+def concatenate(output_store, subset, output_format, source_stores):
+    key = shard_key(subset, output_format)
+    shard_file = _temp_file(output_store, TEMP_PREFIX)
+    index_file = _temp_file(output_store, TEMP_PREFIX + 'index-')
+    try:
+        size = 0
+        with open(shard_file, 'wb') as shard, open(index_file, 'w') as index:
+            for source_store in source_stores:
+                entries = _load_index(source_store, key)
+                if not entries:
+                    continue
+                copy_object(source_store, key, shard)
+                for item, (block_offset, block_length, offset, length) in sorted(entries.items(), key=lambda entry: entry[1]):
+                    index.write('\t'.join(str(value) for value in (item, size + block_offset, block_length, offset, length)) + '\n')
+                size = shard.tell()
+        output_store.write_file(key, shard_file)
+        output_store.write_file(key + INDEX_SUFFIX, index_file)
+        output_store.flush()
+    finally:
+        _remove_files([shard_file, index_file])
+
+# ------------------------------------------------------------------------------
+# read_item:
+# The STAC JSON of an item, as a string, read from its shard with one ranged read.
+# None if it is not in the shard.
+# ------------------------------------------------------------------------------
+def read_item(output_store, subset, item, output_format='ndjson.gz'):
+    key = shard_key(subset, output_format)
+    entry = _load_index(output_store, key).get(item)
+    if entry is None:
+        return None
+    block_offset, block_length, offset, length = entry
+    block = output_store.read_range(key, block_offset, block_length)
+    if output_format.endswith('.gz'):
+        block = gzip.decompress(block)
+    return block[offset:offset + length].decode('utf-8')
+
+# ------------------------------------------------------------------------------
+# main:
+# Print an item from its shard.
+# ------------------------------------------------------------------------------
+@click.command(name='shards')
+@click.argument('output_dir', type=str)
+@click.argument('subset', type=str)
+@click.argument('item', type=str)
+@click.option('--output_format', type=click.Choice(SHARDED), default='ndjson.gz', help='Format of the shard.')
+@click.option('--s3_endpoint', type=str, default=None, help='Endpoint URL of an S3-compatible store, when output_dir is an s3:// URL.')
+def main(output_dir,subset,item,output_format,s3_endpoint):
+    output_store = storage.open_storage(output_dir, s3_endpoint)
+    line = read_item(output_store, os.path.join(subset, ''), item, output_format)
+    if line is None:
+        raise click.ClickException('{} is not in {}'.format(item, output_store.url(shard_key(os.path.join(subset, ''), output_format))))
+    print(json.dumps(json.loads(line), indent=1))
+
+# ------------------------------------------------------------------------------
+# Standard boilerplate to call the main() function.
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,127 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+In-process API to make STAC items, for a program that already has the
+ARD-METADATA.yaml and bounds.geojson of its items in memory, e.g. the packaging job
+that has just written them. It makes the same items as 'parse_direct.py', without a
+process to start nor any file to read or write, and is what the programs of this
+directory use to make their items.
+
+HOW:
+    - An ItemBuilder holds the ItemTemplate of each subset it has seen (see
+      'item_template.py') and nothing else, so builders are independent of each
+      other and of any module globals: a program may have several, e.g. one per
+      product.
+    - The metadata of an item may be given parsed (the dicts of yaml.safe_load() and
+      json.load()) or as bytes or str, which are parsed as 'parse_direct.py' does
+      (see 'ard_yaml.py').
+    - values() takes the values of an item from its metadata; to_dict() and dumps()
+      make its dict or its JSON from them. item_dict() and item_json() do both.
+    - build_items(), dumps_items() and ndjson() do the same for a batch of items,
+      given as (subset, item, ard, bounds), in order. A bad item raises its error.
+
+USAGE:
+    import stac_items
+    builder = stac_items.ItemBuilder('https://FQDN/S2_MSI_ARD/')
+    text = builder.item_json('2018-05-28', item, ard_bytes, bounds_bytes)
+    body = builder.ndjson([('2018-05-28', item, ard, bounds) for item, ard, bounds in packaged])
+'''
+# ------------------------------------------------------------------------------
+import collections
+import gzip
+import json
+import os
+
+import ard_yaml
+import item_template
+import run_stats
+
+# One item of a batch. 'ard' and 'bounds' are parsed, or bytes or str.
+ItemInput = collections.namedtuple('ItemInput', 'subset item ard bounds')
+
+_TEXT = (bytes, bytearray, memoryview, str)
+_NO_TIMINGS = run_stats.ItemTimings('', '', False)
+
+def _text(data):
+    return bytes(data) if isinstance(data, (bytearray, memoryview)) else data
+
+# ------------------------------------------------------------------------------
+# ItemBuilder:
+# The items of a product. 'base_url' is the URL of the product (above the subsets),
+# and with catalogs=True the items link to the catalog.json of their subset and of
+# the product (see 'catalog.py').
+# ------------------------------------------------------------------------------
+class ItemBuilder(object):
+    def __init__(self, base_url, catalogs=True, metadata_mode='events'):
+        self.base_url = os.path.join(base_url, '')
+        self.root_url = self.base_url if catalogs else None
+        self.metadata_mode = metadata_mode
+        self.templates = {}
+
+    # --------------------------------------------------------------------------
+    # template:
+    # The ItemTemplate of a subset, made once.
+    # --------------------------------------------------------------------------
+    def template(self, subset):
+        if subset not in self.templates:
+            self.templates[subset] = item_template.ItemTemplate(
+                self.base_url + (os.path.join(subset, '') if subset else ''), self.root_url)
+        return self.templates[subset]
+
+    # --------------------------------------------------------------------------
+    # values:
+    # The ItemValues of an item, from its ARD-METADATA.yaml and bounds.geojson. Each
+    # stage is timed into 'timings', an ItemTimings, if given.
+    # --------------------------------------------------------------------------
+    def values(self, subset, item, ard, bounds, timings=None):
+        timings = timings or _NO_TIMINGS
+        if isinstance(ard, _TEXT):
+            with timings.stage('parse_yaml'):
+                ard = ard_yaml.load_ard_metadata(_text(ard), self.metadata_mode)
+        if isinstance(bounds, _TEXT):
+            with timings.stage('parse_geojson'):
+                bounds = json.loads(_text(bounds))
+        with timings.stage('build'):
+            return self.template(subset).values(item, ard, bounds)
+
+    def to_dict(self, subset, values):
+        return self.template(subset).to_dict(values)
+
+    # --------------------------------------------------------------------------
+    # dumps:
+    # The JSON of an item in the given output format (see 'shards.py'), written
+    # straight from the template of its subset.
+    # --------------------------------------------------------------------------
+    def dumps(self, subset, values, output_format='json'):
+        return self.template(subset).dumps(values, output_format)
+
+    def item_dict(self, subset, item, ard, bounds):
+        return self.to_dict(subset, self.values(subset, item, ard, bounds))
+
+    def item_json(self, subset, item, ard, bounds, output_format='json'):
+        return self.dumps(subset, self.values(subset, item, ard, bounds), output_format)
+
+    # --------------------------------------------------------------------------
+    # build_items, dumps_items:
+    # The dicts, or the JSON, of a batch of items, one by one as they are made.
+    # 'inputs' is an iterable of ItemInput, or of (subset, item, ard, bounds).
+    # --------------------------------------------------------------------------
+    def build_items(self, inputs):
+        for subset, item, ard, bounds in inputs:
+            yield self.item_dict(subset, item, ard, bounds)
+
+    def dumps_items(self, inputs, output_format='json'):
+        for subset, item, ard, bounds in inputs:
+            yield self.item_json(subset, item, ard, bounds, output_format)
+
+    # --------------------------------------------------------------------------
+    # ndjson:
+    # A batch of items as ndjson, one minified item per line, gzip compressed with
+    # compress=True, e.g. to be uploaded as one object.
+    # --------------------------------------------------------------------------
+    def ndjson(self, inputs, compress=False):
+        data = ''.join(line + '\n' for line in self.dumps_items(inputs, 'ndjson')).encode('utf-8')
+        return gzip.compress(data, 6) if compress else data
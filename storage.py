@@ -0,0 +1,234 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Storage backends for the inputs and outputs of 'create_jsons'.
+
+input_dir and output_dir may each be a local directory or an S3 URL such as
+'s3://dea-public-data/S2_MSI_ARD/'. Items can then be generated straight from and
+into the bucket, without staging copies.
+
+Both backends take keys relative to their root, e.g. 'subset/item/STAC.json':
+    - list_subsets(), list_items(subset): lazily list the subsets and items.
+    - item_record(subset, item): the ItemRecord of an item, with the (mtime, size)
+      of its inputs.
+    - read_many(keys): the content of several objects, as bytes.
+    - read_range(key, offset, length): part of an object, as bytes.
+    - size(key): the size of an object, in bytes.
+    - exists(key): True if the object exists and is not empty.
+    - write(key, data), flush(): write an object. A write may still be in flight
+      until flush() returns. Readers never see a partly written object: a local file
+      is written to a temporary file and renamed into place, and an S3 PUT is atomic.
+    - write_file(key, path): move a local file (e.g. a large catalog assembled on
+      disk) into place. The file must be in local_dir.
+    - url(key): the full path or URL of a key, for messages.
+    - local_dir: a local directory for the state and index files of this root.
+
+HOW (S3):
+    - Uses boto3, which is only needed if an S3 URL is given. Any S3-compatible
+      store (e.g. MinIO or a moto server for testing) can be used with endpoint_url;
+      the AWS_ENDPOINT_URL environment variable is honoured as well.
+    - One client, with a connection pool of max_concurrency connections, is made per
+      process (after the fork, for the parallel program).
+    - read_many() GETs its keys concurrently. write() PUTs in the background, with
+      at most 2 * max_concurrency PUTs in flight.
+    - item_record() takes the stat data of both inputs from a single LIST request.
+'''
+# ------------------------------------------------------------------------------
+import collections
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import discovery
+from discovery import ARD_METADATA, BOUNDS, ItemRecord
+
+DEFAULT_CONCURRENCY = 16
+S3_LOCAL_DIR = '.stac_s3' # Local directory for the state and index files of S3 roots.
+
+# ------------------------------------------------------------------------------
+# open_storage:
+# The backend for a local directory or an 's3://bucket/prefix/' URL.
+# ------------------------------------------------------------------------------
+def open_storage(location, endpoint_url=None, max_concurrency=DEFAULT_CONCURRENCY):
+    location = os.path.join(location, '')
+    if location.startswith('s3://'):
+        return S3Storage(location, endpoint_url, max_concurrency)
+    return LocalStorage(location)
+
+# ------------------------------------------------------------------------------
+# LocalStorage:
+# A local (or network mounted) directory, accessed with the low-syscall helpers of
+# 'discovery.py'.
+# ------------------------------------------------------------------------------
+class LocalStorage(object):
+    def __init__(self, root):
+        self.root = os.path.join(root, '')
+        self.local_dir = self.root
+
+    def url(self, key):
+        return self.root + key
+
+    def list_subsets(self):
+        return discovery.list_subsets(self.root)
+
+    def list_items(self, subset):
+        return discovery.list_items(self.root + subset)
+
+    def item_record(self, subset, item):
+        item_key = subset + item + '/'
+        stats = discovery.stat_inputs(self.root + item_key + ARD_METADATA, self.root + item_key + BOUNDS)
+        return ItemRecord(item, item_key + ARD_METADATA, item_key + BOUNDS, stats)
+
+    def read_many(self, keys):
+        data = []
+        for key in keys:
+            with open(self.root + key, 'rb') as f:
+                data.append(f.read())
+        return data
+
+    def read_range(self, key, offset, length):
+        with open(self.root + key, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def size(self, key):
+        return os.path.getsize(self.root + key)
+
+    def exists(self, key):
+        return discovery.output_exists(self.root + key)
+
+    def write(self, key, data):
+        path = self.root + key
+        discovery.make_output_dir(os.path.dirname(path))
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'wb' if isinstance(data, bytes) else 'w') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def write_file(self, key, path):
+        target = self.root + key
+        discovery.make_output_dir(os.path.dirname(target))
+        os.chmod(path, 0o644)
+        os.replace(path, target)
+
+    def flush(self):
+        pass
+
+# ------------------------------------------------------------------------------
+# S3Storage:
+# A prefix of an S3 bucket.
+# ------------------------------------------------------------------------------
+class S3Storage(object):
+    def __init__(self, url, endpoint_url=None, max_concurrency=DEFAULT_CONCURRENCY):
+        self.bucket, _, self.prefix = url[len('s3://'):].partition('/')
+        self.prefix = os.path.join(self.prefix, '') if self.prefix else ''
+        self.endpoint_url = endpoint_url
+        self.max_concurrency = max_concurrency
+        self.local_dir = os.path.join(S3_LOCAL_DIR, self.bucket, self.prefix)
+        self._pid = None
+        self._lock = threading.Lock() # The methods may be called from several threads.
+
+    # --------------------------------------------------------------------------
+    # _setup:
+    # Make the boto3 client and the thread pool of this process. Clients and their
+    # connection pools cannot be shared across a fork, so each process makes its own
+    # on first use.
+    # --------------------------------------------------------------------------
+    def _setup(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            import boto3
+            from botocore.config import Config
+            config = Config(max_pool_connections=self.max_concurrency, retries={'max_attempts': 5, 'mode': 'standard'})
+            self._client = boto3.session.Session().client('s3', endpoint_url=self.endpoint_url, config=config)
+            self._executor = ThreadPoolExecutor(self.max_concurrency)
+            self._pending = collections.deque()
+            self._pid = os.getpid()
+
+    @property
+    def client(self):
+        self._setup()
+        return self._client
+
+    def url(self, key):
+        return 's3://' + self.bucket + '/' + self.prefix + key
+
+    def _list_prefixes(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix, Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', []):
+                yield common_prefix['Prefix'][len(self.prefix + prefix):]
+
+    def list_subsets(self):
+        return self._list_prefixes('')
+
+    def list_items(self, subset):
+        for item in self._list_prefixes(subset):
+            yield item.rstrip('/')
+
+    def item_record(self, subset, item):
+        item_key = subset + item + '/'
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix + item_key, Delimiter='/')
+        objects = {obj['Key'][len(self.prefix + item_key):]: obj for obj in response.get('Contents', [])}
+        ard, bounds = objects.get(ARD_METADATA), objects.get(BOUNDS)
+        stats = None
+        if ard and bounds and ard['Size'] > 0 and bounds['Size'] > 0:
+            stats = (ard['LastModified'].timestamp(), ard['Size'], bounds['LastModified'].timestamp(), bounds['Size'])
+        return ItemRecord(item, item_key + ARD_METADATA, item_key + BOUNDS, stats)
+
+    def _get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+
+    def read_many(self, keys):
+        self._setup()
+        return list(self._executor.map(self._get, keys))
+
+    def read_range(self, key, offset, length):
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key,
+                                      Range='bytes={}-{}'.format(offset, offset + length - 1))['Body'].read()
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)['ContentLength']
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)['ContentLength'] > 0
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def write(self, key, data):
+        client = self.client
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        content_type = 'application/json' if key.endswith('.json') else 'binary/octet-stream'
+        with self._lock:
+            while len(self._pending) >= 2 * self.max_concurrency:
+                self._pending.popleft().result()
+            self._pending.append(self._executor.submit(
+                client.put_object, Bucket=self.bucket, Key=self.prefix + key, Body=data, ContentType=content_type))
+
+    def write_file(self, key, path):
+        content_type = 'application/json' if key.endswith('.json') else 'binary/octet-stream'
+        self.client.upload_file(path, self.bucket, self.prefix + key, ExtraArgs={'ContentType': content_type})
+        os.remove(path)
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            while self._pending:
+                self._pending.popleft().result()
@@ -0,0 +1,77 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+The items made from ARD-METADATA.yaml read in events mode must be those of a full load.
+
+USAGE:
+    python -m pytest -q tests
+'''
+# ------------------------------------------------------------------------------
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ard_yaml
+import stac_items
+
+ITEM = 'S2A_OPER_MSI_ARD_TL_EPAE_20180529T010118_A000000_T56HPK_N02.06'
+BOUNDS = {"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": {"type": "Polygon",
+          "coordinates": [[[149.1, -35.9], [150.2, -35.9], [150.2, -34.9], [149.1, -34.9], [149.1, -35.9]]]}}]}
+
+PLAIN = """id: 7d9d8ba0-0000-4a5b-9c1e-2f6b2d0c8a11
+extent:
+  center_dt: '2018-05-29T00:10:02.775Z'
+  coord:
+    ll: {lat: -35.9, lon: 149.1}
+    ur: {lat: -34.9, lon: 150.2}
+image:
+  bands:
+    nbar_blue: {layer: 1, path: NBAR/NBAR_B02.TIF}
+    fmask: {layer: 1, path: QA/FMASK.TIF}
+lineage: {source_datasets: {}}
+"""
+
+MERGE_AT_TOP_LEVEL = """defaults: &defaults
+  id: 7d9d8ba0-0000-4a5b-9c1e-2f6b2d0c8a11
+  extent:
+    center_dt: '2018-05-29T00:10:02.775Z'
+    coord:
+      ll: {lat: -35.9, lon: 149.1}
+      ur: {lat: -34.9, lon: 150.2}
+<<: *defaults
+image:
+  bands:
+    nbar_blue: {layer: 1, path: NBAR/NBAR_B02.TIF}
+"""
+
+MERGE_IN_BANDS = """id: 7d9d8ba0-0000-4a5b-9c1e-2f6b2d0c8a11
+extent:
+  center_dt: '2018-05-29T00:10:02.775Z'
+  coord:
+    ll: {lat: -35.9, lon: 149.1}
+    ur: {lat: -34.9, lon: 150.2}
+band: &band {layer: 1, path: NBAR/NBAR_B02.TIF}
+image:
+  bands:
+    <<: {fmask: {layer: 1, path: QA/FMASK.TIF}}
+    nbar_blue:
+      <<: *band
+    nbar_green:
+      <<: *band
+      path: NBAR/NBAR_B03.TIF
+"""
+
+@pytest.mark.parametrize('document', [PLAIN, MERGE_AT_TOP_LEVEL, MERGE_IN_BANDS],
+                         ids=['plain', 'merge_at_top_level', 'merge_in_bands'])
+def test_events_mode_makes_the_item_of_a_full_load(document):
+    items = []
+    for mode in ard_yaml.MODES:
+        builder = stac_items.ItemBuilder('http://example.com/S2_MSI_ARD/', metadata_mode=mode)
+        items.append(builder.item_json('05S105E-10S110E', ITEM, document.encode('utf-8'), BOUNDS))
+    assert items[0] == items[1]
+    assert 'NBAR/NBAR_B02.TIF' in items[0]
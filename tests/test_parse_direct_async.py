@@ -0,0 +1,76 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Runs of 'parse_direct_async.py' on a small input tree made in a temporary directory.
+
+USAGE:
+    python -m pytest -q tests
+'''
+# ------------------------------------------------------------------------------
+import json
+import os
+import subprocess
+import sys
+
+PROGRAM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'parse_direct_async.py')
+SUBSET = '05S105E-10S110E'
+ITEMS = ['S2A_OPER_MSI_ARD_TL_EPAE_20180529T010118_A00000{}_T56HPK_N02.06'.format(i) for i in range(3)]
+
+ARD_METADATA = """id: 7d9d8ba0-{0:04d}-4a5b-9c1e-2f6b2d0c8a11
+product_type: S2MSIARD
+creation_dt: '2018-05-29T01:01:18'
+extent:
+  center_dt: '2018-05-29T00:10:0{0}.775Z'
+  coord:
+    ll: {{lat: -35.9, lon: 149.1}}
+    lr: {{lat: -35.9, lon: 150.2}}
+    ul: {{lat: -34.9, lon: 149.1}}
+    ur: {{lat: -34.9, lon: 150.2}}
+format: {{name: GeoTIFF}}
+image:
+  bands:
+    nbar_blue: {{layer: 1, path: NBAR/NBAR_B02.TIF}}
+    fmask: {{layer: 1, path: QA/FMASK.TIF}}
+"""
+
+BOUNDS = {"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": {"type": "Polygon",
+          "coordinates": [[[149.1, -35.9], [150.2, -35.9], [150.2, -34.9], [149.1, -34.9], [149.1, -35.9]]]}}]}
+
+def _input_tree(tmpdir):
+    input_dir = os.path.join(str(tmpdir), 'packaged')
+    for i, item in enumerate(ITEMS):
+        item_dir = os.path.join(input_dir, SUBSET, item)
+        os.makedirs(item_dir)
+        with open(os.path.join(item_dir, 'ARD-METADATA.yaml'), 'w') as f:
+            f.write(ARD_METADATA.format(i))
+        with open(os.path.join(item_dir, 'bounds.geojson'), 'w') as f:
+            json.dump(BOUNDS, f)
+    return input_dir
+
+def _run(tmpdir, *options):
+    config = os.path.join(str(tmpdir), 'stac.yaml')
+    with open(config, 'w') as f:
+        f.write('base_url: http://example.com/S2_MSI_ARD\n')
+        f.write('input_dir: {}\n'.format(_input_tree(tmpdir)))
+        f.write('subset: {}\n'.format(SUBSET))
+        f.write('output_dir: {}\n'.format(os.path.join(str(tmpdir), 'Json')))
+    return subprocess.run([sys.executable, PROGRAM, config, '--cores=0'] + list(options),
+                          cwd=str(tmpdir), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+# ------------------------------------------------------------------------------
+# Without catalogs nor --incremental, there is no state to record: the run must
+# still write its items and close the journal and the index.
+# ------------------------------------------------------------------------------
+def test_no_catalogs_without_incremental(tmpdir):
+    run = _run(tmpdir, '--no_catalogs')
+    assert run.returncode == 0, run.stdout
+    assert 'Finished !' in run.stdout
+    output_dir = os.path.join(str(tmpdir), 'Json')
+    for item in ITEMS:
+        with open(os.path.join(output_dir, SUBSET, item, 'STAC.json')) as f:
+            assert json.load(f)['id']
+    assert not os.path.exists(os.path.join(output_dir, SUBSET, 'catalog.json'))
+    assert os.path.exists(os.path.join(output_dir, 'items.sqlite'))
@@ -0,0 +1,85 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+The S3Storage backend of 'storage.py', against moto's in-process S3.
+
+USAGE:
+    python -m pytest -q tests
+'''
+# ------------------------------------------------------------------------------
+import os
+import sys
+
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import storage
+
+BUCKET = 'dea-public-data'
+SUBSET = '05S105E-10S110E/'
+ITEMS = ['S2A_OPER_MSI_ARD_TL_EPAE_20180529T010118_A00000{}_T56HPK_N02.06'.format(i) for i in range(3)]
+
+@pytest.fixture
+def s3(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir)) # local_dir is relative to the working directory.
+    for var, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                       ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(var, value)
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        for item in ITEMS:
+            client.put_object(Bucket=BUCKET, Key='S2_MSI_ARD/' + SUBSET + item + '/ARD-METADATA.yaml', Body=b'id: ' + item.encode())
+            client.put_object(Bucket=BUCKET, Key='S2_MSI_ARD/' + SUBSET + item + '/bounds.geojson', Body=b'{}')
+        client.put_object(Bucket=BUCKET, Key='S2_MSI_ARD/' + SUBSET + 'EMPTY/ARD-METADATA.yaml', Body=b'')
+        client.put_object(Bucket=BUCKET, Key='S2_MSI_ARD/' + SUBSET + 'EMPTY/bounds.geojson', Body=b'{}')
+        yield client
+
+def test_list(s3):
+    store = storage.open_storage('s3://{}/S2_MSI_ARD'.format(BUCKET))
+    assert list(store.list_subsets()) == [SUBSET]
+    assert sorted(store.list_items(SUBSET)) == sorted(ITEMS + ['EMPTY'])
+
+def test_item_record(s3):
+    store = storage.open_storage('s3://{}/S2_MSI_ARD'.format(BUCKET))
+    record = store.item_record(SUBSET, ITEMS[0])
+    assert record.ard_metadata_file == SUBSET + ITEMS[0] + '/ARD-METADATA.yaml'
+    assert record.bounds_file == SUBSET + ITEMS[0] + '/bounds.geojson'
+    ard_mtime, ard_size, bounds_mtime, bounds_size = record.stats
+    assert (ard_size, bounds_size) == (len('id: ' + ITEMS[0]), 2)
+    assert store.item_record(SUBSET, 'EMPTY').stats is None # An empty input, as with local files.
+
+def test_read(s3):
+    store = storage.open_storage('s3://{}/S2_MSI_ARD'.format(BUCKET))
+    keys = [SUBSET + item + '/ARD-METADATA.yaml' for item in ITEMS]
+    assert store.read_many(keys) == [b'id: ' + item.encode() for item in ITEMS]
+    assert store.read_range(keys[0], 4, 3) == ITEMS[0][:3].encode()
+    assert store.size(keys[0]) == len('id: ' + ITEMS[0])
+
+def test_write(s3):
+    store = storage.open_storage('s3://{}/stac'.format(BUCKET))
+    key = SUBSET + ITEMS[0] + '/STAC.json'
+    assert not store.exists(key)
+    store.write(key, '{"id": "a"}')
+    store.write(SUBSET + 'empty.json', b'')
+    store.flush()
+    assert store.exists(key)
+    assert not store.exists(SUBSET + 'empty.json') # Empty objects count as missing.
+    assert s3.get_object(Bucket=BUCKET, Key='stac/' + key)['Body'].read() == b'{"id": "a"}'
+    assert s3.head_object(Bucket=BUCKET, Key='stac/' + key)['ContentType'] == 'application/json'
+
+    os.makedirs(store.local_dir)
+    path = os.path.join(store.local_dir, 'catalog.tmp')
+    with open(path, 'w') as f:
+        f.write('{"id": "catalog"}')
+    store.write_file(SUBSET + 'catalog.json', path)
+    store.flush()
+    assert not os.path.exists(path) # Moved into place.
+    assert store.read_many([SUBSET + 'catalog.json']) == [b'{"id": "catalog"}']
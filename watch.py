@@ -0,0 +1,582 @@
+#!/usr/bin/env python
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+A long running process that writes the STAC.json of each item as soon as it lands in
+input_dir, instead of waiting for the next cron run over whole subsets.
+
+HOW:
+    - input_dir is watched with inotify, or, with --poll or where inotify is not
+      available, by polling the mtimes of input_dir and of its subset directories,
+      which change when an item directory is added. Inotify does not see changes
+      made on other hosts of a network filesystem, so use --poll for those.
+    - A new or changed item is pending until both ARD-METADATA.yaml and
+      bounds.geojson exist and neither was modified in the last --settle seconds, so
+      that a directory that is still being written is not picked up half way.
+      Pending items are looked at with a stat of their two inputs, and inotify
+      watches are only kept on the directories of pending items.
+    - Ready items are fed to a pool of workers started once, with the item code of
+      'parse_direct_parallel.py'. A thread collects the results and records them in
+      the state index and the item index of output_dir, as an incremental run would.
+    - On start, every item of input_dir is looked at once, and only those that
+      changed since they were last recorded are processed (see 'item_state.py').
+    - A status line with the backlog (items settling, incomplete, failed and queued)
+      is printed every --status_interval seconds, and on SIGUSR1. With --report
+      and/or --prometheus it is also written there, with the backlog as gauges.
+    - SIGTERM or SIGINT stops the watch: the items in the pool are finished and
+      recorded, and the process exits. Items still pending are picked up by the
+      next start. A second signal kills it.
+    - The catalog.json files are not rewritten, as they are remade from all the
+      items of a subset: keep a periodic run of 'parse_direct_parallel.py' for them.
+    - A failed item is tried again when one of its inputs changes.
+
+USAGE:
+    watch.py stac.yaml --subset=A --cores=4
+
+    See usage() or --info=yes.
+'''
+# ------------------------------------------------------------------------------
+import click
+import ctypes
+import ctypes.util
+import errno
+import os
+import queue
+import select
+import signal
+import struct
+import threading
+import time
+import yaml
+
+import ard_yaml
+import catalog
+import discovery
+import executor
+import item_index
+import item_state
+import parse_direct_parallel as pdp
+import run_stats
+import storage
+
+SETTLE = 5.0 # Seconds an item's inputs must be left alone before it is processed.
+STATUS_INTERVAL = 60.0
+TICK = 0.5 # Longest wait for events before the pending items are looked at again.
+FAILED_RECHECK = 60.0 # Seconds between looks at the inputs of an item that failed.
+FLUSH_ITEMS = 64 # Results recorded per transaction while the pool is busy.
+
+# inotify(7)
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+DIR_MASK = IN_CREATE | IN_MOVED_TO # input_dir and the subsets: new directories.
+ITEM_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ATTRIB # Pending items: their files.
+_EVENT = struct.Struct('iIII')
+
+# Globals
+stopping = threading.Event()
+status_requested = threading.Event()
+lock = threading.Lock() # Held for everything the main loop and the result thread share.
+state = {} # (subset, item): recorded state, kept up to date as items are processed.
+in_flight = set()
+touched = set() # Items changed while in the pool, or failed, to be looked at again after.
+failed = {} # (subset, item): the stat data of the inputs that failed.
+first_seen = {} # (subset, item): when it was first seen pending, for the latency.
+counts = {'published': 0, 'failed': 0, 'latency_sum': 0.0, 'latency_max': 0.0}
+stats = None # RunStats, with --report or --prometheus.
+
+# ------------------------------------------------------------------------------
+# _default_config:
+# As in 'parse_direct_parallel.py'.
+# ------------------------------------------------------------------------------
+def _default_config(ctx, param, value):
+     if os.path.exists(value):
+         return value
+     ctx.fail('STAC_CONFIG_FILE not provided.')
+
+# ------------------------------------------------------------------------------
+# Inotify:
+# The inotify(7) API through ctypes. Each watch is tagged with the (subset, item) it
+# is on; (None, None) for input_dir, and (subset, None) for a subset directory.
+# ------------------------------------------------------------------------------
+class Inotify(object):
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches = {} # wd: (subset, item)
+        self.keys = {} # (subset, item): wd
+
+    def add_watch(self, path, mask, key):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        self.watches[wd] = key
+        self.keys[key] = wd
+
+    def rm_watch(self, key):
+        wd = self.keys.pop(key, None)
+        if wd is not None:
+            self.watches.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    # --------------------------------------------------------------------------
+    # read:
+    # The events that arrive within 'timeout' seconds, as (key, mask, name).
+    # --------------------------------------------------------------------------
+    def read(self, timeout):
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except InterruptedError:
+            return []
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+            offset += length
+            if mask & IN_IGNORED: # The watched directory is gone.
+                key = self.watches.pop(wd, None)
+                if self.keys.get(key) == wd:
+                    del self.keys[key]
+                continue
+            events.append((self.watches.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+# ------------------------------------------------------------------------------
+# InotifyWatcher:
+# The items of input_dir that were added or changed, from inotify events.
+# 'subsets' is the list of subsets to watch, or None for all of them.
+# ------------------------------------------------------------------------------
+class InotifyWatcher(object):
+    def __init__(self, input_dir, subsets):
+        self.input_dir = os.path.join(input_dir, '')
+        self.subsets = subsets
+        self.inotify = Inotify()
+        if subsets is None:
+            self.inotify.add_watch(self.input_dir, DIR_MASK, (None, None))
+
+    # --------------------------------------------------------------------------
+    # scan:
+    # Watch the subsets and list all their items.
+    # --------------------------------------------------------------------------
+    def scan(self):
+        subsets = self.subsets
+        if subsets is None:
+            subsets = list(discovery.list_subsets(self.input_dir))
+        for subset in subsets:
+            for key in self._watch_subset(subset):
+                yield key
+
+    def _watch_subset(self, subset):
+        try:
+            if (subset, None) not in self.inotify.keys:
+                self.inotify.add_watch(self.input_dir + subset, DIR_MASK, (subset, None))
+            return [(subset, item) for item in discovery.list_items(self.input_dir + subset)]
+        except OSError as e:
+            print("*** Cannot watch {}: {}".format(self.input_dir + subset, e))
+            return []
+
+    def watch_item(self, key):
+        if key not in self.inotify.keys:
+            subset, item = key
+            try:
+                self.inotify.add_watch(self.input_dir + subset + item, ITEM_MASK, key)
+            except OSError:
+                pass # Gone already, or out of watches: it is still looked at while pending.
+
+    def unwatch_item(self, key):
+        self.inotify.rm_watch(key)
+
+    # --------------------------------------------------------------------------
+    # changes:
+    # The (subset, item) pairs touched within 'timeout' seconds. After an overflow
+    # of the event queue, every item is listed again.
+    # --------------------------------------------------------------------------
+    def changes(self, timeout):
+        keys = []
+        for key, mask, name in self.inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                print("*** Inotify queue overflow: rescanning", self.input_dir)
+                keys.extend(self.scan())
+            elif key is None:
+                continue
+            elif key == (None, None):
+                if mask & IN_ISDIR:
+                    keys.extend(self._watch_subset(name + '/'))
+            elif key[1] is None:
+                if mask & IN_ISDIR:
+                    keys.append((key[0], name))
+            else:
+                keys.append(key)
+        return keys
+
+    def close(self):
+        self.inotify.close()
+
+# ------------------------------------------------------------------------------
+# PollWatcher:
+# The items of input_dir that were added, found by polling every 'interval' seconds.
+# Only the directories whose mtime changed are listed again. Changes to the files
+# of an item are seen while it is pending, as its inputs are stat'ed then.
+# ------------------------------------------------------------------------------
+class PollWatcher(object):
+    def __init__(self, input_dir, subsets, interval):
+        self.input_dir = os.path.join(input_dir, '')
+        self.subsets = subsets
+        self.interval = interval
+        self.mtimes = {} # directory: mtime when it was last listed
+        self.items = {} # subset: set of items
+        self.next_poll = time.time() + interval
+
+    def _changed(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+        if self.mtimes.get(path) == mtime:
+            return False
+        self.mtimes[path] = mtime
+        return True
+
+    def _poll(self, everything=False):
+        subsets = self.subsets
+        if subsets is None:
+            if self._changed(self.input_dir) or everything:
+                self.subset_list = list(discovery.list_subsets(self.input_dir))
+            subsets = self.subset_list
+        keys = []
+        for subset in subsets:
+            if self._changed(self.input_dir + subset) or everything:
+                try:
+                    items = set(discovery.list_items(self.input_dir + subset))
+                except OSError:
+                    continue
+                known = self.items.get(subset, set())
+                keys.extend((subset, item) for item in sorted(items if everything else items - known))
+                self.items[subset] = items
+        return keys
+
+    def scan(self):
+        return self._poll(everything=True)
+
+    def watch_item(self, key):
+        pass
+
+    def unwatch_item(self, key):
+        pass
+
+    def changes(self, timeout):
+        wait = self.next_poll - time.time()
+        if wait > timeout:
+            stopping.wait(timeout)
+            return []
+        stopping.wait(max(0, wait))
+        self.next_poll = time.time() + self.interval
+        return self._poll()
+
+    def close(self):
+        pass
+
+# ------------------------------------------------------------------------------
+# _process:
+# Run in a worker: the item code of 'parse_direct_parallel.py' on one item.
+# ------------------------------------------------------------------------------
+def _process(work):
+    result, timings = pdp.create_jsons(work)
+    return work, result, timings
+
+# ------------------------------------------------------------------------------
+# record_results:
+# Run in a thread: record the results of the pool in the state index and the item
+# index as they arrive, until the work queue is closed.
+# ------------------------------------------------------------------------------
+def record_results(pool, work_queue):
+    global stats
+    state_conn = item_state.open_state(pdp.output_store.local_dir)
+    if pdp.index:
+        item_index_db = item_index.ItemIndex(pdp.output_store.local_dir)
+    records = []
+    for work, result, timings in pool.map(_process, iter(work_queue.get, None)):
+        now = time.time()
+        with lock:
+            in_flight.discard(work)
+            if timings:
+                stats.add(timings)
+            published = result is not None and result.record is not None
+            if published:
+                latency = now - first_seen.pop(work, now)
+                counts['published'] += 1
+                counts['latency_sum'] += latency
+                counts['latency_max'] = max(counts['latency_max'], latency)
+                state[work] = result.record
+                failed.pop(work, None)
+                records.append(result[:3])
+            else:
+                counts['failed'] += 1
+                touched.add(work) # Back to pending, until its inputs change.
+            idle = not in_flight
+        if published:
+            url = catalog.item_url(pdp.base_url + result.subset, result.item)
+            print("Published {} ({:.1f} s)".format(url, latency))
+            if pdp.index:
+                item_index_db.add(result.subset, result.item, result.id, result.bbox, result.datetime,
+                                  url, result.geometry)
+        else:
+            print("*** Failed:", pdp.input_store.url(work[0] + work[1]))
+        if len(records) >= FLUSH_ITEMS or idle:
+            if pdp.index:
+                item_index_db.commit()
+            item_state.record_items(state_conn, records)
+            records = []
+    if pdp.index:
+        item_index_db.close(pdp.output_store)
+    item_state.record_items(state_conn, records)
+    state_conn.close()
+
+# ------------------------------------------------------------------------------
+# check_pending:
+# Look at the inputs of the pending items that are due, and queue those that are
+# ready. Returns the backlog as {state: number of items}.
+# ------------------------------------------------------------------------------
+def check_pending(pending, watcher, work_queue, settle):
+    now = time.time()
+    backlog = {'settling': 0, 'incomplete': 0, 'failed': 0}
+    for key, (next_check, reason) in list(pending.items()):
+        if next_check > now:
+            backlog[reason] += 1
+            continue
+        item_stats = pdp.input_store.item_record(*key).stats
+        with lock:
+            previous, previous_failure = state.get(key), failed.get(key)
+        if item_stats is None:
+            pending[key] = (now + settle, 'incomplete')
+            watcher.watch_item(key)
+        elif item_state.unchanged(previous, item_stats):
+            del pending[key] # Recorded already.
+            watcher.unwatch_item(key)
+            first_seen.pop(key, None)
+            continue
+        elif previous_failure == item_stats:
+            pending[key] = (now + FAILED_RECHECK, 'failed')
+        elif now - max(item_stats[0], item_stats[2]) < settle:
+            pending[key] = (max(item_stats[0], item_stats[2]) + settle, 'settling')
+        else:
+            del pending[key]
+            watcher.unwatch_item(key)
+            with lock:
+                failed[key] = item_stats # Until it is recorded.
+                in_flight.add(key)
+            work_queue.put(key)
+            continue
+        backlog[pending[key][1]] += 1
+    return backlog
+
+# ------------------------------------------------------------------------------
+# print_status:
+# Print the status line, and write the report if asked for.
+# ------------------------------------------------------------------------------
+def print_status(backlog, pool, report, prometheus):
+    with lock:
+        backlog = dict(backlog, queued=len(in_flight))
+        published, n_failed = counts['published'], counts['failed']
+        mean = counts['latency_sum'] / published if published else 0.0
+        print("Status: {} published, {} failed; latency mean {:.1f} s, max {:.1f} s; backlog: {}".format(
+            published, n_failed, mean, counts['latency_max'],
+            ', '.join('{} {}'.format(n, name) for name, n in sorted(backlog.items()))))
+        if stats:
+            stats.write(report, prometheus, dict(pool.worker_stats), backlog)
+
+# ------------------------------------------------------------------------------
+# watch:
+# Watch input_dir until stopped. 'subsets' is the list of subsets to watch, or None
+# for all of them, including new ones.
+# ------------------------------------------------------------------------------
+def watch(subsets, cores, settle, poll, status_interval, initial_scan, report, prometheus):
+    global stats
+    state_conn = item_state.open_state(pdp.output_store.local_dir)
+    state.update(item_state.load_subsets(state_conn, subsets or pdp.input_store.list_subsets()))
+    state_conn.close()
+    if report or prometheus:
+        stats = run_stats.RunStats('watch')
+
+    def stop(signum, frame):
+        stopping.set()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, stop)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: status_requested.set())
+
+    pool = executor.ItemExecutor(cores, 1)
+    pool.start() # Fork before any thread is started. The workers inherit the handlers above.
+    work_queue = queue.Queue()
+    recorder = threading.Thread(target=record_results, args=(pool, work_queue), name='record_results')
+    recorder.start()
+
+    watcher = None
+    if not poll:
+        try:
+            watcher = InotifyWatcher(pdp.input_dir, subsets)
+        except OSError as e:
+            print("*** Inotify not available ({}): polling every {} s".format(e, max(settle, 1.0)))
+            poll = max(settle, 1.0)
+    if watcher is None:
+        watcher = PollWatcher(pdp.input_dir, subsets, poll)
+    print("Cores: {}; Watching {} ({}); Settle: {} s".format(
+        pool.workers, pdp.input_dir, 'poll every {} s'.format(poll) if poll else 'inotify', settle))
+
+    pending = {} # (subset, item): (next look, reason)
+    scanned = list(watcher.scan())
+    if initial_scan:
+        now = time.time()
+        for key in scanned:
+            pending[key] = (now, 'settling')
+            first_seen.setdefault(key, now)
+    backlog = {}
+    next_status = time.time() + status_interval
+    try:
+        while not stopping.is_set():
+            keys = watcher.changes(TICK)
+            now = time.time()
+            for key in keys:
+                with lock:
+                    busy = key in in_flight
+                    if busy:
+                        touched.add(key)
+                if not busy:
+                    pending[key] = (now, 'settling')
+                    first_seen.setdefault(key, now)
+                    watcher.watch_item(key)
+            with lock:
+                done = [key for key in touched if key not in in_flight]
+                touched.difference_update(done)
+            for key in done:
+                pending[key] = (now, 'settling')
+                first_seen.setdefault(key, now)
+                watcher.watch_item(key)
+            backlog = check_pending(pending, watcher, work_queue, settle)
+            if status_requested.is_set() or now >= next_status:
+                status_requested.clear()
+                print_status(backlog, pool, report, prometheus)
+                next_status = now + status_interval
+    finally:
+        # Also on an error, so that the items in the pool are recorded.
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL) # A second signal kills.
+        with lock:
+            n = len(in_flight)
+        print("Stopping: finishing {} items; {} pending items are left for the next start.".format(n, len(pending)))
+        watcher.close()
+        work_queue.put(None)
+        recorder.join()
+    pool.close()
+    print_status(backlog, pool, report, prometheus)
+    pool.report()
+    print("Finished !")
+
+# ------------------------------------------------------------------------------
+# usage:
+# Help info to run. Invoke it with --info=usage
+# ------------------------------------------------------------------------------
+def usage():
+    this_program = os.path.basename(__file__)
+    print("\n\
+Usage:\n\
+    {} config.yaml. Default is './stac.yaml'. \n\
+\n\
+    Or, commandline as:\n\
+        {} --base_url=url --input_dir=path --subset=str --output_dir=path\n\
+\n\
+    Runs until stopped with SIGTERM or Ctrl-C, and writes the STAC.json of each\n\
+    item of input_dir/subset (or of every subset, with --subset=A) as soon as its\n\
+    ARD-METADATA.yaml and bounds.geojson are written and left alone for --settle\n\
+    seconds. Items that changed since they were last recorded are processed on start.\n\
+\n\
+    input_dir is watched with inotify; add --poll=seconds for network filesystems.\n\
+\n\
+    The backlog is printed every --status_interval seconds and on SIGUSR1, and\n\
+    written with --report=file.json and/or --prometheus=file.prom.\n\
+\n\
+    The catalog.json files are not rewritten: keep a periodic run of\n\
+    parse_direct_parallel.py for them.\n\
+\n\
+".format(this_program,this_program))
+
+# ------------------------------------------------------------------------------
+# main:
+# The main function.
+# ***REMEMBER:*** COMMANDLINE OPTIONS MUST ALL BE IN LOWER CASE
+# ------------------------------------------------------------------------------
+@click.command(name='watch')
+@click.argument('stac_config_file', type=str, default='stac.yaml', callback=_default_config, metavar='STAC_CONFIG_FILE')
+@click.option('--info', type=str, help='Type --info=yes to get additional info.')
+@click.option('--base_url', type=str, help='URL of the product. e.g. https://FQDN/S2_MSI_ARD',default='')
+@click.option('--input_dir', type=str, help='Full path of the directory where the subsets are. e.g. /g/data/dz56/datacube/002/S2_MSI_ARD/packaged',default='')
+@click.option('--subset', type=str, help='The subset to watch, or A for all of them, including new ones.',default='')
+@click.option('--output_dir', type=str, help='Relative or full path of the output directory where the STAC.json will be written under "subset/item/"',default='')
+@click.option('--cores', type=int, default=0, help='Number of workers. By default, the number of CPUs available to this job.')
+@click.option('--settle', type=float, default=SETTLE, help='Seconds the inputs of an item must be left alone before it is processed.')
+@click.option('--poll', type=float, default=0, help='Poll input_dir every so many seconds instead of using inotify, e.g. on a network filesystem.')
+@click.option('--status_interval', type=float, default=STATUS_INTERVAL, help='Seconds between status lines and reports.')
+@click.option('--no_initial_scan', is_flag=True, help='Only process the items that change after the start.')
+@click.option('--metadata_mode', type=click.Choice(ard_yaml.MODES), default='events', help='How ARD-METADATA.yaml is read: only the required values (events) or the whole document (full).')
+@click.option('--output_format', type=click.Choice(('json', 'minified')), default='json', help='Indented (json) or minified STAC.json per item.')
+@click.option('--direct_serialise', is_flag=True, help='Write the items straight from the template of their subset, without making their dicts.')
+@click.option('--s3_endpoint', type=str, default=None, help='Endpoint URL of an S3-compatible store, when output_dir is an s3:// URL.')
+@click.option('--s3_concurrency', type=int, default=storage.DEFAULT_CONCURRENCY, help='Maximum concurrent S3 requests per worker.')
+@click.option('--no_catalogs', is_flag=True, help='Do not link the items to the catalog.json files.')
+@click.option('--no_index', is_flag=True, help='Do not index the items in output_dir/items.sqlite.')
+@click.option('--report', type=str, default=None, help='Time each stage and write a JSON report, with the backlog, to this file.')
+@click.option('--prometheus', type=str, default=None, help='Time each stage and write the report as Prometheus metrics to this file.')
+def main(stac_config_file,info,base_url,input_dir,subset,output_dir,cores,settle,poll,status_interval,no_initial_scan,metadata_mode,output_format,direct_serialise,s3_endpoint,s3_concurrency,no_catalogs,no_index,report,prometheus):
+    if (info):
+        usage()
+        return
+    if ((not base_url) or (not input_dir) or (not subset) or (not output_dir)):  # Specify all or none in commandline. If any is missing, it will use the config file.
+        config = yaml.safe_load(open(stac_config_file))
+        base_url = config['base_url']
+        input_dir = config['input_dir']
+        subset = config['subset']
+        output_dir = config['output_dir']
+    if input_dir.startswith('s3://'):
+        raise click.BadParameter('input_dir must be a local or mounted directory to be watched.', param_hint='input_dir')
+
+    # The item code of the parallel program reads its globals, which the workers inherit.
+    pdp.base_url = os.path.join(base_url, '')
+    pdp.input_dir = os.path.join(input_dir, '')
+    pdp.output_dir = output_dir
+    pdp.input_store = storage.open_storage(input_dir)
+    pdp.output_store = storage.open_storage(output_dir, s3_endpoint, s3_concurrency)
+    pdp.incremental = True # Always rebuild, and make the record of, the items that are queued.
+    pdp.state = {}
+    pdp.metadata_mode = metadata_mode
+    pdp.catalogs = not no_catalogs
+    pdp.index = not no_index
+    pdp.instrument = bool(report or prometheus)
+    pdp.output_format = output_format
+    pdp.direct_serialise = direct_serialise
+    subsets = None if subset == 'A' else [os.path.join(subset, '')]
+    watch(subsets, cores, settle, poll, status_interval, not no_initial_scan, report, prometheus)
+
+# ------------------------------------------------------------------------------
+# Standard boilerplate to call the main() function.
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# ------------------------------------------------------------------------------
+# Copyright (c) 2018, Geoscience Australia
+# Licence: GPL-3.0
+# ------------------------------------------------------------------------------
+'''
+DESCRIPTION:
+Split a run of 'parse_direct_parallel.py' over several nodes, e.g. the tasks of a PBS
+array job, and merge their results. (These are shards of the work, not to be mixed
+up with the ndjson shards of the output, see 'shards.py'.)
+
+HOW:
+    - With --shard=INDEX/COUNT, a run only processes the items whose name hashes
+      (CRC-32) to INDEX modulo COUNT. The hash does not depend on the node, the
+      Python version or the order of the listing, so COUNT runs process disjoint
+      parts of the items that together cover all of them, with no coordination.
+    - The STAC.json files are written to output_dir as usual. Everything that is
+      made from all the items of a subset or of the run (the state index, the item
+      index, the catalogs, the ndjson shards and the report) is kept in the
+      directory of the shard instead, 'output_dir/.shards/INDEX-of-COUNT/', so the
+      runs do not write to the same files. With the same COUNT, an incremental run
+      of a shard finds its own state there on the next run.
+    - Once all the shards are done, this program merges them into output_dir:
+        - the item indexes into 'output_dir/items.sqlite',
+        - the catalogs of each subset into 'output_dir/subset/catalog.json', and
+          the root catalog,
+        - the ndjson shards of each subset, block by block,
+        - the reports into one, with --report and/or --prometheus.
+      A shard is done when its report is written, at the end of its run.
+
+USAGE:
+    PBS array job (#PBS -J 0-7):
+        parse_direct_parallel.py stac.yaml --shard=${PBS_ARRAY_INDEX}/8
+    then, once all of them are done:
+        work_shards.py stac.yaml --count=8
+'''
+# ------------------------------------------------------------------------------
+import click
+import json
+import os
+import sqlite3
+import tempfile
+import yaml
+import zlib
+
+import catalog
+import item_index
+import item_state
+import run_stats
+import shards
+import storage
+
+SHARDS_DIR = '.shards/'
+REPORT = 'report.json'
+
+# ------------------------------------------------------------------------------
+# parse_shard:
+# Click callback: 'INDEX/COUNT' as (index, count), or None.
+# ------------------------------------------------------------------------------
+def parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        index, count = (int(n) for n in value.split('/'))
+    except ValueError:
+        raise click.BadParameter('must be INDEX/COUNT, e.g. 3/8.')
+    if not 0 <= index < count:
+        raise click.BadParameter('INDEX must be from 0 to COUNT - 1.')
+    return index, count
+
+def in_shard(item, shard):
+    index, count = shard
+    return zlib.crc32(item.encode('utf-8')) % count == index
+
+def shard_key(shard):
+    return '{}{}-of-{}/'.format(SHARDS_DIR, shard[0], shard[1])
+
+# ------------------------------------------------------------------------------
+# _merge_index:
+# Add the rows of the item index of a shard, as read from its storage, to the item
+# index of the output_dir.
+# ------------------------------------------------------------------------------
+def _merge_index(item_index_db, shard_store, local_dir):
+    fd, copy = tempfile.mkstemp(prefix='.index-', suffix='.tmp', dir=local_dir)
+    with os.fdopen(fd, 'wb') as f:
+        shards.copy_object(shard_store, item_index.INDEX_FILE, f)
+    conn = sqlite3.connect(copy)
+    rows = conn.execute('SELECT subset, item, stac_id, datetime, href, geometry, west, south, east, north '
+                        'FROM items JOIN items_bbox USING (id)')
+    for subset, item, stac_id, datetime, href, geometry, west, south, east, north in rows:
+        item_index_db.add(subset, item, stac_id, (west, south, east, north), datetime, href,
+                          json.loads(geometry) if geometry is not None else None)
+    conn.close()
+    os.remove(copy)
+
+# ------------------------------------------------------------------------------
+# merge:
+# Merge the results of the 'count' shards of a run into output_dir, and return the
+# merged report. Every shard must be done.
+# ------------------------------------------------------------------------------
+def merge(output_store, base_url, count, shard_stores):
+    missing = [index for index, shard_store in enumerate(shard_stores) if not shard_store.exists(REPORT)]
+    if missing:
+        raise click.ClickException('Shards not done: {}'.format(', '.join('{}/{}'.format(index, count) for index in missing)))
+    subsets = sorted(set(subset for shard_store in shard_stores for subset in shard_store.list_subsets()))
+
+    if any(shard_store.exists(item_index.INDEX_FILE) for shard_store in shard_stores):
+        item_index_db = item_index.ItemIndex(output_store.local_dir)
+        for shard_store in shard_stores:
+            if shard_store.exists(item_index.INDEX_FILE):
+                _merge_index(item_index_db, shard_store, output_store.local_dir)
+        item_index_db.close(output_store)
+        print("Index: {}".format(output_store.url(item_index.INDEX_FILE)))
+
+    shards.remove_temp_files(output_store) # Left by a killed merge.
+    for subset in subsets:
+        for output_format in shards.SHARDED:
+            key = shards.shard_key(subset, output_format)
+            if any(shard_store.exists(key) for shard_store in shard_stores):
+                shards.concatenate(output_store, subset, output_format, shard_stores)
+                print("Shard: {}".format(output_store.url(key)))
+
+    catalog_subsets = [subset for subset in subsets
+                       if any(shard_store.exists(subset + catalog.CATALOG) for shard_store in shard_stores)]
+    if catalog_subsets:
+        state_conn = item_state.open_state(output_store.local_dir)
+        catalog.open_extents(state_conn)
+        for subset in catalog_subsets:
+            subset_catalog = catalog.SubsetCatalog(output_store, base_url, subset, state_conn)
+            for shard_store in shard_stores:
+                if shard_store.exists(subset + catalog.CATALOG):
+                    subset_catalog.add_catalog(json.loads(shard_store.read_many([subset + catalog.CATALOG])[0]))
+            subset_catalog.close()
+        catalog.write_root_catalog(output_store, base_url, state_conn)
+        state_conn.close()
+        print("Catalogs: {} subsets".format(len(catalog_subsets)))
+
+    reports = [json.loads(shard_store.read_many([REPORT])[0]) for shard_store in shard_stores]
+    return run_stats.merge_reports(reports, reports[0]['program'])
+
+# ------------------------------------------------------------------------------
+# _default_config:
+# As in 'parse_direct_parallel.py'.
+# ------------------------------------------------------------------------------
+def _default_config(ctx, param, value):
+     if os.path.exists(value):
+         return value
+     ctx.fail('STAC_CONFIG_FILE not provided.')
+
+# ------------------------------------------------------------------------------
+# main:
+# Merge the shards of a run.
+# ------------------------------------------------------------------------------
+@click.command(name='work_shards')
+@click.argument('stac_config_file', type=str, default='stac.yaml', callback=_default_config, metavar='STAC_CONFIG_FILE')
+@click.option('--count', type=int, required=True, help='Number of shards of the run, the COUNT of --shard=INDEX/COUNT.')
+@click.option('--base_url', type=str, help='URL of the product. e.g. https://FQDN/S2_MSI_ARD',default='')
+@click.option('--output_dir', type=str, help='Output directory of the run.',default='')
+@click.option('--report', type=str, default=None, help='Write the merged JSON report of the shards to this file.')
+@click.option('--prometheus', type=str, default=None, help='Write the merged report as Prometheus metrics to this file.')
+@click.option('--s3_endpoint', type=str, default=None, help='Endpoint URL of an S3-compatible store, when output_dir is an s3:// URL.')
+@click.option('--s3_concurrency', type=int, default=storage.DEFAULT_CONCURRENCY, help='Maximum concurrent S3 requests.')
+def main(stac_config_file,count,base_url,output_dir,report,prometheus,s3_endpoint,s3_concurrency):
+    if (not base_url) or (not output_dir):
+        config = yaml.safe_load(open(stac_config_file))
+        base_url = config['base_url']
+        output_dir = config['output_dir']
+    base_url = os.path.join(base_url, '')
+    output_store = storage.open_storage(output_dir, s3_endpoint, s3_concurrency)
+    shard_stores = [storage.open_storage(output_store.url(shard_key((index, count))), s3_endpoint, s3_concurrency)
+                    for index in range(count)]
+    run_stats.write_report(merge(output_store, base_url, count, shard_stores), report, prometheus)
+
+# ------------------------------------------------------------------------------
+# Standard boilerplate to call the main() function.
+if __name__ == '__main__':
+  main()